@@ -0,0 +1,170 @@
+'''
+Рассылка игровых событий по вебсокетам.
+
+Каждое событие, которое нужно разослать игрокам, оборачивается в `Broadcast`. Он решает, какой
+вариант события получает каждый игрок, и кодирует каждый вариант один раз для всей его аудитории.
+`Broadcast` можно передать в другой процесс (см. `broker`) и закодировать уже там.
+
+События, которые сервер создал в ответ на одно событие игрока, рассылаются вместе с ним одним
+`BroadcastBatch`
+'''
+
+import time
+
+from .codecs import Codec, JSON
+from .metrics import encode_seconds
+from .models import GameEvent, ObservableEvent, EventTargets
+
+
+class Broadcast:
+    '''
+    Игровое событие, разосланное игрокам игры.
+
+    Тем, кто указан в `targets`, достаётся полное событие, остальным, если это `ObservableEvent`, -
+    событие с точки зрения наблюдателя. Игрок, от которого было получено событие, его не получает
+    '''
+
+    __slots__ = ('seq', 'targets', 'from_player', '_event', '_documents', '_payloads')
+
+    def __init__(self, event: GameEvent | None, from_player: str | None = None) -> None:
+        '''
+        @event: Событие, которое нужно разослать
+        @from_player: Идентификатор игрока, от которого было изначально получено событие.
+        `None`, если событие создано сервером
+        '''
+        self.from_player = from_player
+        self._event = event
+        self._documents: dict[bool, dict | None] = {}
+        '''Полное событие и событие с точки зрения наблюдателя в виде словарей'''
+        self._payloads: dict[tuple[Codec, bool], str | bytes] = {}
+        '''Варианты события, закодированные в каждом из использованных форматов'''
+        if event is not None:
+            self.seq: int | None = event.seq
+            self.targets: list[str] | EventTargets = event.targets
+
+    @staticmethod
+    def from_message(message: dict) -> 'Broadcast':
+        '''Восстанавливает рассылку, переданную из другого процесса через `to_message`'''
+        broadcast = Broadcast(None, message['from_player'])
+        broadcast.seq = message['seq']
+        broadcast.targets = message['targets']
+        broadcast._documents = {False: message['full'], True: message['observed']}
+        return broadcast
+
+    def to_message(self) -> dict:
+        '''Рассылка в виде словаря, который можно закодировать в JSON'''
+        return {
+            'seq': self.seq,
+            'targets': self.targets,
+            'from_player': self.from_player,
+            'full': self.document(observed=False),
+            'observed': self.document(observed=True),
+        }
+
+    def document(self, observed: bool) -> dict | None:
+        '''
+        Полное событие или событие с точки зрения наблюдателя в виде словаря.
+        `None`, если у события нет варианта для наблюдателей
+        '''
+        if observed not in self._documents:
+            if not observed:
+                self._documents[observed] = self._event.dict()
+            elif isinstance(self._event, ObservableEvent):
+                self._documents[observed] = self._event.observer_dict()
+            else:
+                self._documents[observed] = None
+        return self._documents[observed]
+
+    def payload(self, observed: bool, codec: Codec = JSON) -> str | bytes:
+        '''
+        Вариант события, закодированный в формате `codec`.
+        Кодируется только при первом запросе в этом формате
+        '''
+        payload = self._payloads.get((codec, observed))
+        if payload is None:
+            start = time.perf_counter()
+            payload = self._payloads[codec, observed] = codec.encode(self.document(observed))
+            encode_seconds.observe(time.perf_counter() - start, codec.subprotocol)
+        return payload
+
+    def variant_for(self, player_id: str) -> bool | None:
+        '''
+        Какой вариант события получает игрок: `False` - полное событие, `True` - событие с точки
+        зрения наблюдателя, `None` - никакой
+        '''
+        if player_id == self.from_player:
+            return None
+        if self.targets == EventTargets.Server:
+            # Событие предназначалось только для сервера
+            observed = True
+        else:
+            observed = self.targets != EventTargets.All and player_id not in self.targets
+        if observed and self.document(observed=True) is None:
+            return None
+        return observed
+
+    def payload_for(self, player_id: str, codec: Codec = JSON) -> str | bytes | None:
+        '''
+        Событие, которое получает игрок, в формате `codec`, или `None`, если он его не получает
+        '''
+        observed = self.variant_for(player_id)
+        if observed is None:
+            return None
+        return self.payload(observed, codec)
+
+
+class BroadcastBatch:
+    '''
+    Несколько рассылок, которые клиенты, принимающие пакеты, получают одним сообщением `EventBatch`.
+
+    В пакет попадают только те события, которые получает клиент, и в том варианте, в котором он
+    их получает. Пакеты с одинаковым набором вариантов кодируются один раз
+    '''
+
+    __slots__ = ('broadcasts', '_payloads')
+
+    def __init__(self, broadcasts: list[Broadcast]) -> None:
+        self.broadcasts = broadcasts
+        self._payloads: dict[tuple[Codec, tuple[bool | None, ...]], str | bytes] = {}
+
+    @property
+    def seq(self) -> int | None:
+        '''Порядковый номер последнего события пакета'''
+        return self.broadcasts[-1].seq
+
+    @staticmethod
+    def from_message(message: dict) -> 'BroadcastBatch':
+        return BroadcastBatch([Broadcast.from_message(item) for item in message['batch']])
+
+    def to_message(self) -> dict:
+        return {'batch': [broadcast.to_message() for broadcast in self.broadcasts]}
+
+    def payload_for(self, player_id: str, codec: Codec = JSON) -> str | bytes | None:
+        '''
+        Пакет событий, которые получает игрок, в формате `codec`,
+        или `None`, если он не получает ни одного из них
+        '''
+        variants = tuple(broadcast.variant_for(player_id) for broadcast in self.broadcasts)
+        payload = self._payloads.get((codec, variants))
+        if payload is None:
+            start = time.perf_counter()
+            events = [broadcast.document(observed)
+                      for broadcast, observed in zip(self.broadcasts, variants)
+                      if observed is not None]
+            if len(events) == 0:
+                return None
+            payload = self._payloads[codec, variants] = codec.encode({
+                'type': 'EventBatch',
+                'targets': EventTargets.All,
+                'seq': self.seq,
+                'events': events,
+            })
+            encode_seconds.observe(time.perf_counter() - start, codec.subprotocol)
+        return payload
+
+
+def broadcast_from_message(message: dict) -> Broadcast | BroadcastBatch:
+    '''Восстанавливает рассылку или пакет рассылок, переданные из другого процесса'''
+    if 'batch' in message:
+        return BroadcastBatch.from_message(message)
+    return Broadcast.from_message(message)
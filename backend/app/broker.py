@@ -0,0 +1,438 @@
+'''
+Брокер сообщений между процессами сервера.
+
+Через брокер менеджеры соединений (`GameManager`) разных процессов uvicorn договариваются, кто из них
+владеет состоянием игры, пересылают владельцу события игроков и получают от него рассылки событий
+для своих вебсокетов.
+
+- `LocalBroker` - для сервера из одного процесса, всё происходит в памяти
+- `IPCBroker` - для нескольких процессов на одной машине. Процессы соединяются с посредником
+  (`BrokerHub`) через UNIX-сокет. Посредника поднимает первый запустившийся процесс, либо его можно
+  запустить отдельно: `python -m app.broker /tmp/overboard.sock`
+
+Брокер выбирается переменной окружения `OVERBOARD_BROKER`: `local` (по умолчанию)
+или `unix:<путь к сокету>`
+'''
+
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import sys
+from itertools import count
+from typing import Awaitable, Callable
+
+from .broadcast import Broadcast, BroadcastBatch, broadcast_from_message
+from .codecs import encode_event
+
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[Broadcast | BroadcastBatch], Awaitable[None]]
+'''Получает рассылки игры, на которую подписан'''
+
+Server = Callable[[dict], Awaitable[dict | None]]
+'''
+Отвечает на запросы к владельцу игры. Возвращает `None`, если процесс уже не владеет игрой.
+И запрос, и ответ должны кодироваться в JSON. Ошибка передаётся ответом
+`{'error': <описание>, 'status': <HTTP-код>}`
+'''
+
+
+class Broker:
+    '''Интерфейс брокера сообщений между процессами сервера'''
+
+    async def start(self) -> None:
+        '''Подключается к остальным процессам. Вызывается при запуске приложения'''
+
+    async def stop(self) -> None:
+        '''Отключается от остальных процессов. Вызывается при остановке приложения'''
+
+    async def subscribe(self, game_id: int, handler: Handler) -> None:
+        '''Начинает передавать `handler` все рассылки игры из всех процессов'''
+        raise NotImplementedError()
+
+    async def unsubscribe(self, game_id: int, handler: Handler) -> None:
+        raise NotImplementedError()
+
+    async def publish(self, game_id: int, broadcast: Broadcast | BroadcastBatch) -> None:
+        '''Передаёт рассылку всем подписчикам игры во всех процессах, в том числе в этом'''
+        raise NotImplementedError()
+
+    async def claim(self, game_id: int, server: Server, on_lost: Callable[[], None]) -> bool:
+        '''
+        Пытается сделать этот процесс владельцем игры.
+
+        @server: Отвечает на запросы к владельцу игры (см. `request`)
+        @on_lost: Вызывается, если процесс потерял владение игрой не по своей воле
+
+        :returns: Владеет ли теперь процесс игрой. Повторный вызов с тем же `server` ничего не меняет
+        '''
+        raise NotImplementedError()
+
+    async def release(self, game_id: int, server: Server) -> None:
+        '''Отказывается от владения игрой'''
+        raise NotImplementedError()
+
+    async def request(self, game_id: int, message: dict) -> dict | None:
+        '''
+        Передаёт запрос владельцу игры и ждёт ответа.
+
+        :returns: Ответ владельца или `None`, если у игры нет владельца
+
+        :raises TimeoutError: Владелец в другом процессе не ответил вовремя
+        '''
+        raise NotImplementedError()
+
+
+class LocalBroker(Broker):
+    '''Брокер для сервера из одного процесса'''
+
+    def __init__(self) -> None:
+        self._handlers: dict[int, list[Handler]] = {}
+        self._owners: dict[int, Server] = {}
+
+    async def subscribe(self, game_id: int, handler: Handler) -> None:
+        self._handlers.setdefault(game_id, []).append(handler)
+
+    async def unsubscribe(self, game_id: int, handler: Handler) -> None:
+        handlers = self._handlers.get(game_id, [])
+        if handler in handlers:
+            handlers.remove(handler)
+        if len(handlers) == 0:
+            self._handlers.pop(game_id, None)
+
+    async def publish(self, game_id: int, broadcast: Broadcast | BroadcastBatch) -> None:
+        for handler in self._handlers.get(game_id, ()):
+            await handler(broadcast)
+
+    async def claim(self, game_id: int, server: Server, on_lost: Callable[[], None]) -> bool:
+        owner = self._owners.setdefault(game_id, server)
+        return owner == server
+
+    async def release(self, game_id: int, server: Server) -> None:
+        if self._owners.get(game_id) == server:
+            del self._owners[game_id]
+
+    async def request(self, game_id: int, message: dict) -> dict | None:
+        server = self._owners.get(game_id)
+        if server is None:
+            return None
+        return await server(message)
+
+
+def _frame(message: dict) -> bytes:
+    '''Сообщения между процессами - JSON, по одному в строке'''
+    return encode_event(message).encode() + b'\n'
+
+
+class BrokerHub:
+    '''
+    Посредник, через которого общаются процессы с `IPCBroker`.
+
+    Запоминает, какие процессы подписаны на какую игру и кто ей владеет, пересылает рассылки
+    подписчикам, а запросы - владельцу. Владельцем игры становится первый попросивший,
+    при отключении процесса все его игры освобождаются
+    '''
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._server: asyncio.AbstractServer | None = None
+        self._subscribers: dict[int, set[asyncio.StreamWriter]] = {}
+        self._owners: dict[int, asyncio.StreamWriter] = {}
+        self._requests: dict[int, tuple[asyncio.StreamWriter, int, asyncio.StreamWriter]] = {}
+        '''Идентификатор пересланного запроса -> (кто спросил, его идентификатор, кого спросили)'''
+        self._request_ids = count()
+        self._peers: set[asyncio.StreamWriter] = set()
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_unix_server(self._connection, path=self.path)
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            for peer in list(self._peers):
+                peer.close()
+            await self._server.wait_closed()
+
+    async def _connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._peers.add(writer)
+        try:
+            while line := await reader.readline():
+                self._dispatch(writer, line)
+        except ConnectionError:
+            pass
+        finally:
+            self._peers.discard(writer)
+            self._disconnect(writer)
+            writer.close()
+
+    def _dispatch(self, peer: asyncio.StreamWriter, line: bytes) -> None:
+        message = json.loads(line)
+        op = message['op']
+        game_id = message.get('game_id')
+
+        if op == 'publish':
+            # Рассылку пересылаем как есть, не перекодируя
+            for subscriber in self._subscribers.get(game_id, ()):
+                if subscriber is not peer:
+                    subscriber.write(line)
+        elif op == 'subscribe':
+            self._subscribers.setdefault(game_id, set()).add(peer)
+        elif op == 'unsubscribe':
+            self._subscribers.get(game_id, set()).discard(peer)
+        elif op == 'claim':
+            owner = self._owners.setdefault(game_id, peer)
+            peer.write(_frame({'op': 'claimed', 'id': message['id'], 'ok': owner is peer}))
+        elif op == 'release':
+            if self._owners.get(game_id) is peer:
+                del self._owners[game_id]
+        elif op == 'request':
+            owner = self._owners.get(game_id)
+            if owner is None:
+                peer.write(_frame({'op': 'reply', 'id': message['id'], 'reply': None}))
+                return
+            request_id = next(self._request_ids)
+            self._requests[request_id] = (peer, message['id'], owner)
+            owner.write(_frame({'op': 'request', 'id': request_id,
+                                'game_id': game_id, 'message': message['message']}))
+        elif op == 'reply':
+            if message['id'] in self._requests:
+                peer, request_id, _ = self._requests.pop(message['id'])
+                peer.write(_frame({'op': 'reply', 'id': request_id, 'reply': message['reply']}))
+
+    def _disconnect(self, peer: asyncio.StreamWriter) -> None:
+        for subscribers in self._subscribers.values():
+            subscribers.discard(peer)
+        for game_id in [game_id for game_id, owner in self._owners.items() if owner is peer]:
+            del self._owners[game_id]
+        for request_id, (requester, original_id, owner) in list(self._requests.items()):
+            if requester is peer:
+                del self._requests[request_id]
+            elif owner is peer:
+                # Отключившийся владелец уже не ответит, спросивший попробует завладеть игрой сам
+                del self._requests[request_id]
+                requester.write(_frame({'op': 'reply', 'id': original_id, 'reply': None}))
+
+
+class IPCBroker(Broker):
+    '''
+    Брокер для нескольких процессов на одной машине, общающихся через посредника `BrokerHub`
+    на UNIX-сокете.
+
+    Если посредник не запущен, его поднимает у себя первый процесс, захвативший файл блокировки
+    рядом с сокетом. Если посредник отключился, процесс переподключается (при необходимости поднимая
+    посредника сам) и заново подписывается на свои игры и заявляет права на те, которыми владел
+    '''
+
+    reconnect_delay: float = 0.2
+    '''Сколько секунд ждать между попытками подключиться к посреднику'''
+
+    request_timeout: float = 10.0
+    '''Сколько секунд ждать ответа посредника или владельца игры'''
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._handlers: dict[int, list[Handler]] = {}
+        self._owned: dict[int, tuple[Server, Callable[[], None]]] = {}
+        self._pending: dict[int, asyncio.Future] = {}
+        '''Запросы посреднику, ждущие ответа'''
+        self._answers: set[asyncio.Task] = set()
+        '''Ответы на запросы других процессов, которые ещё готовятся'''
+        self._ids = count()
+
+        self._hub: BrokerHub | None = None
+        self._lock_fd: int | None = None
+        self._writer: asyncio.StreamWriter | None = None
+        self._reader_task: asyncio.Task | None = None
+        self._connected = asyncio.Event()
+        self._stopping = False
+
+    async def start(self) -> None:
+        self._stopping = False
+        await self._connect()
+
+    async def stop(self) -> None:
+        self._stopping = True
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+        if self._hub is not None:
+            await self._hub.stop()
+            self._hub = None
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def _try_lock(self) -> bool:
+        '''Захватывает право поднять посредника. Блокировка снимается, когда процесс завершается'''
+        if self._lock_fd is not None:
+            return True
+        fd = os.open(self.path + '.lock', os.O_CREAT | os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+
+    async def _connect(self) -> None:
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if self._hub is None and self._try_lock():
+                    self._hub = BrokerHub(self.path)
+                    await self._hub.start()
+                    continue
+                await asyncio.sleep(self.reconnect_delay)
+
+        self._writer = writer
+        self._reader_task = asyncio.create_task(self._read(reader))
+        for game_id in self._handlers:
+            writer.write(_frame({'op': 'subscribe', 'game_id': game_id}))
+        self._connected.set()
+
+        for game_id, (server, on_lost) in list(self._owned.items()):
+            del self._owned[game_id]
+            if not await self.claim(game_id, server, on_lost):
+                on_lost()
+
+    async def _send(self, message: dict) -> None:
+        await self._connected.wait()
+        self._writer.write(_frame(message))
+
+    async def _ask(self, message: dict):
+        '''
+        Отправляет сообщение посреднику и ждёт ответа на него
+
+        :raises TimeoutError: Ответа нет дольше `request_timeout` секунд
+        '''
+        message['id'] = next(self._ids)
+        answered = asyncio.get_running_loop().create_future()
+        self._pending[message['id']] = answered
+        try:
+            return await asyncio.wait_for(self._send_and_wait(message, answered),
+                                          self.request_timeout)
+        finally:
+            self._pending.pop(message['id'], None)
+
+    async def _send_and_wait(self, message: dict, answered: asyncio.Future):
+        await self._send(message)
+        return await answered
+
+    async def _read(self, reader: asyncio.StreamReader) -> None:
+        try:
+            while line := await reader.readline():
+                message = json.loads(line)
+                op = message['op']
+                if op == 'publish':
+                    broadcast = broadcast_from_message(message['broadcast'])
+                    for handler in list(self._handlers.get(message['game_id'], ())):
+                        await handler(broadcast)
+                elif op == 'request':
+                    answer = asyncio.create_task(self._answer(message))
+                    self._answers.add(answer)
+                    answer.add_done_callback(self._answers.discard)
+                elif op == 'reply':
+                    self._resolve(message['id'], message['reply'])
+                elif op == 'claimed':
+                    self._resolve(message['id'], message['ok'])
+        except ConnectionError:
+            pass
+        finally:
+            self._connected.clear()
+            # Ответов на эти запросы уже не будет
+            pending, self._pending = self._pending, {}
+            for answered in pending.values():
+                if not answered.done():
+                    answered.set_result(None)
+            if not self._stopping:
+                asyncio.create_task(self._connect())
+
+    def _resolve(self, request_id: int, result) -> None:
+        answered = self._pending.pop(request_id, None)
+        if answered is not None and not answered.done():
+            answered.set_result(result)
+
+    async def _answer(self, message: dict) -> None:
+        # Спросивший ждёт ответа, поэтому ответ отправляется, даже если владелец упал
+        reply = None
+        try:
+            owned = self._owned.get(message['game_id'])
+            if owned is not None:
+                reply = await owned[0](message['message'])
+        except Exception as e:
+            logger.exception('Could not answer a request to game %s', message['game_id'])
+            reply = {'error': f'{type(e).__name__}: {e}', 'status': 500}
+        await self._send({'op': 'reply', 'id': message['id'], 'reply': reply})
+
+    async def subscribe(self, game_id: int, handler: Handler) -> None:
+        handlers = self._handlers.setdefault(game_id, [])
+        handlers.append(handler)
+        if len(handlers) == 1:
+            await self._send({'op': 'subscribe', 'game_id': game_id})
+
+    async def unsubscribe(self, game_id: int, handler: Handler) -> None:
+        handlers = self._handlers.get(game_id, [])
+        if handler in handlers:
+            handlers.remove(handler)
+        if len(handlers) == 0 and self._handlers.pop(game_id, None) is not None:
+            await self._send({'op': 'unsubscribe', 'game_id': game_id})
+
+    async def publish(self, game_id: int, broadcast: Broadcast | BroadcastBatch) -> None:
+        for handler in list(self._handlers.get(game_id, ())):
+            await handler(broadcast)
+        await self._send({'op': 'publish', 'game_id': game_id, 'broadcast': broadcast.to_message()})
+
+    async def claim(self, game_id: int, server: Server, on_lost: Callable[[], None]) -> bool:
+        owned = self._owned.get(game_id)
+        if owned is not None:
+            return owned[0] == server
+        if not await self._ask({'op': 'claim', 'game_id': game_id}):
+            return False
+        self._owned[game_id] = (server, on_lost)
+        return True
+
+    async def release(self, game_id: int, server: Server) -> None:
+        owned = self._owned.get(game_id)
+        if owned is not None and owned[0] == server:
+            del self._owned[game_id]
+            await self._send({'op': 'release', 'game_id': game_id})
+
+    async def request(self, game_id: int, message: dict) -> dict | None:
+        owned = self._owned.get(game_id)
+        if owned is not None:
+            return await owned[0](message)
+        return await self._ask({'op': 'request', 'game_id': game_id, 'message': message})
+
+
+def create_broker(url: str) -> Broker:
+    '''
+    Создаёт брокер по его адресу: `local` или `unix:<путь к сокету>`
+
+    :raises ValueError: Неизвестный вид брокера
+    '''
+    if url == 'local':
+        return LocalBroker()
+    if url.startswith('unix:'):
+        return IPCBroker(url.removeprefix('unix:'))
+    raise ValueError(f'Unknown broker {url}')
+
+
+broker: Broker = create_broker(os.environ.get('OVERBOARD_BROKER', 'local'))
+'''Брокер этого процесса'''
+
+
+async def _serve_hub(path: str) -> None:
+    hub = BrokerHub(path)
+    await hub.start()
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    asyncio.run(_serve_hub(sys.argv[1]))
@@ -0,0 +1,177 @@
+'''
+Форматы, в которых события передаются по вебсокету.
+
+Клиент выбирает формат подпротоколом вебсокета (заголовок `Sec-WebSocket-Protocol`), перечисляя
+подходящие ему в порядке предпочтения. Сервер выбирает первый из них, который поддерживает.
+Если клиент не передал ни одного известного подпротокола, события передаются в JSON:
+
+- `overboard.json` - JSON в текстовых сообщениях
+- `overboard.msgpack` - MessagePack в бинарных сообщениях
+- `overboard.msgpack.keys` - MessagePack, в котором названия полей моделей заменены на их номера
+в таблице `wire_keys` (её можно получить по `/schemas/wirekeys`). Названия, которых нет в таблице,
+передаются как есть
+
+Для форматов MessagePack нужен пакет `msgpack`. Если он не установлен, сервер их не предлагает
+'''
+
+import json
+from typing import Any
+
+from fastapi import WebSocket
+from pydantic import BaseModel
+from pydantic.json import pydantic_encoder
+from pydantic.schema import schema
+
+from .models import Game, GameEvent
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def encode_event(event: dict) -> str:
+    '''Кодирует событие в JSON так же, как `WebSocket.send_json`'''
+    return json.dumps(event, separators=(',', ':'), ensure_ascii=False, default=pydantic_encoder)
+
+
+def _models(base: type[BaseModel]) -> list[type[BaseModel]]:
+    '''Модель и все её наследники'''
+    models = [base]
+    for subclass in base.__subclasses__():
+        models.extend(_models(subclass))
+    return models
+
+
+def _collect_wire_keys() -> list[str]:
+    models = {}
+    for model in [Game, *_models(GameEvent)]:
+        # Модели для разбора событий (`PlayerEvent.from_dict`) называются так же, как события,
+        # и идут после них
+        models.setdefault(model.__name__, model)
+    definitions = schema([models[name] for name in sorted(models)], by_alias=False)['definitions']
+    keys = set()
+    for definition in definitions.values():
+        keys.update(definition.get('properties', {}))
+    return sorted(keys)
+
+
+wire_keys: list[str] = _collect_wire_keys()
+'''
+Названия полей всех моделей событий и игры. В формате `overboard.msgpack.keys` вместо
+названия передаётся его номер в этом списке. Список зависит только от моделей
+'''
+_key_numbers: dict[str, int] = {key: number for number, key in enumerate(wire_keys)}
+
+
+def _intern(value: Any) -> Any:
+    '''Заменяет известные названия полей на их номера'''
+    if isinstance(value, dict):
+        # Ключи, которые не являются строками, приводятся к строкам, как в JSON,
+        # иначе их нельзя было бы отличить от номеров
+        return {_key_numbers.get(key, key) if isinstance(key, str) else str(key): _intern(item)
+                for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_intern(item) for item in value]
+    return value
+
+
+def _extern(value: Any) -> Any:
+    '''Заменяет номера полей обратно на их названия'''
+    if isinstance(value, dict):
+        return {wire_keys[key] if isinstance(key, int) and 0 <= key < len(wire_keys) else key:
+                _extern(item)
+                for key, item in value.items()}
+    if isinstance(value, list):
+        return [_extern(item) for item in value]
+    return value
+
+
+class Codec:
+    '''Формат сообщений вебсокета'''
+
+    subprotocol: str
+    '''Подпротокол вебсокета, которым клиент выбирает этот формат'''
+
+    def encode(self, event: dict) -> str | bytes:
+        '''Кодирует событие. Строки отправляются текстовыми сообщениями, байты - бинарными'''
+        raise NotImplementedError()
+
+    def decode(self, message: str | bytes) -> Any:
+        '''
+        Декодирует сообщение, закодированное `encode`
+
+        :raises TypeError: Сообщение не в этом формате
+        '''
+        raise NotImplementedError()
+
+    async def receive(self, websocket: WebSocket) -> Any:
+        '''
+        Получает и декодирует сообщение от клиента
+
+        :raises WebSocketDisconnect: Клиент отключился
+        '''
+        raise NotImplementedError()
+
+
+class JsonCodec(Codec):
+    subprotocol = 'overboard.json'
+
+    def encode(self, event: dict) -> str:
+        return encode_event(event)
+
+    def decode(self, message: str | bytes) -> Any:
+        return json.loads(message)
+
+    async def receive(self, websocket: WebSocket) -> Any:
+        return await websocket.receive_json()
+
+
+class MsgpackCodec(Codec):
+    subprotocol = 'overboard.msgpack'
+
+    def __init__(self, intern_keys: bool = False) -> None:
+        '''@intern_keys: Заменять названия полей на их номера в `wire_keys`'''
+        self.intern_keys = intern_keys
+        if intern_keys:
+            self.subprotocol = 'overboard.msgpack.keys'
+
+    def encode(self, event: dict) -> bytes:
+        if self.intern_keys:
+            event = _intern(event)
+        return msgpack.packb(event, default=pydantic_encoder)
+
+    def decode(self, message: str | bytes) -> Any:
+        try:
+            message = msgpack.unpackb(message, strict_map_key=False)
+        except ValueError as e:
+            raise TypeError(f'Message is not valid MessagePack: {e}')
+        if self.intern_keys:
+            message = _extern(message)
+        return message
+
+    async def receive(self, websocket: WebSocket) -> Any:
+        return self.decode(await websocket.receive_bytes())
+
+
+JSON = JsonCodec()
+'''Формат по умолчанию'''
+
+codecs: dict[str, Codec] = {JSON.subprotocol: JSON}
+'''Поддерживаемые форматы по подпротоколам'''
+if msgpack is not None:
+    for codec in (MsgpackCodec(), MsgpackCodec(intern_keys=True)):
+        codecs[codec.subprotocol] = codec
+
+
+def negotiate(subprotocols: list[str]) -> tuple[Codec, str | None]:
+    '''
+    Выбирает формат из подпротоколов, предложенных клиентом.
+
+    :returns: Формат и подпротокол, который нужно вернуть клиенту. Если клиент не предложил
+    ни одного поддерживаемого подпротокола - JSON и `None`
+    '''
+    for subprotocol in subprotocols:
+        if subprotocol in codecs:
+            return codecs[subprotocol], subprotocol
+    return JSON, None
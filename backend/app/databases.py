@@ -1,12 +1,65 @@
 '''Простой модуль для хранения и инициализации подключений к базам данных'''
 
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import time
+from typing import Callable, TypeVar
+
 import pymongo
+from pymongo import ASCENDING
 from pymongo.database import Database
 
+from .metrics import db_seconds
+
 # Ну я подразумеваю, что во время исполнения программы не нужно будет переподключаться по
 # другому url
 
 MONGO_DATABASE_URL = 'localhost'
 
 mongo_client = pymongo.MongoClient(MONGO_DATABASE_URL)
-mongo_db: Database = mongo_client['overboard']
\ No newline at end of file
+mongo_db: Database = mongo_client['overboard']
+
+
+DB_THREADS = 16
+'''
+Сколько запросов к базе данных может выполняться одновременно.
+Остальные запросы ждут своей очереди, не блокируя цикл событий
+'''
+
+db_executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix='mongo')
+'''Пул потоков, в котором выполняются блокирующие запросы pymongo'''
+
+
+T = TypeVar('T')
+
+
+async def run_db(func: Callable[..., T], *args, site: str, **kwargs) -> T:
+    '''
+    Выполняет блокирующий запрос к базе данных в `db_executor`, не останавливая цикл событий.
+    Время запроса вместе с ожиданием свободного потока попадает в метрику `db_seconds`
+
+    @site: Место вызова, которым запрос помечается в метриках
+
+    ### Пример
+    `document = await run_db(mongo_db['games'].find_one, {'id': game_id}, site='game_document')`
+    '''
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    try:
+        return await loop.run_in_executor(db_executor, partial(func, *args, **kwargs))
+    finally:
+        db_seconds.observe(time.perf_counter() - start, site)
+
+
+def ensure_indexes() -> None:
+    '''
+    Создаёт индексы коллекции игр, если их ещё нет. Вызывается при запуске приложения.
+    Индексы журнала игр создаёт `eventlog.ensure_indexes`
+
+    #### Блокирующая, в цикле событий её нужно вызывать через `run_db`
+    '''
+    # Все запросы к играм ищут их по id, а уникальность id проверяет сама база данных
+    mongo_db['games'].create_index([('id', ASCENDING)], unique=True)
+    # Заброшенные игры удаляются сами, когда наступает их `expire_at`
+    mongo_db['games'].create_index('expire_at', expireAfterSeconds=0)
@@ -0,0 +1,165 @@
+'''
+Журнал игровых событий.
+
+Каждое применённое к игре событие игрока и каждое ответное событие сервера дописывается в
+коллекцию `game_events` со своим порядковым номером `seq`. Запись события игрока также хранит
+запрос, которым его обработка изменила документ игры. Раз в несколько событий в коллекцию
+`game_snapshots` записывается полное состояние игры.
+
+Состояние игры восстанавливается из последнего снимка (или документа игры, если он новее)
+и изменений из журнала после него.
+
+Заброшенные игры удаляются из базы данных сами: у документа игры есть поле `expire_at`,
+которое сдвигается при каждом изменении игры, а записи журнала и снимки удаляются через
+`GAME_TTL` после записи.
+
+#### Все функции модуля блокирующие, в цикле событий их нужно вызывать через `run_db`
+'''
+
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError
+
+from .databases import mongo_db as db
+from .models import Game, GameEvent, GamePhase
+from .models.tracking import apply_update
+
+
+EVENTS = 'game_events'
+SNAPSHOTS = 'game_snapshots'
+
+DUPLICATE_KEY = 11000
+'''Код ошибки MongoDB при нарушении уникального индекса'''
+
+GAME_TTL = timedelta(days=30)
+'''Через сколько после последнего изменения удаляется игра, её журнал и снимки'''
+
+LOBBY_TTL = timedelta(days=1)
+'''Через сколько после последнего изменения удаляется игра, которая так и не началась'''
+
+
+def ensure_indexes() -> None:
+    '''Создаёт индексы журнала, если их ещё нет. Вызывается при запуске приложения'''
+    db[EVENTS].create_index([('game_id', ASCENDING), ('seq', ASCENDING)], unique=True)
+    db[SNAPSHOTS].create_index([('game_id', ASCENDING), ('seq', DESCENDING)])
+    for collection in (EVENTS, SNAPSHOTS):
+        db[collection].create_index(
+            'created_at', expireAfterSeconds=int(GAME_TTL.total_seconds()))
+
+
+def expiry(game: Game) -> datetime:
+    '''Когда игру можно будет удалить, если она больше не изменится'''
+    ttl = LOBBY_TTL if game.phase == GamePhase.Lobby else GAME_TTL
+    return datetime.now(timezone.utc) + ttl
+
+
+def forget(game_id: int, before: datetime) -> None:
+    '''
+    Удаляет записи журнала и снимки игры, записанные раньше `before`. Вызывается при создании
+    игры, чтобы она не унаследовала журнал удалённой игры с тем же идентификатором
+    '''
+    for collection in (EVENTS, SNAPSHOTS):
+        db[collection].delete_many({'game_id': game_id, 'created_at': {'$lt': before}})
+
+
+def _pack(update: dict[str, dict]) -> list[list]:
+    '''
+    Переводит запрос `update_one` в список `[оператор, путь, аргумент]`. Ключи с `$` и точками
+    нельзя надёжно хранить в документах MongoDB
+    '''
+    packed = []
+    for op, changes in update.items():
+        for path, arg in changes.items():
+            packed.append([op, path, arg['$each'] if op == '$push' else arg])
+    return packed
+
+
+def _unpack(packed: list[list]) -> dict[str, dict]:
+    update: dict[str, dict] = {}
+    for op, path, arg in packed:
+        update.setdefault(op, {})[path] = {'$each': arg} if op == '$push' else arg
+    return update
+
+
+def record(game: Game, events: list[GameEvent]) -> tuple[list[dict], dict]:
+    '''
+    Назначает событиям следующие порядковые номера игры и собирает изменения игры.
+
+    @game: Игра, к которой только что были применены события. Её изменения должны отслеживаться
+    @events: Событие игрока и ответные события сервера в порядке отправки
+
+    :returns: Записи журнала для `append` и запрос `update_one` для документа игры,
+    который также сдвигает `expire_at`
+    '''
+    for event in events:
+        game.seq += 1
+        event.seq = game.seq
+    changes = game.collect_changes()
+
+    entries = []
+    created_at = datetime.now(timezone.utc)
+    for event in events:
+        entries.append({'game_id': game.id, 'seq': event.seq, 'event': event.dict(),
+                        'created_at': created_at})
+    if len(entries) > 0:
+        entries[0]['changes'] = _pack(changes)
+    # Пока в игре что-то происходит, она не удаляется
+    changes.setdefault('$set', {})['expire_at'] = expiry(game)
+    return entries, changes
+
+
+def append(entries: list[dict]) -> None:
+    '''
+    Дописывает записи в журнал. Записи, которые уже есть в журнале (например, при повторной
+    попытке после сбоя), пропускаются
+    '''
+    if len(entries) == 0:
+        return
+    try:
+        db[EVENTS].insert_many(entries, ordered=False)
+    except BulkWriteError as e:
+        if any(error['code'] != DUPLICATE_KEY for error in e.details['writeErrors']):
+            raise
+
+
+def save_snapshot(document: dict) -> None:
+    '''Сохраняет полное состояние игры, полученное через `Game.dict()`'''
+    db[SNAPSHOTS].insert_one({'game_id': document['id'], 'seq': document['seq'], 'game': document,
+                              'created_at': datetime.now(timezone.utc)})
+
+
+def read(game_id: int, after_seq: int = 0) -> list[dict]:
+    '''Записи журнала игры с порядковым номером больше `after_seq`'''
+    return list(db[EVENTS].find(
+        {'game_id': game_id, 'seq': {'$gt': after_seq}}, {'_id': 0}).sort('seq', ASCENDING))
+
+
+def load_game(game_id: int) -> Game | None:
+    '''
+    Восстанавливает игру из последнего снимка или документа игры и журнала после него.
+
+    :returns: Игру, изменения которой уже отслеживаются, или `None`, если игры с таким
+    идентификатором нет. Если документ игры отстаёт от журнала, первое же сохранение
+    изменений перезапишет его целиком
+    '''
+    document = db['games'].find_one({'id': game_id})
+    if document is None:
+        return None
+    stored_seq = document.get('seq', 0)
+
+    snapshot = db[SNAPSHOTS].find_one({'game_id': game_id}, sort=[('seq', DESCENDING)])
+    if snapshot is not None and snapshot['seq'] > stored_seq:
+        document = snapshot['game']
+
+    for entry in read(game_id, document.get('seq', 0)):
+        if entry.get('changes'):
+            apply_update(document, _unpack(entry['changes']))
+        document['seq'] = entry['seq']
+
+    game = Game(**document)
+    changes = game.track_changes()
+    if game.seq != stored_seq:
+        for name in game.__fields__:
+            changes.set(name)
+    return game
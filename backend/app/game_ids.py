@@ -0,0 +1,107 @@
+'''
+Выдача свободных идентификаторов игр.
+
+Идентификаторы - пятизначные числа. Вместо того чтобы угадывать случайное число и проверять его
+в базе данных, идентификаторы берутся по порядку из общего счётчика в коллекции `counters`
+и перемешиваются перестановкой Фейстеля, поэтому выглядят случайными, но за один проход
+по счётчику не повторяются. Каждый процесс забирает из счётчика сразу `lease_size` номеров,
+так что к базе данных обращается только раз в `lease_size` выдач.
+
+За один проход по счётчику перестановка не повторяет идентификаторов. Когда счётчик проходит все
+идентификаторы, он начинает сначала, и идентификаторы удалённых к тому времени игр выдаются
+повторно. Поэтому вместе с блоком номеров процесс одним запросом проверяет, какие из его
+идентификаторов ещё заняты играми, и пропускает их. Идентификатор не резервируется: если две
+игры создадут с одним идентификатором, `/create` отклонит вторую по уникальному индексу
+'''
+
+import asyncio
+import random
+from collections import deque
+from hashlib import blake2b
+
+from pymongo import ReturnDocument
+
+from .databases import mongo_db as db, run_db
+
+
+ID_MIN = 10000
+ID_MAX = 99999
+SPACE = ID_MAX - ID_MIN + 1
+
+_HALF_BITS = 9
+'''Перестановка работает над 18-битными числами из двух половин по 9 бит, их больше, чем `SPACE`'''
+_HALF_MASK = (1 << _HALF_BITS) - 1
+_ROUNDS = 4
+
+
+def _round(key: int, round: int, half: int) -> int:
+    digest = blake2b(f'{key}:{round}:{half}'.encode(), digest_size=4).digest()
+    return int.from_bytes(digest, 'little') & _HALF_MASK
+
+
+def permute(index: int, key: int) -> int:
+    '''
+    Взаимно однозначно переставляет номера от 0 до `SPACE - 1`.
+
+    @key: Ключ перестановки. При разных ключах номера перемешиваются по-разному
+    '''
+    # Сеть Фейстеля переставляет все 18-битные числа; если результат вышел за `SPACE`,
+    # переставляем его ещё раз, пока не попадём в диапазон
+    while True:
+        left, right = index >> _HALF_BITS, index & _HALF_MASK
+        for round in range(_ROUNDS):
+            left, right = right, left ^ _round(key, round, right)
+        index = (left << _HALF_BITS) | right
+        if index < SPACE:
+            return index
+
+
+class GameIdAllocator:
+    '''Выдаёт свободные идентификаторы, которые не повторяются за один проход по счётчику'''
+
+    lease_size: int = 32
+    '''Сколько номеров процесс забирает из общего счётчика за раз'''
+
+    def __init__(self, counter: str = 'game_ids') -> None:
+        '''@counter: Идентификатор документа счётчика в коллекции `counters`'''
+        self.counter = counter
+        self._free: deque[int] = deque()
+        '''Свободные идентификаторы из последнего блока номеров'''
+        self._lock = asyncio.Lock()
+
+    def _lease(self) -> dict:
+        '''Забирает следующий блок номеров из счётчика'''
+        return db['counters'].find_one_and_update(
+            {'_id': self.counter},
+            {'$inc': {'next': self.lease_size},
+             '$setOnInsert': {'key': random.getrandbits(63)}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+
+    def _in_use(self, ids: list[int]) -> set[int]:
+        '''Идентификаторы из `ids`, которые принадлежат существующим играм'''
+        return {game['id'] for game in db['games'].find({'id': {'$in': ids}}, {'_id': 0, 'id': 1})}
+
+    async def allocate(self) -> int:
+        '''
+        Выдаёт следующий свободный идентификатор. К базе данных обращается только за новым
+        блоком номеров
+
+        :raises RuntimeError: Все идентификаторы заняты играми
+        '''
+        async with self._lock:
+            leased = 0
+            while len(self._free) == 0:
+                if leased > SPACE:
+                    raise RuntimeError('All game ids are in use')
+                leased += self.lease_size
+                counter = await run_db(self._lease, site='game_ids.lease')
+                numbers = range(counter['next'] - self.lease_size, counter['next'])
+                ids = [ID_MIN + permute(number % SPACE, counter['key']) for number in numbers]
+                in_use = await run_db(self._in_use, ids, site='game_ids.in_use')
+                self._free.extend(id for id in ids if id not in in_use)
+            return self._free.popleft()
+
+
+game_ids = GameIdAllocator()
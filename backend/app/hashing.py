@@ -1,14 +1,45 @@
+import hmac
+import os
+from functools import lru_cache
 from hashlib import sha256
+from typing import Callable
 
 def mock_hashfunc(string: str) -> str:
     salt = 'Very salty'
     return sha256((string + salt).encode('utf-8')).hexdigest()
 
 
+def hmac_hashfunc(key: bytes) -> Callable[[str], str]:
+    '''Хэш-функция HMAC-SHA256 с секретным ключом `key`'''
+    def hashfunc(string: str) -> str:
+        return hmac.new(key, string.encode('utf-8'), sha256).hexdigest()
+    return hashfunc
+
+
+HASH_CACHE_SIZE = 4096
+'''Сколько последних хэшей хранится в памяти'''
+
+hash_function: Callable[[str], str] = mock_hashfunc
+'''
+Хэш-функция токенов. Если задана переменная окружения `OVERBOARD_TOKEN_KEY`, используется
+HMAC с этим ключом.
+#### При смене функции меняются идентификаторы всех игроков
+'''
+if os.environ.get('OVERBOARD_TOKEN_KEY'):
+    hash_function = hmac_hashfunc(os.environ['OVERBOARD_TOKEN_KEY'].encode('utf-8'))
+# else:
+#     raise RuntimeWarning("You are using a mock hashing function that is publicly available " +
+#                          "on the repository.")
+
+
+@lru_cache(maxsize=HASH_CACHE_SIZE)
 def hash_string(string: str) -> str:
-    raise NotImplementedError()
+    '''Хэширует строку функцией `hash_function`. Результаты последних вызовов кэшируются'''
+    return hash_function(string)
 
 
-hash_string = mock_hashfunc
-# raise RuntimeWarning("You are using a mock hashing function that is publicly available " +
-#                      "on the repository.")
\ No newline at end of file
+def use_hash_function(function: Callable[[str], str]) -> None:
+    '''Заменяет хэш-функцию токенов и сбрасывает кэш хэшей'''
+    global hash_function
+    hash_function = function
+    hash_string.cache_clear()
@@ -1,31 +1,66 @@
+import asyncio
 from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+import logging
+import os
 from typing import Annotated, Awaitable
-import random
 
 from fastapi import FastAPI, HTTPException, Cookie, Query, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
+from pymongo.errors import DuplicateKeyError
 
 from .models import *
 from .models import tests
-from .databases import mongo_db as db
-from . import websocket_connections
+from .databases import mongo_db as db, run_db, ensure_indexes
+from . import eventlog, metrics, profiling, websocket_connections
+from .game_ids import game_ids
+from .broker import broker
 from .routers import eventhandlers, schemas
 from . import mkdocs
 from .utils import Token
 
 
+SELFTEST = os.environ.get('OVERBOARD_SELFTEST') == '1'
+'''Запускать ли тесты моделей при запуске приложения'''
+
+logger = logging.getLogger(__name__)
+
+
+async def build_docs(app: FastAPI) -> None:
+    '''Собирает документацию в отдельном потоке и открывает к ней доступ'''
+    await asyncio.to_thread(mkdocs.build)
+    app.mount('/docs', StaticFiles(directory='app/mkdocs/site', html=True), '/docs')
+
+
+def _docs_built(task: asyncio.Task) -> None:
+    '''Сообщает в лог, если документацию не удалось собрать, и /docs так и не появится'''
+    if not task.cancelled() and task.exception() is not None:
+        logger.error('Could not build the documentation, /docs is unavailable',
+                     exc_info=task.exception())
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    result = tests.run()
-    if len(result.failures) > 0:
-        raise AssertionError(result.failures[0][1])
+    if SELFTEST:
+        result = tests.run()
+        if len(result.failures) > 0:
+            raise AssertionError(result.failures[0][1])
 
-    mkdocs.build()
-    app.mount('/docs', StaticFiles(directory='app/mkdocs/site', html=True), '/docs')
+    # Сервер начинает принимать соединения, не дожидаясь сборки документации.
+    # Пока она собирается, /docs недоступен
+    app.state.docs_build = asyncio.create_task(build_docs(app))
+    app.state.docs_build.add_done_callback(_docs_built)
 
+    await run_db(ensure_indexes, site='startup.games_indexes')
+    await run_db(eventlog.ensure_indexes, site='startup.eventlog_indexes')
+
+    await broker.start()
+    sweeper = asyncio.create_task(websocket_connections.GameManager.sweep_forever())
     yield
+    sweeper.cancel()
+    await broker.stop()
 
 
 app = FastAPI(lifespan=lifespan, openapi_tags=[eventhandlers.tag_meta], docs_url='/rest/docs')
@@ -38,15 +73,27 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(profiling.ProfileRequests)
 
 
 app.include_router(websocket_connections.router)
 app.include_router(eventhandlers.router)
 app.include_router(schemas.router)
+app.include_router(metrics.router)
+app.include_router(profiling.router)
+
 
+async def game_document(game_id: int) -> dict:
+    # Пока игра загружена в память, документ в базе данных может отставать от неё
+    manager = websocket_connections.GameManager.managed_games.get(game_id)
+    if manager is not None and manager.game is not None:
+        return manager.game.dict()
+    # Игра может быть загружена и в другом процессе
+    reply = await broker.request(game_id, {'kind': 'document'})
+    if reply is not None and reply['game'] is not None:
+        return reply['game']
 
-def game_document(game_id: int) -> dict:
-    game_document = db['games'].find_one({'id': game_id})
+    game_document = await run_db(db['games'].find_one, {'id': game_id}, site='game_document')
     if game_document is None:
         raise HTTPException(422, f'Cannot find a game with id {game_id}')
 
@@ -61,7 +108,7 @@ TokenParam = Annotated[Token | None, Depends(cookie_token)]
 
 
 @app.post('/create')
-def create_game(
+async def create_game(
     game_id: Annotated[int, Query(description="Идентификатор для новой игры")],
     token: TokenParam
 ):
@@ -72,9 +119,17 @@ def create_game(
     \f
     @token: Идентификатор клиента, создающего игру.
     '''
-    if db['games'].find_one({'id': game_id}) is not None:
+    # Уникальность id проверяет индекс, поэтому две одновременные попытки создать одну и ту же
+    # игру не могут обе пройти
+    game = Game(id=game_id)
+    created_at = datetime.now(timezone.utc)
+    try:
+        await run_db(db['games'].insert_one, {**game.dict(), 'expire_at': eventlog.expiry(game)},
+                     site='create_game')
+    except DuplicateKeyError:
         raise HTTPException(400, detail=f"Game with {game_id} id already exists")
-    db['games'].insert_one(Game(id=game_id).dict())
+    # Идентификатор мог принадлежать удалённой игре, от которой остался журнал
+    await run_db(eventlog.forget, game_id, created_at, site='create_game.forget_log')
 
 
 class UniqueId(BaseModel):
@@ -82,12 +137,12 @@ class UniqueId(BaseModel):
 
 
 @app.get('/uniqueid')
-def free_id() -> UniqueId:
-    '''Возвращает id, не используемый ни в каких активных играх'''
-    while True:
-        game_id = random.randint(10000, 99999)
-        if db['games'].find_one({'id': game_id}) is None:
-            return UniqueId(game_id=game_id)
+async def free_id() -> UniqueId:
+    '''
+    Возвращает id, не занятый существующими играми. Id не резервируется: если его успеет занять
+    другая игра, `/create` ответит ошибкой 400, и нужно запросить новый
+    '''
+    return UniqueId(game_id=await game_ids.allocate())
 
 
 class PlayerIdModel(BaseModel):
@@ -95,26 +150,31 @@ class PlayerIdModel(BaseModel):
 
 
 @app.get('/playerid')
-def player_id(token: TokenParam) -> PlayerIdModel:
+async def player_id(token: TokenParam) -> PlayerIdModel:
     '''Возвращает id игрока, принадлежащий клиенту с переданным токеном'''
     return PlayerIdModel(id=token.hash())
 
 
 @app.get('/{game_id:int}/info')
-def game_info(game_document: Annotated[dict, Depends(game_document)]) -> GameInfo:
+async def game_info(game_document: Annotated[dict, Depends(game_document)]) -> GameInfo:
     '''Возвращает основную информацию об игре'''
 
     return GameInfo(**game_document)
 
 
 @app.get('/{game_id:int}')
-def game(game_document: Annotated[dict, Depends(game_document)], token: TokenParam) -> Game:
+async def game(game_id: int, token: TokenParam) -> Game:
     '''
     Возвращает информацию об игре, доступную клиенту с токеном-идентификатором.
     Если токен не передаётся, то возвращается информация, доступная наблюдателям.
     '''
-    game = Game(**game_document)
-    player_id = token.hash()
+    player_id = token.hash() if token is not None else None
+    manager = websocket_connections.GameManager.managed_games.get(game_id)
+    if manager is not None and manager.game is not None and player_id not in manager.game.players:
+        # Состояние для наблюдателей вычисляется один раз на каждое событие игры
+        return manager.spectator_view()
+
+    game = Game(**await game_document(game_id))
     if player_id in game.players:
         game = Game.with_player_view(game, player_id)
     else:
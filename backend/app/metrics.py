@@ -0,0 +1,173 @@
+'''
+Метрики сервера в текстовом формате Prometheus (`/metrics`).
+
+Метрики хранятся в памяти процесса, поэтому при нескольких процессах (см. `broker`) каждый
+процесс отдаёт свои. Обновление метрики - это несколько операций со словарём, поэтому они
+собираются всегда. Значения, которые и так хранятся в памяти (количество игр, соединений),
+не обновляются при каждом изменении, а считаются только при запросе `/metrics`
+'''
+
+from bisect import bisect_left
+from typing import Callable
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+
+router = APIRouter(tags=['Metrics'])
+
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+'''Границы корзин гистограмм времени, в секундах'''
+
+SIZE_BUCKETS = (0, 1, 2, 4, 6, 8, 16, 32, 64, 256, 1024, 4096)
+'''Границы корзин гистограмм количества'''
+
+
+class Metric:
+    '''Метрика, у которой может быть несколько значений, различающихся метками'''
+
+    type: str
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        '''
+        @name: Название метрики в Prometheus
+        @help: Описание метрики
+        @labels: Названия меток. Их значения передаются при обновлении метрики в том же порядке
+        '''
+        self.name = name
+        self.help = help
+        self.labels = labels
+        registry.append(self)
+
+    def _label_string(self, values: tuple, extra: str = '') -> str:
+        pairs = [f'{label}="{_escape(value)}"' for label, value in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def samples(self) -> list[str]:
+        '''Строки со значениями метрики'''
+        raise NotImplementedError()
+
+    def render(self) -> str:
+        header = f'# HELP {self.name} {self.help}\n# TYPE {self.name} {self.type}\n'
+        return header + ''.join(sample + '\n' for sample in self.samples())
+
+
+class Counter(Metric):
+    '''Счётчик, который только увеличивается'''
+
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        super().__init__(name, help, labels)
+        # Счётчик без меток виден с нуля, а не с первого увеличения
+        self._values: dict[tuple, float] = {} if labels else {(): 0}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self) -> list[str]:
+        return [f'{self.name}{self._label_string(labels)} {value}'
+                for labels, value in self._values.items()]
+
+
+class Histogram(Metric):
+    '''Распределение наблюдаемых значений по корзинам'''
+
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        '''@buckets: Верхние границы корзин по возрастанию, без `+Inf`'''
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        self._counts: dict[tuple, list[int]] = {}
+        '''Количество значений в каждой корзине (не накопленное) и в `+Inf`'''
+        self._sums: dict[tuple, float] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        counts = self._counts.get(labels)
+        if counts is None:
+            counts = self._counts[labels] = [0] * (len(self.buckets) + 1)
+        counts[bisect_left(self.buckets, value)] += 1
+        self._sums[labels] = self._sums.get(labels, 0) + value
+
+    def samples(self) -> list[str]:
+        samples = []
+        for labels, counts in self._counts.items():
+            total = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                total += count
+                le = f'le="{bound}"'
+                samples.append(f'{self.name}_bucket{self._label_string(labels, le)} {total}')
+            samples.append(f'{self.name}_sum{self._label_string(labels)} {self._sums[labels]}')
+            samples.append(f'{self.name}_count{self._label_string(labels)} {total}')
+        return samples
+
+
+class Gauge(Metric):
+    '''Значение, которое считается функцией при каждом запросе метрик'''
+
+    type = 'gauge'
+
+    def __init__(self, name: str, help: str,
+                 collect: Callable[[], float | dict[tuple, float]],
+                 labels: tuple[str, ...] = ()) -> None:
+        '''
+        @collect: Возвращает значение метрики или, если у метрики есть метки, словарь
+        со значениями по кортежам значений меток
+        '''
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def samples(self) -> list[str]:
+        values = self.collect()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [f'{self.name}{self._label_string(labels)} {value}'
+                for labels, value in values.items()]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+registry: list[Metric] = []
+'''Все созданные метрики в порядке создания'''
+
+
+def render() -> str:
+    '''Все метрики в текстовом формате Prometheus'''
+    return ''.join(metric.render() for metric in registry)
+
+
+@router.get('/metrics', response_class=PlainTextResponse)
+async def metrics() -> PlainTextResponse:
+    '''
+    Метрики сервера в текстовом формате Prometheus.
+    Выполняется в цикле событий, чтобы не читать менеджеров игр, пока цикл событий их меняет
+    '''
+    return PlainTextResponse(render(), media_type='text/plain; version=0.0.4')
+
+
+handler_seconds = Histogram(
+    'overboard_handler_seconds', 'Время обработки события игрока его обработчиком', ('event',))
+db_seconds = Histogram(
+    'overboard_db_seconds', 'Время запроса к базе данных, включая ожидание свободного потока',
+    ('site',))
+broadcast_fanout = Histogram(
+    'overboard_broadcast_fanout', 'Сколько соединений процесса получают хотя бы одно событие рассылки',
+    ('audience',), buckets=SIZE_BUCKETS)
+encode_seconds = Histogram(
+    'overboard_encode_seconds', 'Время кодирования варианта события', ('codec',),
+    buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01))
+rejected_events = Counter(
+    'overboard_rejected_events_total', 'Отклонённые события игроков', ('source', 'exception'))
+outbound_overflows = Counter(
+    'overboard_outbound_overflows_total', 'Сколько раз переполнялись очереди исходящих сообщений')
+outbound_high_water = Histogram(
+    'overboard_outbound_high_water',
+    'Наибольшая длина очереди исходящих сообщений за время соединения, по закрытым соединениям',
+    buckets=SIZE_BUCKETS)
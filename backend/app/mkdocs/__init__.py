@@ -1,39 +1,42 @@
 from enum import Enum
+from hashlib import sha256
+from importlib.metadata import version
 import json
+import os
 from typing import Literal, Union, get_args, get_origin, Any
 from types import UnionType
 
-from mkdocs.commands.build import build as mkbuild
-from mkdocs.config import load_config
 from pydantic import BaseModel
 
-from ..routers.eventhandlers import playerevent
+from ..routers.eventhandlers import playerevent, connection_events
 from ..models import *
 
 
-event_handlers = playerevent.handlers
 EventInfoKey = Literal["observable", "targeted", "player", "response_events"]
 events_info: dict[type[GameEvent], dict[EventInfoKey, Any]] = {}
-'''Словарь игровых событий с дополнительной информацией'''
+'''Словарь игровых событий с дополнительной информацией. Заполняется при сборке документации'''
 
-for name in event_handlers:
-    handler = event_handlers[name]
-    response_events = handler.response_events
-    event = handler.event_type
-    events_info[event] = {
+
+def _event_info(event: type[GameEvent], response_events=()) -> dict[EventInfoKey, Any]:
+    return {
         "observable": Observable in event.mro(),
         "targeted": TargetedEvent in event.mro(),
         "player": PlayerEvent in event.mro(),
         "response_events": response_events
     }
 
-    for event in response_events:
-        events_info[event] = {
-            "observable": Observable in event.mro(),
-            "targeted": TargetedEvent in event.mro(),
-            "player": PlayerEvent in event.mro(),
-            "response_events": []
-        }
+
+def _collect_events_info() -> None:
+    events_info.clear()
+    event_handlers = playerevent.handlers
+    for name in event_handlers:
+        handler = event_handlers[name]
+        events_info[handler.event_type] = _event_info(handler.event_type, handler.response_events)
+        for event in handler.response_events:
+            events_info[event] = _event_info(event)
+
+    for event in connection_events:
+        events_info[event] = _event_info(event)
 
 
 _dir = '/'.join(__path__) + '/'
@@ -199,7 +202,8 @@ def _make_event_block(event: type[GameEvent]) -> str:
 
     return md_event
 
-def _make_event_page():
+def _make_event_page() -> str:
+    '''Собирает страницу с описанием событий и записывает её в `docs/events.md`'''
     player_events = ""
     server_events = ""
 
@@ -208,13 +212,63 @@ def _make_event_page():
     for event in filter(lambda event: PlayerEvent not in event.mro(), events_info.keys()):
         server_events += _make_event_block(event) + '\n\n'
 
-    md_path = _dir + 'docs/events.md'
-    with open(_dir + 'templates/events.md', encoding='utf-8') as template, open(md_path, 'w', encoding='utf-8') as output:
+    with open(_dir + 'templates/events.md', encoding='utf-8') as template:
         md = template.read()
-        md = md.replace('{%player_events%}', player_events).replace('{%server_events%}', server_events)
+    md = md.replace('{%player_events%}', player_events).replace('{%server_events%}', server_events)
+
+    # Страница перезаписывается, только если изменилась
+    md_path = _dir + 'docs/events.md'
+    if os.path.exists(md_path):
+        with open(md_path, encoding='utf-8') as output:
+            if output.read() == md:
+                return md
+    with open(md_path, 'w', encoding='utf-8') as output:
         output.write(md)
+    return md
+
+
+def _sources_hash() -> str:
+    '''Хэш всего, из чего собирается сайт: настроек, страниц и версий mkdocs'''
+    digest = sha256()
+    digest.update(version('mkdocs').encode())
+    digest.update(version('mkdocs-material').encode())
+    paths = [_dir + 'mkdocs.yml']
+    for root, dirs, files in os.walk(_dir + 'docs'):
+        dirs.sort()
+        paths.extend(os.path.join(root, file) for file in sorted(files))
+    for path in paths:
+        digest.update(path.removeprefix(_dir).encode())
+        with open(path, 'rb') as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+
+def build(force: bool = False) -> bool:
+    '''
+    Собирает сайт документации в `site`.
+
+    Сайт пересобирается, только если изменились модели, обработчики событий или страницы
+    документации с прошлой сборки
 
+    @force: Собрать сайт, даже если ничего не изменилось
 
-def build():
+    :returns: Был ли сайт пересобран
+    '''
+    _collect_events_info()
     _make_event_page()
-    mkbuild(load_config(_dir + 'mkdocs.yml'))
\ No newline at end of file
+
+    hash_path = _dir + 'site/.build-hash'
+    sources_hash = _sources_hash()
+    if not force and os.path.exists(hash_path):
+        with open(hash_path, encoding='utf-8') as file:
+            if file.read() == sources_hash:
+                return False
+
+    # mkdocs долго импортируется, а нужен только при пересборке
+    from mkdocs.commands.build import build as mkbuild
+    from mkdocs.config import load_config
+
+    mkbuild(load_config(_dir + 'mkdocs.yml'))
+    with open(hash_path, 'w', encoding='utf-8') as file:
+        file.write(sources_hash)
+    return True
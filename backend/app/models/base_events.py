@@ -1,8 +1,10 @@
 from enum import Enum
+from typing import Callable, get_args
 
-from pydantic import BaseModel, validator, Field
+from pydantic import BaseModel, validator, Field, create_model
+from pydantic.fields import SHAPE_SINGLETON
 
-from .game import Game, Observable
+from .game import Game, Observable, UNKNOWN
 
 from ..utils import Token, PlayerId
 
@@ -33,6 +35,11 @@ class GameEvent(BaseModel):
     Сервер использует эту информацию, для того, чтобы понять, кому послать или переслать полученное
     событие
     '''
+    seq: int | None = None
+    '''
+    Порядковый номер события в журнале игры.
+    Назначается сервером, когда событие применено к игре
+    '''
 
     def __init__(self, **data):
         data['type'] = type(self).__name__
@@ -73,15 +80,20 @@ class PlayerEvent(GameEvent):
 
     @validator('player_id', always=True)
     def player_id_setup(cls, value, values):
-        client_token = Token(values['client_token'])
+        client_token = values.get('client_token')
         if client_token is not None:
+            # Переданный экземпляр `Token` (например, токен соединения) уже может помнить свой хэш
+            if not isinstance(client_token, Token):
+                client_token = Token(client_token)
             return client_token.hash()
         return value
 
 
-    def __init_subclass__(cls) -> None:
-        player_events[cls.__name__] = cls
-        return super().__init_subclass__()
+    def __init_subclass__(cls, register: bool = True, **kwargs) -> None:
+        '''@register: Добавить событие в `player_events`. Не добавляются модели для разбора'''
+        if register:
+            player_events[cls.__name__] = cls
+        return super().__init_subclass__(**kwargs)
 
     @staticmethod
     def from_dict(model: dict) -> 'PlayerEvent':
@@ -96,13 +108,70 @@ class PlayerEvent(GameEvent):
         '''
 
         if 'type' not in model:
-            'Type not provided'
+            raise AttributeError('Type not provided')
+
+        parse = _parsers.get(model['type'])
+        if parse is None:
+            if model['type'] not in player_events:
+                raise AttributeError(f'Given type is not a child of {PlayerEvent.__name__}')
+            parse = _parsers[model['type']] = _compile_parser(player_events[model['type']])
+
+        return parse(model)
 
-        if model['type'] not in player_events:
-            raise AttributeError(f'Given type is not a child of {PlayerEvent.__name__}')
 
-        event = player_events[model['type']](**model)
-        return event
+_parsers: dict[str, Callable[[dict], PlayerEvent]] = {}
+'''Функции разбора событий игроков по `type`. Составляются при первом разборе события'''
+
+
+def _or_unknown(model: type[BaseModel]) -> type:
+    '''
+    Тип для поля `model | UNKNOWN`, который принимает те же значения, что и объединение,
+    но выбирает вариант сразу.
+
+    Pydantic проверяет варианты объединения по очереди, и значение, которое оказалось `UNKNOWN`,
+    сначала проваливает проверку как `model`. Словарь без обязательных полей `model` может быть
+    только `UNKNOWN`, поэтому для него проверка `model` пропускается
+    '''
+    required = frozenset(name for name, field in model.__fields__.items() if field.required)
+
+    def validate(value):
+        if not isinstance(value, dict) or required <= value.keys():
+            try:
+                return model.validate(value)
+            except (ValueError, TypeError):
+                pass
+        return UNKNOWN.validate(value)
+
+    return type(f'{model.__name__}OrUnknown', (), {
+        '__get_validators__': classmethod(lambda cls: iter((validate,)))
+    })
+
+
+def _compile_parser(event_type: type[PlayerEvent]) -> Callable[[dict], PlayerEvent]:
+    '''
+    Составляет функцию разбора события. Если у события есть поля `X | UNKNOWN`, событие
+    проверяется моделью, в которой такие поля проверяются через `_or_unknown`. Остальные поля
+    и валидаторы у неё те же, поэтому она отклоняет те же события, что и сама модель события
+    '''
+    overrides = {}
+    for name, field in event_type.__fields__.items():
+        variants = get_args(field.outer_type_)
+        if field.shape == SHAPE_SINGLETON and len(variants) == 2 and UNKNOWN in variants:
+            model = variants[0] if variants[1] is UNKNOWN else variants[1]
+            overrides[name] = (_or_unknown(model), ... if field.required else field.default)
+    if len(overrides) == 0:
+        return lambda model: event_type(**model)
+
+    # Имя то же, чтобы `GameEvent.__init__` назначил событию правильный `type`
+    parser = create_model(event_type.__name__, __base__=event_type, __module__=event_type.__module__,
+                          __cls_kwargs__={'register': False}, **overrides)
+
+    def parse(model: dict) -> PlayerEvent:
+        event = parser(**model)
+        # Модель для разбора хранит поля так же, как модель события, поэтому уже проверенные
+        # значения переносятся в модель события без повторной проверки
+        return event_type.construct(_fields_set=event.__fields_set__, **event.__dict__)
+    return parse
 
 
 # Этот класс почти идентичен Observable, я просто хочу для понятности переписать здесь докстринги
@@ -1,20 +1,113 @@
 import random
 from enum import Enum, auto
-from typing import TYPE_CHECKING, Literal
+from typing import TYPE_CHECKING, Any, ClassVar, Literal
 
-from pydantic import BaseModel
-from pymongo.collection import Collection
+import pydantic.fields
+from pydantic import BaseModel, PrivateAttr
+
+from .tracking import Tracked, to_document
 
 if TYPE_CHECKING:
     from .base_events import GameEvent
 
 
+def _freeze(value: Any) -> Any:
+    '''Неизменяемая и хэшируемая копия значения поля'''
+    if isinstance(value, Frozen):
+        return value.key
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+class Frozen(BaseModel):
+    '''
+    Неизменяемая модель. Один экземпляр можно хранить сразу в нескольких играх и событиях,
+    поэтому при проверке вложенных моделей он не копируется. Чтобы изменить значение в игре,
+    его нужно заменить копией (`copy(update=...)`).
+
+    Экземпляры с одинаковыми значениями полей - это шаблоны из `ModelEnum`. При проверке
+    вложенного значения (например, при загрузке игры) вместо новой модели возвращается шаблон
+    с теми же значениями, если он есть
+    '''
+
+    class Config:
+        allow_mutation = False
+        copy_on_model_validation = 'none'
+
+    _templates: ClassVar[dict[tuple, 'Frozen']] = {}
+    '''Шаблоны модели по `key`'''
+
+    _key: tuple | None = PrivateAttr(None)
+
+    _defaults: ClassVar[tuple[tuple[str, Any], ...]] = ()
+    '''Поля модели и их значения по умолчанию, в порядке `key`'''
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        cls._templates = {}
+        cls._defaults = tuple((name, field.default) for name, field in cls.__fields__.items())
+
+    @property
+    def key(self) -> tuple:
+        '''Значения всех полей. Модели с равными ключами равны'''
+        if self._key is None:
+            object.__setattr__(self, '_key', _freeze(tuple(self.__dict__.values())))
+        return self._key
+
+    def intern(self) -> 'Frozen':
+        '''Делает модель шаблоном или возвращает уже существующий шаблон с теми же значениями'''
+        return self._templates.setdefault(self.key, self)
+
+    @classmethod
+    def validate(cls, value: Any) -> 'Frozen':
+        if len(cls._templates) == 0:
+            return super().validate(value)
+        if isinstance(value, dict):
+            # Словарь со значениями шаблона не нужно проверять: шаблон уже проверен
+            key = tuple(_freeze(value.get(name, default)) for name, default in cls._defaults)
+            template = cls._templates.get(key)
+            if template is not None:
+                return template
+        model = super().validate(value)
+        if type(model) is not cls:
+            return model
+        return cls._templates.get(model.key, model)
+
+    def copy(self, **kwargs) -> 'Frozen':
+        copy = super().copy(**kwargs)
+        object.__setattr__(copy, '_key', None)
+        return copy
+
+    def __eq__(self, other: Any) -> bool:
+        if self is other:
+            return True
+        if type(other) is type(self):
+            return self.key == other.key
+        return super().__eq__(other)
+
+    def __hash__(self) -> int:
+        return hash(self.key)
+
+
 class ModelEnum(Enum):
-    '''Enum, значениями которого являются pydantic модели'''
+    '''
+    Enum, значениями которого являются pydantic модели.
+
+    `Frozen` модели становятся шаблонами и возвращаются без копирования
+    '''
+
+    def __init__(self, value: BaseModel) -> None:
+        if isinstance(value, Frozen):
+            value.intern()
+
     @property
     def value(self):
-        '''Возвращает копию значения, хранимого в enum'''
-        return type(super().value).construct(**super().value.dict())
+        '''Возвращает шаблон или, если модель можно изменять, копию значения, хранимого в enum'''
+        value = super().value
+        if isinstance(value, Frozen):
+            return value
+        return type(value).construct(**value.dict())
 
 
 class UNKNOWN(BaseModel):
@@ -27,6 +120,38 @@ class UNKNOWN(BaseModel):
     они неизвестны
     '''
 
+
+_UNKNOWN = UNKNOWN()
+'''
+Общий экземпляр `UNKNOWN` для скрытых значений. У `UNKNOWN` нет полей,
+поэтому его можно не копировать
+'''
+
+class ObserverAction(Enum):
+    '''Что происходит с полем `Observable` модели с точки зрения наблюдателя'''
+    Mask = auto()
+    '''Значение (или каждый элемент списка/словаря) заменяется на `UNKNOWN`'''
+    Recurse = auto()
+    '''Значение (или каждый элемент списка/словаря) - `Observable`, который тоже нужно скрыть'''
+
+
+class FieldShape(Enum):
+    Single = auto()
+    List = auto()
+    Dict = auto()
+
+
+_LIST_SHAPES = {
+    pydantic.fields.SHAPE_LIST, pydantic.fields.SHAPE_SET, pydantic.fields.SHAPE_FROZENSET,
+    pydantic.fields.SHAPE_TUPLE_ELLIPSIS, pydantic.fields.SHAPE_SEQUENCE,
+    pydantic.fields.SHAPE_ITERABLE, pydantic.fields.SHAPE_DEQUE
+}
+_DICT_SHAPES = {
+    pydantic.fields.SHAPE_DICT, pydantic.fields.SHAPE_DEFAULTDICT,
+    pydantic.fields.SHAPE_MAPPING, pydantic.fields.SHAPE_COUNTER
+}
+
+
 class Observable(BaseModel):
     '''
     Модель, часть информации которой доступна не всем игрокам.
@@ -40,6 +165,46 @@ class Observable(BaseModel):
     observed: bool = False
     '''Если True, то модель отображает точку зрения наблюдателя'''
 
+    _observer_plan: ClassVar[tuple[tuple[str, ObserverAction, FieldShape], ...]] = ()
+    '''
+    Поля, которые меняются с точки зрения наблюдателя. Остальные поля наблюдатель видит как есть.
+    Составляется один раз при создании класса в `compile_observer_plan`
+    '''
+
+    _observer_passthrough: ClassVar[tuple[str, ...]] = ()
+    '''Поля, которые наблюдатель видит как есть, кроме исключённых из `dict()`'''
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        cls.compile_observer_plan()
+
+    @classmethod
+    def compile_observer_plan(cls) -> None:
+        '''
+        Определяет по аннотациям полей, какие из них скрываются или содержат `Observable`.
+        Нужно вызвать повторно, если аннотации изменились, например, после `update_forward_refs`
+        '''
+        plan = []
+        passthrough = []
+        for name, field in cls.__fields__.items():
+            if field.shape in _LIST_SHAPES:
+                shape = FieldShape.List
+            elif field.shape in _DICT_SHAPES:
+                shape = FieldShape.Dict
+            else:
+                shape = FieldShape.Single
+
+            # По идее если у аннотации есть __args__, то это означает, что это type hint, который
+            # принимает несколько разных типов
+            if hasattr(field.type_, '__args__') and UNKNOWN in field.type_.__args__:
+                plan.append((name, ObserverAction.Mask, shape))
+            elif isinstance(field.type_, type) and issubclass(field.type_, Observable):
+                plan.append((name, ObserverAction.Recurse, shape))
+            elif name != 'observed' and not field.field_info.exclude:
+                passthrough.append(name)
+        cls._observer_plan = tuple(plan)
+        cls._observer_passthrough = tuple(passthrough)
+
     def observer_viewpoint(self) -> 'Observable':
         '''Возвращает модель с точки зрения наблюдателя'''
         changed_values: dict = self._observer_diff()
@@ -52,52 +217,74 @@ class Observable(BaseModel):
 
         return copy
 
+    def observer_dict(self) -> dict[str, Any]:
+        '''
+        Возвращает `observer_viewpoint().dict()`, не создавая промежуточных копий моделей
+        '''
+        plan = self._observer_plan
+        if len(plan) == 0:
+            self._raise_no_diff()
+
+        values = self.__dict__
+        document = {name: to_document(values[name]) for name in self._observer_passthrough}
+        for name, action, shape in plan:
+            value = values[name]
+            if value is None:
+                document[name] = {} if action == ObserverAction.Mask else None
+            elif action == ObserverAction.Mask:
+                if shape == FieldShape.List:
+                    document[name] = [{} for _ in value]
+                elif shape == FieldShape.Dict:
+                    document[name] = {key: {} for key in value}
+                else:
+                    document[name] = {}
+            elif shape == FieldShape.List:
+                document[name] = [el.observer_dict() for el in value]
+            elif shape == FieldShape.Dict:
+                document[name] = {key: value[key].observer_dict() for key in value}
+            else:
+                document[name] = value.observer_dict()
+        document['observed'] = True
+        return document
+
     def _observer_diff(self) -> dict[str, any]:
         '''
         Поля, которые должны быть скрыты или изменены для наблюдателя.
 
         Используется в `observer_viewpoint`.
         '''
-        diff = {}
-        for name in self.__fields__:
+        plan = self._observer_plan
+        if len(plan) == 0:
+            self._raise_no_diff()
 
-            field = self.__fields__[name]
-            value = self.__getattribute__(name)
-
-            # По идее если у аннотации есть __args__, то это означает, что это type hint, который
-            # принимает несколько разных типов
-            if hasattr(field.type_, '__args__') and UNKNOWN in field.type_.__args__:
-                if isinstance(value, list):
-                    diff[name] = [UNKNOWN() for el in value]
-                elif isinstance(value, dict):
-                    diff[name] = {}
-                    for key in value:
-                        diff[name][key] = UNKNOWN()
+        values = self.__dict__
+        diff = {}
+        for name, action, shape in plan:
+            value = values[name]
+            if value is None:
+                diff[name] = _UNKNOWN if action == ObserverAction.Mask else None
+            elif action == ObserverAction.Mask:
+                if shape == FieldShape.List:
+                    diff[name] = [_UNKNOWN] * len(value)
+                elif shape == FieldShape.Dict:
+                    diff[name] = dict.fromkeys(value, _UNKNOWN)
                 else:
-                    diff[name] = UNKNOWN()
-            # Разбираемся с Observable-полями
-            elif isinstance(value, Observable):
+                    diff[name] = _UNKNOWN
+            elif shape == FieldShape.List:
+                diff[name] = [el.observer_viewpoint() for el in value]
+            elif shape == FieldShape.Dict:
+                diff[name] = {key: value[key].observer_viewpoint() for key in value}
+            else:
                 diff[name] = value.observer_viewpoint()
-            elif isinstance(value, list):
-                diff[name] = [
-                    el.observer_viewpoint() if isinstance(el, Observable) else el for el in value
-                ]
-            elif isinstance(value, dict):
-                diff[name] = {}
-                for key in value:
-                    if isinstance(value[key], Observable):
-                        diff[name][key] = value[key].observer_viewpoint()
-                    else:
-                        diff[name][key] = value[key]
-
-        if len(diff) == 0:
-            raise RuntimeWarning(
-                'No changes could be made when converting Observable to observer viewpoint. ' +
-                'You might want to override `_observer_diff` or `observer_viewpoint`'
-            )
 
         return diff
 
+    def _raise_no_diff(self):
+        raise RuntimeWarning(
+            'No changes could be made when converting Observable to observer viewpoint. ' +
+            'You might want to override `_observer_diff` or `observer_viewpoint`'
+        )
+
 
 class GameViewpoint(str, Enum):
     Player = 'Player'
@@ -109,7 +296,7 @@ class GameInfo(BaseModel):
     started: bool = False
 
 
-class Character(BaseModel):
+class Character(Frozen):
     name: str
     '''Уникальное имя персонажа'''
     attack: int
@@ -131,7 +318,7 @@ class CharactersEnum(ModelEnum):
     KIDDO = Character(name="Kiddo", attack=3, health=3, survival_bonus=9, order=6)
 
 
-class Supply(BaseModel):
+class Supply(Frozen):
     # Припасы в За Бортом ведут себя очень по-разному, поэтому нецелесообразно пытаться все их
     # особенности выразить через модель. Вместо этого у них есть уникальный тип, который
     # определяет, что в коде делать с таким-то припасом (как на фронте, так и на бэке).
@@ -152,7 +339,10 @@ class SuppliesEnum(ModelEnum):
     SHARK_BAIT = Supply(type="shark_bait")
 
 
-class Navigation(BaseModel):
+_SUPPLY_TEMPLATES: list[Supply] = [supply.value for supply in SuppliesEnum]
+
+
+class Navigation(Frozen):
     '''Карта навигации'''
 
     bird_info: Literal['exed', 'missing', 'present']
@@ -179,7 +369,7 @@ class Navigation(BaseModel):
 
 
 
-class Player(Observable):
+class Player(Observable, Tracked):
     name: str = None
     character: Character = None
     supplies: list[Supply | UNKNOWN] = []
@@ -199,7 +389,7 @@ class GamePhase(str, Enum):
     Evening = 'evening'
 
 
-class Game(Observable):
+class Game(Observable, Tracked):
     '''
     Модель, отображающая состояние игры. В зависимости от `viewpoint` часть информации
     скрывается или искажается.
@@ -231,6 +421,9 @@ class Game(Observable):
     player_turn_queue: list[str] = []
     '''Очередь игроков, ждущих свой ход в текущей фазе'''
 
+    seq: int = 0
+    '''Порядковый номер последнего события, применённого к игре'''
+
     def apply_event(self, event: 'GameEvent'):
         '''Применяет переданные событием изменения к игре'''
         event.apply_to_game(self)
@@ -251,8 +444,7 @@ class Game(Observable):
 
     def create_supply_stash(self):
         '''Создаёт утренние припасы и добавляет их в игру в базе данных'''
-        self.supply_stash: list[Supply] = random.choices(
-            [e.value for e in SuppliesEnum], k=len(self.players))
+        self.supply_stash: list[Supply] = random.choices(_SUPPLY_TEMPLATES, k=len(self.players))
 
     def generate_offered_navigations(self):
         '''Генерирует карты навигации, которые будут предложены активному игроку'''
@@ -291,19 +483,6 @@ class Game(Observable):
             self.offered_navigations.append(navigation)
 
 
-    def save_changes(self, mongo_collection: Collection):
-        if self.observed:
-            raise AttributeError('Cannot save game from observer viewpoint')
-
-        curr_document = mongo_collection.find_one({'id': self.id})
-        model_dict = self.dict()
-
-        changes = {}
-        for name in model_dict:
-            if name not in curr_document or curr_document[name] != model_dict[name]:
-                changes[name] = model_dict[name]
-        mongo_collection.update_one({'id': self.id}, {'$set': changes})
-
     @staticmethod
     def with_player_view(game: 'Game | dict', player_id: str) -> 'Game':
         '''
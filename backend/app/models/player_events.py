@@ -5,7 +5,7 @@ from .game import *
 class PlayerConnect(PlayerEvent):
 
     def apply_to_game(self, game):
-        game.players[self.player_id] = {}
+        game.players[self.player_id] = Player()
 
 
 class NameChange(PlayerEvent):
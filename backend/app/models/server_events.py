@@ -58,4 +58,20 @@ class SupplyShowcase(TargetedEvent, ObservableEvent):
 
 class NavigationsOffer(TargetedEvent, ObservableEvent):
     '''Клиенту для выбора предоставляется набор карт навигации'''
-    offered_navigations: list[Navigation | UNKNOWN]
\ No newline at end of file
+    offered_navigations: list[Navigation | UNKNOWN]
+
+class GameSync(TargetedEvent):
+    '''
+    Полное состояние игры с точки зрения клиента. Присылается при переподключении,
+    если пропущенные клиентом события уже недоступны
+    '''
+    game: Game
+
+
+class EventBatch(GameEvent):
+    '''
+    События, вызванные одним событием игрока, одним сообщением. Присылается клиентам,
+    подключившимся с `batch=true`. Клиент применяет все события пакета сразу, по порядку
+    '''
+    events: list[dict]
+    '''События в том виде, в котором они были бы присланы по отдельности'''
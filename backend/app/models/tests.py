@@ -3,8 +3,11 @@
 import unittest
 from unittest import TestResult
 
-from .game import Observable, UNKNOWN, SuppliesEnum
+from .game import Observable, UNKNOWN, SuppliesEnum, CharactersEnum, Game, Player, Supply
+from .base_events import PlayerEvent
+from .player_events import TakeSupply
 from .server_events import NewSupplies
+from .tracking import apply_update
 
 
 class TestObservable(unittest.TestCase):
@@ -48,7 +51,117 @@ class TestObservable(unittest.TestCase):
         self.assertEqual(w.observer_viewpoint().d['b'], observed_o)
 
 
+    def test_observer_dict(self):
+        game = Game(id=0, players={'a': Player(supplies=[SuppliesEnum.MEDKIT.value])},
+                    supply_stash=[SuppliesEnum.SHARK_BAIT.value], player_turn_queue=['a'])
+        self.assertEqual(game.observer_dict(), game.observer_viewpoint().dict())
+
+        event = NewSupplies(targets=['a'], supplies=[SuppliesEnum.MEDKIT.value])
+        self.assertEqual(event.observer_dict(), event.observer_viewpoint().dict())
+
+
+class TestTracking(unittest.TestCase):
+
+    def test_nested_push(self):
+        game = Game(id=0, players={'a': Player()})
+        game.track_changes()
+        supply = SuppliesEnum.MEDKIT.value
+        game.players['a'].supplies.append(supply)
+
+        self.assertEqual(game.collect_changes(),
+                         {'$push': {'players.a.supplies': {'$each': [supply.dict()]}}})
+        self.assertEqual(game.collect_changes(), {})
+
+    def test_conflicting_operations(self):
+        supply = SuppliesEnum.MEDKIT.value
+        game = Game(id=0, supply_stash=[supply, supply], player_turn_queue=['a', 'b'])
+        game.track_changes()
+        game.supply_stash.remove(supply)
+        game.player_turn_queue.pop(0)
+        game.player_turn_queue.append('c')
+
+        # $pull удалил бы оба припаса, а на один путь нельзя делать $pop и $push сразу
+        self.assertEqual(game.collect_changes(), {'$set': {
+            'supply_stash': [supply.dict()], 'player_turn_queue': ['b', 'c']
+        }})
+
+    def test_parent_overrides_child(self):
+        game = Game(id=0, players={'a': Player()})
+        game.track_changes()
+        game.players['a'].name = 'name'
+        game.players['a'] = Player(name='other')
+        game.players['a'].rowed_this_turn = True
+
+        self.assertEqual(list(game.collect_changes()['$set']), ['players.a'])
+
+    def test_apply_update(self):
+        supply = SuppliesEnum.MEDKIT.value
+        game = Game(id=0, players={'a': Player(), 'b': Player()}, supply_stash=[supply],
+                    player_turn_queue=['a', 'b'])
+        document = game.dict()
+        game.track_changes()
+        game.supply_stash.remove(supply)
+        game.players['a'].supplies.append(supply)
+        game.players['c'] = Player(name='c')
+        game.change_turn()
+
+        self.assertEqual(apply_update(document, game.collect_changes()), game.dict())
+
+    def test_views_are_not_tracked(self):
+        game = Game(id=0, players={'a': Player()}, active_player='a')
+        game.track_changes()
+        Game.with_player_view(game, 'a')
+        Game.with_spectator_view(game)
+
+        self.assertEqual(game.collect_changes(), {})
+
+
+class TestFrozen(unittest.TestCase):
+
+    def test_templates_are_shared(self):
+        supply = SuppliesEnum.MEDKIT.value
+        self.assertIs(supply, SuppliesEnum.MEDKIT.value)
+        with self.assertRaises(TypeError):
+            supply.points = 10
+
+    def test_loaded_values_are_interned(self):
+        game = Game(**Game(id=0, players={'a': Player(character=CharactersEnum.LADY.value)},
+                           supply_stash=[SuppliesEnum.MEDKIT.value]).dict())
+
+        self.assertIs(game.supply_stash[0], SuppliesEnum.MEDKIT.value)
+        self.assertIs(game.players['a'].character, CharactersEnum.LADY.value)
+
+    def test_copy_is_not_template(self):
+        supply = SuppliesEnum.MEDKIT.value
+        changed = supply.copy(update={'points': 3})
+
+        self.assertNotEqual(changed, supply)
+        self.assertEqual(changed, Supply(type='medkit', points=3))
+
+
+class TestPlayerEvents(unittest.TestCase):
+
+    def test_parsed_event_is_event_model(self):
+        model = {'type': 'TakeSupply', 'client_token': 'a',
+                 'supply': SuppliesEnum.MEDKIT.value.dict()}
+        event = PlayerEvent.from_dict(model)
+
+        self.assertIs(type(event), TakeSupply)
+        self.assertEqual(event, TakeSupply(**model))
+        self.assertEqual(event.__fields_set__, TakeSupply(**model).__fields_set__)
+        self.assertIs(event.supply, SuppliesEnum.MEDKIT.value)
+
+    def test_unknown_field(self):
+        event = PlayerEvent.from_dict({'type': 'TakeSupply', 'client_token': 'a', 'supply': {}})
+
+        self.assertIs(type(event), TakeSupply)
+        self.assertEqual(event.supply, UNKNOWN())
+
+
 def run() -> TestResult:
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(TestObservable))
+    suite.addTest(unittest.makeSuite(TestTracking))
+    suite.addTest(unittest.makeSuite(TestFrozen))
+    suite.addTest(unittest.makeSuite(TestPlayerEvents))
     return unittest.TextTestRunner().run(suite)
\ No newline at end of file
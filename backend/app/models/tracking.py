@@ -0,0 +1,369 @@
+'''
+Отслеживание изменений моделей для частичной записи в MongoDB.
+
+Вместо того чтобы перечитывать документ из базы данных и сравнивать его с моделью целиком,
+модели `Tracked` запоминают, какие поля и вложенные списки/словари были изменены,
+и превращают это в минимальный запрос `$set`/`$unset`/`$push`/`$pull`/`$pop`
+по вложенным путям вида `players.<id>.supplies`
+'''
+
+from typing import Any, Iterable
+
+from pydantic import BaseModel, PrivateAttr
+
+
+def to_document(value: Any) -> Any:
+    '''Переводит значение модели в вид, в котором оно хранится в базе данных'''
+    if isinstance(value, BaseModel):
+        return value.dict()
+    if isinstance(value, list):
+        return [to_document(el) for el in value]
+    if isinstance(value, dict):
+        return {key: to_document(value[key]) for key in value}
+    return value
+
+
+class ChangeLog:
+    '''
+    Набор изменений модели, которые ещё не записаны в базу данных.
+
+    Для каждого пути хранится одна операция. Если к одному и тому же пути применяется
+    несколько несовместимых операций, они заменяются на `$set` всего пути: MongoDB не разрешает
+    в одном запросе изменять один путь разными операциями, а также путь и его родителя
+    '''
+
+    def __init__(self) -> None:
+        self._ops: dict[str, tuple[str, Any]] = {}
+        '''Путь -> (операция, аргумент)'''
+
+    def __len__(self) -> int:
+        return len(self._ops)
+
+    def _covered(self, path: str) -> bool:
+        '''Перезаписывается ли путь целиком одним из его родителей'''
+        index = path.rfind('.')
+        while index != -1:
+            path = path[:index]
+            op = self._ops.get(path)
+            if op is not None and op[0] in ('set', 'unset'):
+                return True
+            index = path.rfind('.')
+        return False
+
+    def _replace(self, path: str, op: str) -> None:
+        prefix = path + '.'
+        for key in [key for key in self._ops if key.startswith(prefix)]:
+            del self._ops[key]
+        self._ops[path] = (op, None)
+
+    def set(self, path: str) -> None:
+        '''Путь нужно перезаписать текущим значением'''
+        if not self._covered(path):
+            self._replace(path, 'set')
+
+    def unset(self, path: str) -> None:
+        '''Путь нужно удалить'''
+        if not self._covered(path):
+            self._replace(path, 'unset')
+
+    def push(self, path: str, items: Iterable) -> None:
+        '''В конец списка по пути добавлены элементы'''
+        if self._covered(path):
+            return
+        op = self._ops.get(path)
+        if op is None:
+            self._ops[path] = ('push', list(items))
+        elif op[0] == 'push':
+            op[1].extend(items)
+        else:
+            self._replace(path, 'set')
+
+    def pull(self, path: str, item: Any) -> None:
+        '''Из списка по пути удалены все элементы, равные `item`'''
+        if self._covered(path):
+            return
+        if path in self._ops:
+            self._replace(path, 'set')
+        else:
+            self._ops[path] = ('pull', item)
+
+    def pop(self, path: str, first: bool) -> None:
+        '''Из списка по пути удалён первый или последний элемент'''
+        if self._covered(path):
+            return
+        if path in self._ops:
+            self._replace(path, 'set')
+        else:
+            self._ops[path] = ('pop', -1 if first else 1)
+
+    def clear(self) -> None:
+        self._ops.clear()
+
+    def as_update(self, root: BaseModel) -> dict[str, dict]:
+        '''
+        Запрос для `update_one`, записывающий изменения.
+
+        @root: Модель, изменения которой отслеживаются. Из неё берутся текущие значения для `$set`
+        '''
+        update: dict[str, dict] = {}
+        for path, (op, arg) in self._ops.items():
+            if op == 'set':
+                update.setdefault('$set', {})[path] = to_document(_resolve(root, path))
+            elif op == 'unset':
+                update.setdefault('$unset', {})[path] = ''
+            elif op == 'push':
+                update.setdefault('$push', {})[path] = {'$each': to_document(arg)}
+            elif op == 'pull':
+                update.setdefault('$pull', {})[path] = to_document(arg)
+            elif op == 'pop':
+                update.setdefault('$pop', {})[path] = arg
+        return update
+
+
+def apply_update(document: dict, update: dict[str, dict]) -> dict:
+    '''
+    Применяет к документу запрос, собранный `ChangeLog.as_update`, так же, как это сделала бы
+    MongoDB. Изменяет и возвращает переданный документ
+    '''
+    for op, changes in update.items():
+        for path, arg in changes.items():
+            *parents, key = path.split('.')
+            target = document
+            for parent in parents:
+                target = target.setdefault(parent, {})
+
+            if op == '$set':
+                target[key] = arg
+            elif op == '$unset':
+                target.pop(key, None)
+            elif op == '$push':
+                target.setdefault(key, []).extend(arg['$each'])
+            elif op == '$pull':
+                target[key] = [el for el in target.get(key, []) if el != arg]
+            elif op == '$pop':
+                if len(target.get(key, [])) > 0:
+                    target[key].pop(0 if arg == -1 else -1)
+            else:
+                raise ValueError(f'Unsupported update operator {op}')
+    return document
+
+
+def _resolve(root: BaseModel, path: str) -> Any:
+    value = root
+    for key in path.split('.'):
+        value = value[key] if isinstance(value, dict) else getattr(value, key)
+    return value
+
+
+def _join(path: str, key: str) -> str:
+    return f'{path}.{key}' if path else key
+
+
+def _attach(value: Any, changes: ChangeLog | None, path: str) -> Any:
+    '''Возвращает значение, изменения которого записываются в `changes` под путём `path`'''
+    if isinstance(value, Tracked):
+        value.track_changes(changes, path)
+        return value
+    if isinstance(value, list):
+        return TrackedList(value, changes, path)
+    if isinstance(value, dict):
+        return TrackedDict(value, changes, path)
+    return value
+
+
+class TrackedList(list):
+    '''Список, записывающий свои изменения в `ChangeLog`'''
+
+    __slots__ = ('_changes', '_path')
+
+    def __init__(self, iterable: Iterable = (), changes: ChangeLog | None = None, path: str = ''):
+        super().__init__(iterable)
+        self._changes = changes
+        self._path = path
+
+    def _set(self) -> None:
+        if self._changes is not None:
+            self._changes.set(self._path)
+
+    def append(self, item) -> None:
+        super().append(item)
+        if self._changes is not None:
+            self._changes.push(self._path, (item,))
+
+    def extend(self, items: Iterable) -> None:
+        items = list(items)
+        super().extend(items)
+        if self._changes is not None:
+            self._changes.push(self._path, items)
+
+    def __iadd__(self, items: Iterable) -> 'TrackedList':
+        self.extend(items)
+        return self
+
+    def remove(self, item) -> None:
+        super().remove(item)
+        if self._changes is not None:
+            # $pull удаляет все равные элементы, а list.remove - только первый
+            if item in self:
+                self._changes.set(self._path)
+            else:
+                self._changes.pull(self._path, item)
+
+    def pop(self, index: int = -1):
+        item = super().pop(index)
+        if self._changes is not None:
+            if index == 0:
+                self._changes.pop(self._path, first=True)
+            elif index == -1 or index == len(self):
+                self._changes.pop(self._path, first=False)
+            else:
+                self._changes.set(self._path)
+        return item
+
+    def insert(self, index: int, item) -> None:
+        super().insert(index, item)
+        self._set()
+
+    def clear(self) -> None:
+        super().clear()
+        self._set()
+
+    def sort(self, *args, **kwargs) -> None:
+        super().sort(*args, **kwargs)
+        self._set()
+
+    def reverse(self) -> None:
+        super().reverse()
+        self._set()
+
+    def __setitem__(self, index, value) -> None:
+        super().__setitem__(index, value)
+        self._set()
+
+    def __delitem__(self, index) -> None:
+        super().__delitem__(index)
+        self._set()
+
+    def __imul__(self, value: int) -> 'TrackedList':
+        super().__imul__(value)
+        self._set()
+        return self
+
+
+class TrackedDict(dict):
+    '''Словарь, записывающий свои изменения в `ChangeLog`. Значения-модели тоже отслеживаются'''
+
+    __slots__ = ('_changes', '_path')
+
+    def __init__(self, mapping: dict = {}, changes: ChangeLog | None = None, path: str = ''):
+        super().__init__()
+        self._changes = changes
+        self._path = path
+        for key in mapping:
+            super().__setitem__(key, _attach(mapping[key], changes, _join(path, key)))
+
+    def _set(self) -> None:
+        if self._changes is not None:
+            self._changes.set(self._path)
+
+    def __setitem__(self, key: str, value) -> None:
+        path = _join(self._path, key)
+        super().__setitem__(key, _attach(value, self._changes, path))
+        if self._changes is not None:
+            self._changes.set(path)
+
+    def __delitem__(self, key: str) -> None:
+        super().__delitem__(key)
+        if self._changes is not None:
+            self._changes.unset(_join(self._path, key))
+
+    def update(self, *args, **kwargs) -> None:
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key: str, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key: str, *default):
+        had_key = key in self
+        value = super().pop(key, *default)
+        if had_key and self._changes is not None:
+            self._changes.unset(_join(self._path, key))
+        return value
+
+    def popitem(self):
+        item = super().popitem()
+        if self._changes is not None:
+            self._changes.unset(_join(self._path, item[0]))
+        return item
+
+    def clear(self) -> None:
+        super().clear()
+        self._set()
+
+
+class Tracked(BaseModel):
+    '''
+    Модель, которая может запоминать изменения своих полей, в том числе вложенных списков,
+    словарей и `Tracked`-моделей.
+
+    Изменения начинают отслеживаться после вызова `track_changes`. Копии модели
+    изменения не отслеживают.
+    '''
+
+    _changes: ChangeLog | None = PrivateAttr(None)
+    _path: str = PrivateAttr('')
+
+    def track_changes(self, changes: ChangeLog | None = None, path: str = '') -> ChangeLog:
+        '''
+        Начинает записывать изменения модели в `changes`.
+
+        @changes: Куда записывать изменения. Если не передан, создаётся новый `ChangeLog`
+        @path: Путь к модели внутри документа, которому принадлежат изменения
+
+        :returns: `ChangeLog`, в который записываются изменения
+        '''
+        if changes is None:
+            changes = ChangeLog()
+        object.__setattr__(self, '_changes', changes)
+        object.__setattr__(self, '_path', path)
+        for name in self.__fields__:
+            value = self.__dict__[name]
+            tracked = _attach(value, changes, _join(path, name))
+            if tracked is not value:
+                self.__dict__[name] = tracked
+        return changes
+
+    @property
+    def has_changes(self) -> bool:
+        '''Есть ли изменения, ещё не собранные `collect_changes`'''
+        return self._changes is not None and len(self._changes) > 0
+
+    def collect_changes(self) -> dict[str, dict]:
+        '''
+        Возвращает запрос для `update_one` с изменениями модели с прошлого вызова
+        и очищает их. Вызывается только у корневой модели документа
+        '''
+        if self._changes is None:
+            raise AttributeError('Changes of the model are not tracked. Call `track_changes` first')
+        update = self._changes.as_update(self)
+        self._changes.clear()
+        return update
+
+    def __setattr__(self, name: str, value) -> None:
+        if self._changes is not None and name in self.__fields__:
+            # `player.supplies += [...]` присваивает тот же самый список после `__iadd__`
+            if value is self.__dict__.get(name):
+                return
+            path = _join(self._path, name)
+            value = _attach(value, self._changes, path)
+            self._changes.set(path)
+        super().__setattr__(name, value)
+
+    def copy(self, **kwargs) -> 'Tracked':
+        copy = super().copy(**kwargs)
+        object.__setattr__(copy, '_changes', None)
+        object.__setattr__(copy, '_path', '')
+        return copy
@@ -0,0 +1,222 @@
+'''
+Профилирование по запросу: трафика одной игры или одного REST-запроса.
+
+Включается администратором, знающим ключ из переменной окружения `OVERBOARD_PROFILE_KEY`.
+Если ключ не задан, профилирование недоступно.
+
+- Игра: `POST /profiling/games/{game_id}` с заголовком `X-Overboard-Admin: <ключ>` включает
+`cProfile` на время разбора событий игры в `_handle_socket`, их обработки `playerevent` и рассылки.
+Остальной код, в том числе всё, что происходит во время ожидания (`await`), не профилируется.
+Профилирование заканчивается через `duration` секунд, после `events` событий или по
+`DELETE /profiling/games/{game_id}`
+- Запрос: REST-запрос с заголовком `X-Overboard-Profile: <ключ>` профилируется целиком. Так как
+цикл событий один, в профиль попадает и всё, что выполнялось одновременно с запросом.
+Профилируется только поток цикла событий, поэтому у обычных (не `async`) путей и зависимостей,
+которые FastAPI выполняет в пуле потоков, их собственная работа в профиль не попадает. Для таких
+путей в ответ добавляется заголовок `X-Overboard-Profile-Partial`
+
+Профили записываются в формате pstats (`python -m pstats <файл>`, snakeviz) в папку
+`OVERBOARD_PROFILE_DIR`. Профилируется только тот процесс, который получил запрос администратора
+'''
+
+import asyncio
+import cProfile
+import hmac
+import inspect
+import os
+import time
+from typing import Annotated
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+
+
+PROFILE_KEY = os.environ.get('OVERBOARD_PROFILE_KEY')
+'''Ключ администратора. `None` - профилирование недоступно'''
+
+PROFILE_DIR = os.environ.get('OVERBOARD_PROFILE_DIR', 'profiles')
+'''Папка, в которую записываются профили'''
+
+
+def _profile_path(name: str) -> str:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    return os.path.join(PROFILE_DIR, f'{name}-{time.strftime("%Y%m%d-%H%M%S")}.pstats')
+
+
+_active: cProfile.Profile | None = None
+'''
+Включённый сейчас профилировщик. В потоке может работать только один, поэтому участки кода,
+выполняющиеся во время профилирования запроса, не включают профилировщик игры
+'''
+
+
+class GameProfile:
+    '''Профилирование трафика одной игры. Используется как контекстный менеджер вокруг участков кода'''
+
+    def __init__(self, game_id: int, duration: float, events: int) -> None:
+        '''
+        @duration: Через сколько секунд закончить профилирование
+        @events: После скольких обработанных событий закончить профилирование
+        '''
+        self.game_id = game_id
+        self.events_left = events
+        self.started_at = time.time()
+        self.profile = cProfile.Profile()
+        self.path: str | None = None
+        '''Куда записан профиль, после его окончания'''
+        self._enabled = False
+        self._timer = asyncio.get_running_loop().call_later(duration, self.finish)
+
+    def __enter__(self) -> 'GameProfile':
+        global _active
+        if _active is None:
+            _active = self.profile
+            self._enabled = True
+            self.profile.enable()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        global _active
+        if self._enabled:
+            self.profile.disable()
+            self._enabled = False
+            _active = None
+
+    def event(self) -> None:
+        '''Отмечает обработанное событие игры'''
+        self.events_left -= 1
+        if self.events_left <= 0:
+            self.finish()
+
+    def finish(self) -> str:
+        '''Заканчивает профилирование и записывает профиль. Возвращает путь к файлу'''
+        if self.path is None:
+            self._timer.cancel()
+            if game_profiles.get(self.game_id) is self:
+                del game_profiles[self.game_id]
+            self.path = _profile_path(f'game-{self.game_id}')
+            self.profile.dump_stats(self.path)
+        return self.path
+
+
+class _NotProfiled:
+    '''Заменяет `GameProfile` для игр, которые не профилируются'''
+
+    def __enter__(self) -> '_NotProfiled':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+    def event(self) -> None:
+        pass
+
+
+_NOT_PROFILED = _NotProfiled()
+
+game_profiles: dict[int, GameProfile] = {}
+'''Профилируемые игры по их идентификаторам'''
+
+
+def for_game(game_id: int) -> GameProfile | _NotProfiled:
+    '''
+    Контекстный менеджер, профилирующий участок кода, если игра профилируется.
+    Для остальных игр это только поиск в словаре
+
+    ### Пример
+    ```
+    with profiling.for_game(game_id) as profile:
+        events = handle_player(game, event)
+    profile.event()
+    ```
+    '''
+    return game_profiles.get(game_id, _NOT_PROFILED)
+
+
+def _is_admin(key: str | None) -> bool:
+    return PROFILE_KEY is not None and key is not None and \
+        hmac.compare_digest(key.encode(), PROFILE_KEY.encode())
+
+
+def admin(x_overboard_admin: Annotated[str | None, Header()] = None) -> None:
+    if PROFILE_KEY is None:
+        raise HTTPException(404, 'Profiling is disabled')
+    if not _is_admin(x_overboard_admin):
+        raise HTTPException(403, 'Wrong admin key')
+
+
+router = APIRouter(tags=['Profiling'], prefix='/profiling', dependencies=[Depends(admin)],
+                   include_in_schema=False)
+
+
+@router.get('/games')
+async def active_profiles() -> dict[int, dict]:
+    '''Профилируемые в этом процессе игры'''
+    return {
+        game_id: {'started_at': profile.started_at, 'events_left': profile.events_left}
+        for game_id, profile in game_profiles.items()
+    }
+
+
+@router.post('/games/{game_id}')
+async def start_game_profile(
+    game_id: int,
+    duration: Annotated[float, Query(gt=0, le=3600)] = 60,
+    events: Annotated[int, Query(gt=0)] = 1000
+) -> dict:
+    '''Начинает профилирование игры в этом процессе'''
+    if game_id in game_profiles:
+        raise HTTPException(409, f'Game {game_id} is already being profiled')
+    game_profiles[game_id] = GameProfile(game_id, duration, events)
+    return {}
+
+
+@router.delete('/games/{game_id}')
+async def stop_game_profile(game_id: int) -> dict:
+    '''Заканчивает профилирование игры и возвращает путь к профилю'''
+    profile = game_profiles.get(game_id)
+    if profile is None:
+        raise HTTPException(404, f'Game {game_id} is not being profiled')
+    return {'path': profile.finish()}
+
+
+class ProfileRequests:
+    '''
+    ASGI middleware, профилирующий REST-запросы с заголовком `X-Overboard-Profile`.
+    Путь к профилю возвращается в заголовке ответа `X-Overboard-Profile-Path`.
+    Остальные запросы и вебсокеты передаются приложению как есть
+
+    #### Полностью профилируются только `async` пути: обычные пути выполняются в пуле потоков
+    '''
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        global _active
+        if PROFILE_KEY is None or scope['type'] != 'http' or _active is not None:
+            return await self.app(scope, receive, send)
+        key = dict(scope['headers']).get(b'x-overboard-profile')
+        if key is None or not _is_admin(key.decode('latin-1')):
+            return await self.app(scope, receive, send)
+
+        path = _profile_path('request' + scope['path'].replace('/', '-'))
+
+        async def send_with_path(message: dict) -> None:
+            if message['type'] == 'http.response.start':
+                headers = [*message.get('headers', []),
+                           (b'x-overboard-profile-path', path.encode())]
+                # Маршрутизатор к этому моменту записал найденный путь в `scope`
+                endpoint = scope.get('endpoint')
+                if endpoint is not None and not inspect.iscoroutinefunction(endpoint):
+                    headers.append((b'x-overboard-profile-partial', b'sync route ran in a thread'))
+                message = {**message, 'headers': headers}
+            await send(message)
+
+        profile = _active = cProfile.Profile()
+        profile.enable()
+        try:
+            await self.app(scope, receive, send_with_path)
+        finally:
+            profile.disable()
+            _active = None
+            profile.dump_stats(path)
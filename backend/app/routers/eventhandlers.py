@@ -3,15 +3,17 @@ from typing import Any, Callable, Union, get_origin, get_args
 from types import UnionType
 from inspect import signature, Signature
 import random
+import time
 
 from fastapi import APIRouter, HTTPException, Depends
 
-from ..databases import mongo_db as db
+from ..databases import mongo_db as db, run_db
+from ..metrics import handler_seconds, rejected_events
 from ..models import *
 
 
-def game_exists(game_id: int):
-    if db['games'].find_one({'id': game_id}) is None:
+async def game_exists(game_id: int):
+    if await run_db(db['games'].find_one, {'id': game_id}, {'_id': 1}, site='game_exists') is None:
         raise HTTPException(422, detail='No game with this id found')
 
 
@@ -29,7 +31,8 @@ class playerevent:
         Декоратор, маркирующий функцию как обработчик игрового события от игрока.
         Для каждого типа игрового события может быть только одна функция с этим декоратором
 
-        #### Функции с данным декоратором изменяют игру в базе данных
+        #### Функции с данным декоратором изменяют переданное им состояние игры.
+        Сохраняет изменения в базе данных вызывающий (см. `GameManager`)
 
         Функции с этим декоратором используются методом `handle_player` для обработки события
         того же типа
@@ -101,13 +104,20 @@ class playerevent:
         description=description,
         status_code=200
         )
-        def fastapi_route(game_id: int, event: self.event_type) -> dict:
-            # Такие post-запросы можно использовать, только если все игроки пользуются post-запросами
-            # и поллингом get_game (или как там называется функция), потому что ответные события в
-            # случае пост-запроса не высылаются
-            game = Game(**db['games'].find_one({'id': game_id}))
-            responses = self._handler(game, event)
-            game.save_changes(db['games'])
+        async def fastapi_route(game_id: int, event: self.event_type) -> dict:
+            # Событие обрабатывается так же, как пришедшее по вебсокету: над состоянием игры в
+            # памяти того процесса, который ею владеет, с рассылкой ответных событий
+            from ..websocket_connections import GameManager
+
+            manager = GameManager.get(game_id)
+            try:
+                await manager.submit(event, from_player=event.player_id)
+            except Exception as e:
+                rejected_events.inc('rest', type(e).__name__)
+                raise
+            if len(manager.connections) == 0:
+                # Игру загрузили только ради этого запроса
+                await manager.submit(None)
             return {}
 
     def __init__(self, handler: Callable[[Game, PlayerEvent], list[GameEvent] | None]) -> None:
@@ -123,34 +133,39 @@ class playerevent:
 
         playerevent.handlers[self.event_type.__name__] = self
 
-    def __call__(self, game_id: int, event: GameEvent) -> list[GameEvent] | None:
-        game = Game(**db['games'].find_one({'id': game_id}))
-        responses = self._handler(game, event)
-        game.save_changes(db['games'])
-        return responses
+    def __call__(self, game: Game, event: GameEvent) -> list[GameEvent] | None:
+        '''
+        Применяет обработчик к игре. Сохранением изменений в базе данных занимается вызывающий.
 
+        #### Обработчик должен проверять все условия до того, как изменить игру
+        '''
+        return self._handler(game, event)
 
-def handle_player(game_id: int, event: PlayerEvent) -> list[GameEvent]:
+
+connection_events: tuple[type[GameEvent], ...] = (GameSync, EventBatch)
+'''События, которые сервер присылает клиентам не в ответ на события игроков'''
+
+
+def handle_player(game: Game, event: PlayerEvent) -> list[GameEvent]:
     '''
     Автоматически подбирает и вызывает обработчик для игрового события игрока.
 
-    @game_id: Идентификатор игры, для которой предназначено событие
+    @game: Состояние игры, для которой предназначено событие. Изменяется обработчиком
 
     :returns: Ответное игровое событие, предназначенное игрокам или None
 
     :raises TypeError: Не найден обработчик для переданного типа игрового события
     '''
     if event.type in playerevent.handlers:
-        return playerevent.handlers[event.type](game_id, event)
+        start = time.perf_counter()
+        try:
+            return playerevent.handlers[event.type](game, event)
+        finally:
+            handler_seconds.observe(time.perf_counter() - start, event.type)
 
     raise TypeError(f'No event handler for {event.type} is available')
 
 
-def get_game(game_id: int) -> Game:
-    game_document = db['games'].find_one({'id': game_id})
-    return Game(**game_document)
-
-
 @playerevent
 def on_player_connect(game: Game, event: PlayerConnect) -> list[HostChange] | None:
     if event.player_id not in game.players:
@@ -265,7 +280,9 @@ def get_navigation(game: Game, event: NavigationRequest) -> list[NavigationsOffe
 
 @playerevent
 def save_navigation(game: Game, event: SaveNavigation) -> None:
-    if event.navigation in game.offered_navigations:
-        game.apply_event(event)
-    else:
-        raise HTTPException(400)
\ No newline at end of file
+    if game.active_player != event.player_id:
+        raise HTTPException(403, f"Client {event.player_id} cannot save navigation cards: " +
+                            "it is not his turn")
+    if event.navigation not in game.offered_navigations:
+        raise HTTPException(400, "Navigation card was not offered")
+    game.apply_event(event)
\ No newline at end of file
@@ -1,29 +1,76 @@
-from fastapi import APIRouter
+from hashlib import sha256
+import json
+
+from fastapi import APIRouter, Request, Response, HTTPException
 from pydantic import BaseModel
 from pydantic.schema import schema
 
-from .eventhandlers import playerevent
+from .eventhandlers import playerevent, connection_events
+from ..codecs import wire_keys
 from ..models import Game
 
 
 router = APIRouter(tags=["Schemas"], prefix="/schemas")
 
+CACHE_CONTROL = 'public, max-age=60'
+'''
+Схемы не меняются, пока работает сервер, но могут измениться после перезапуска.
+Устаревшая схема перепроверяется по ETag
+'''
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+'''Для версий схем: содержимое версии не меняется никогда'''
+
+
+class CachedSchema:
+    '''Схема, закодированная в JSON один раз при запуске сервера'''
+
+    def __init__(self, content: dict) -> None:
+        self.content = content
+        self.body = json.dumps(content, separators=(',', ':'), ensure_ascii=False).encode()
+        self.etag = '"' + sha256(self.body).hexdigest()[:32] + '"'
+        '''Сильный ETag, который меняется вместе с содержимым схемы'''
+
+    def response(self, request: Request, cache_control: str = CACHE_CONTROL) -> Response:
+        '''Ответ со схемой или `304 Not Modified`, если у клиента уже есть эта версия'''
+        headers = {'ETag': self.etag, 'Cache-Control': cache_control}
+        if self.matches(request.headers.get('if-none-match')):
+            return Response(status_code=304, headers=headers)
+        return Response(self.body, media_type='application/json', headers=headers)
+
+    def matches(self, if_none_match: str | None) -> bool:
+        '''Совпадает ли ETag с одним из перечисленных в заголовке `If-None-Match`'''
+        if if_none_match is None:
+            return False
+        for etag in if_none_match.split(','):
+            etag = etag.strip().removeprefix('W/')
+            if etag == '*' or etag == self.etag:
+                return True
+        return False
+
+
+model_schemas: dict[str, CachedSchema] = {}
+'''Схемы отдельных событий, где ключ - путь к схеме'''
+
 
 def add_schema_route(model: type[BaseModel]):
     '''Создаёт endpoint для получения схемы модели'''
+    path = model.__name__.lower()
+    cached = model_schemas[path] = CachedSchema(model.schema())
+
     @router.get(
-        '/' + model.__name__.lower(),
+        '/' + path,
         name=f'Get {model.__name__} schema'
     )
-    def fastapi_doc_route() -> dict:
-        return model.schema()
+    def fastapi_doc_route(request: Request) -> dict:
+        return cached.response(request)
 
 
 player_events = [playerevent.handlers[name].event_type for name in playerevent.handlers]
 for event in player_events:
     add_schema_route(event)
 
-server_events: set[type[BaseModel]] = set()
+server_events: set[type[BaseModel]] = set(connection_events)
 for name in playerevent.handlers:
     server_events = server_events.union(set(playerevent.handlers[name].response_events))
 for event in server_events:
@@ -36,18 +83,79 @@ class EventSchemas(BaseModel):
     definitions: dict
 
 
+def _event_schemas(events) -> dict:
+    schemas = schema(events)['definitions']
+    return EventSchemas(definitions=schemas, event_names=[e.__name__ for e in events]).dict()
+
+
+player_events_schema = CachedSchema(_event_schemas(player_events))
+# Порядок событий не должен зависеть от процесса, иначе у разных процессов будут разные ETag
+server_events_schema = CachedSchema(
+    _event_schemas(sorted(server_events, key=lambda event: event.__name__)))
+game_schema_cached = CachedSchema(Game.schema())
+wire_keys_cached = CachedSchema(wire_keys)
+
+bundle = CachedSchema({
+    'playerevents': player_events_schema.content,
+    'serverevents': server_events_schema.content,
+    'game': game_schema_cached.content,
+    'wirekeys': wire_keys_cached.content,
+    'models': {path: model_schemas[path].content for path in sorted(model_schemas)},
+})
+'''Все схемы одним ответом. Версия набора - его ETag'''
+bundle_version = bundle.etag.strip('"')
+
+
 @router.get('/playerevents')
-def player_events_schemas() -> EventSchemas:
-    schemas = schema(player_events)['definitions']
-    return EventSchemas(definitions=schemas, event_names=[e.__name__ for e in player_events])
+def player_events_schemas(request: Request) -> EventSchemas:
+    return player_events_schema.response(request)
 
 
 @router.get('/serverevents')
-def server_events_schemas() -> EventSchemas:
-    schemas = schema(server_events)['definitions']
-    return EventSchemas(definitions=schemas, event_names=[e.__name__ for e in server_events])
+def server_events_schemas(request: Request) -> EventSchemas:
+    return server_events_schema.response(request)
 
 
 @router.get('/game')
-def game_schema() -> dict:
-    return Game.schema()
\ No newline at end of file
+def game_schema(request: Request) -> dict:
+    return game_schema_cached.response(request)
+
+
+@router.get('/wirekeys')
+def wire_keys_table(request: Request) -> list[str]:
+    '''
+    Названия полей, которые в формате вебсокета `overboard.msgpack.keys` передаются
+    своими номерами в этом списке
+    '''
+    return wire_keys_cached.response(request)
+
+
+class BundleVersion(BaseModel):
+    version: str
+
+
+@router.get('/bundle/version')
+def schemas_bundle_version() -> BundleVersion:
+    '''Текущая версия набора всех схем'''
+    return BundleVersion(version=bundle_version)
+
+
+@router.get('/bundle')
+def schemas_bundle(request: Request) -> dict:
+    '''
+    Все схемы одним запросом: `playerevents`, `serverevents`, `game` и схемы отдельных событий
+    в `models`. Версия набора передаётся в заголовке `ETag`
+    '''
+    return bundle.response(request)
+
+
+@router.get('/bundle/{version}')
+def schemas_bundle_versioned(version: str, request: Request) -> dict:
+    '''
+    Набор всех схем определённой версии. Его можно кэшировать навсегда
+
+    @version: Версия из `/schemas/bundle/version`
+    '''
+    if version != bundle_version:
+        raise HTTPException(404, detail=f'Schemas bundle {version} is not available')
+    return bundle.response(request, IMMUTABLE_CACHE_CONTROL)
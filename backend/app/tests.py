@@ -0,0 +1,542 @@
+'''
+Тесты сервера: брокера, менеджера игр и путей FastAPI. Тесты моделей - в `models.tests`.
+
+База данных подменяется заменителем MongoDB в памяти из `benchmarks.fakemongo`
+'''
+
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from functools import partial
+from typing import Awaitable
+from unittest.mock import patch
+
+from fastapi import FastAPI, HTTPException, WebSocketDisconnect
+from fastapi.testclient import TestClient
+from pymongo.errors import AutoReconnect
+
+from benchmarks.fakemongo import FakeDatabase
+
+from . import codecs, eventlog, game_ids, metrics, profiling, websocket_connections
+from .broker import IPCBroker, LocalBroker
+from .routers import schemas
+from .models import (Game, GamePhase, NameChange, NavigationRequest, PlayerConnect, SaveNavigation,
+                     StartRequest, TakeSupply)
+from .utils import Token
+from .websocket_connections import Connection, DurabilityMode, GameManager, OverflowPolicy
+
+
+class FakeWebSocket:
+    '''Вебсокет клиента в формате JSON. Отправленные клиенту сообщения попадают в `sent`'''
+
+    def __init__(self) -> None:
+        self.scope = {'subprotocols': []}
+        self.sent: asyncio.Queue[dict] = asyncio.Queue()
+        self.closed = False
+        self._incoming: asyncio.Queue[dict] = asyncio.Queue()
+
+    async def accept(self, subprotocol: str | None = None) -> None:
+        pass
+
+    async def send_text(self, text: str) -> None:
+        self.sent.put_nowait(json.loads(text))
+
+    async def receive(self) -> dict:
+        return await self._incoming.get()
+
+    async def receive_json(self) -> dict:
+        message = await self.receive()
+        if message['type'] == 'websocket.disconnect':
+            raise WebSocketDisconnect()
+        return json.loads(message['text'])
+
+    async def close(self, reason: str | None = None) -> None:
+        self.closed = True
+
+    def send_from_client(self, event: dict) -> None:
+        self._incoming.put_nowait({'type': 'websocket.receive', 'text': json.dumps(event)})
+
+    def disconnect(self) -> None:
+        self._incoming.put_nowait({'type': 'websocket.disconnect'})
+
+    async def next(self) -> dict:
+        '''Следующее сообщение, отправленное клиенту'''
+        return await asyncio.wait_for(self.sent.get(), 5)
+
+
+class GameTestCase(unittest.IsolatedAsyncioTestCase):
+    '''Тест, которому нужна база данных. Каждый тест получает новую пустую базу данных'''
+
+    modules = (websocket_connections, eventlog)
+    '''Модули, в которых подменяется база данных'''
+
+    def setUp(self) -> None:
+        self.db = FakeDatabase()
+        self._databases = [(module, module.db) for module in self.modules]
+        for module in self.modules:
+            module.db = self.db
+
+    def tearDown(self) -> None:
+        for module, db in self._databases:
+            module.db = db
+
+    def create_game(self, game_id: int) -> None:
+        self.db['games'].insert_one(Game(id=game_id).dict())
+
+    def manager(self, game_id: int, broker=None) -> GameManager:
+        '''Менеджер игры, не добавленный в `GameManager.managed_games`'''
+        manager = GameManager(game_id)
+        manager.broker = broker if broker is not None else LocalBroker()
+        manager.write_retry_delay = 0
+        return manager
+
+    async def written(self, manager: GameManager) -> None:
+        '''Ждёт, пока завершатся фоновые записи менеджера, в том числе повторные'''
+        while len(manager._writes) > 0:
+            await asyncio.gather(*manager._writes, return_exceptions=True)
+
+    async def rejected(self, submit: Awaitable, exception: type[Exception]) -> Exception:
+        '''
+        Ждёт, что событие будет отклонено, и возвращает исключение.
+
+        `assertRaises` очищает кадры трассировки исключения, а в ней есть кадр задачи, которая
+        выполняет очередь игры. Очистка кадра завершила бы эту задачу
+        '''
+        try:
+            await submit
+        except exception as e:
+            return e
+        self.fail(f'{exception.__name__} not raised')
+
+    def stored_game(self, game_id: int) -> Game:
+        return Game(**self.db['games'].find_one({'id': game_id}))
+
+    def connect(self, manager: GameManager, token: str,
+                last_seq: int | None = None) -> tuple[FakeWebSocket, asyncio.Task]:
+        '''Подключает вебсокет клиента. Задача завершается, когда клиент отключится'''
+        websocket = FakeWebSocket()
+        token = Token(token)
+        return websocket, asyncio.create_task(
+            manager.add(websocket, token.hash(), last_seq, token=token))
+
+    async def start_game(self, manager: GameManager, tokens: str) -> dict[str, str]:
+        '''
+        Подключает игроков с токенами из `tokens` и начинает игру
+
+        :returns: Токены игроков по их идентификаторам
+        '''
+        for token in tokens:
+            await manager.submit(PlayerConnect(client_token=token))
+        await manager.submit(StartRequest(client_token=tokens[0]))
+        await self.written(manager)
+        return {Token(token).hash(): token for token in tokens}
+
+
+class TestIPCBroker(GameTestCase):
+
+    async def asyncSetUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        path = os.path.join(self.dir.name, 'broker.sock')
+        # Первый брокер поднимает посредника, второй подключается к нему
+        self.owner = IPCBroker(path)
+        await self.owner.start()
+        self.other = IPCBroker(path)
+        await self.other.start()
+
+    async def asyncTearDown(self) -> None:
+        await self.other.stop()
+        await self.owner.stop()
+        # Посредник замечает закрытые соединения на следующих итерациях цикла событий
+        await asyncio.sleep(0.01)
+        self.dir.cleanup()
+
+    async def test_submit_through_owner(self):
+        self.create_game(1)
+        owner, other = self.manager(1, self.owner), self.manager(1, self.other)
+        await owner.submit(PlayerConnect(client_token='a'))
+        await other.submit(NameChange(client_token='a', new_name='name'))
+
+        self.assertFalse(other._owner)
+        self.assertEqual(owner.game.players[Token('a').hash()].name, 'name')
+
+    async def test_handler_error_is_replied(self):
+        self.create_game(1)
+        owner, other = self.manager(1, self.owner), self.manager(1, self.other)
+        await owner.submit(PlayerConnect(client_token='a'))
+
+        # Игрок 'b' не входил в игру, обработчик владельца падает с KeyError
+        error = await self.rejected(
+            asyncio.wait_for(other.submit(NameChange(client_token='b', new_name='name')), 5),
+            HTTPException)
+        self.assertEqual(error.status_code, 500)
+
+    async def test_server_error_is_replied(self):
+        async def server(message: dict) -> dict:
+            raise ValueError('broken')
+
+        await self.owner.claim(1, server, lambda: None)
+        with self.assertLogs('app.broker', 'ERROR'):
+            reply = await asyncio.wait_for(self.other.request(1, {}), 5)
+        self.assertEqual(reply['status'], 500)
+
+    async def test_request_timeout(self):
+        async def server(message: dict) -> dict:
+            await asyncio.Event().wait()
+
+        await self.owner.claim(1, server, lambda: None)
+        self.other.request_timeout = 0.1
+        with self.assertRaises(TimeoutError):
+            await self.other.request(1, {})
+        self.assertEqual(self.other._pending, {})
+
+
+class TestWriteBehind(GameTestCase):
+
+    async def test_retry_after_lost_ack(self):
+        self.create_game(1)
+        manager = self.manager(1)
+        tokens = await self.start_game(manager, 'ab')
+
+        # Запись применяется, но ответ базы данных теряется
+        collection = self.db['games']
+        bulk_write = collection.bulk_write
+
+        def applied_then_lost(requests, **kwargs):
+            collection.bulk_write = bulk_write
+            bulk_write(requests, **kwargs)
+            raise AutoReconnect('connection lost')
+        collection.bulk_write = applied_then_lost
+
+        game = manager.game
+        with self.assertLogs(websocket_connections.logger, 'ERROR'):
+            await manager.submit(TakeSupply(client_token=tokens[game.active_player],
+                                            supply=game.supply_stash[0]))
+            await self.written(manager)
+
+        self.assertEqual(manager._updates, [])
+        self.assertEqual(self.stored_game(1), manager.game)
+
+    async def test_failed_handler_is_not_saved(self):
+        self.create_game(1)
+        manager = self.manager(1)
+        await manager.submit(PlayerConnect(client_token='a'))
+
+        def broken(game: Game, event: NameChange):
+            game.host = 'nobody'
+            raise KeyError('player')
+
+        with patch.object(websocket_connections, 'handle_player', broken):
+            await self.rejected(manager.submit(NameChange(client_token='a', new_name='broken')),
+                                KeyError)
+        await manager.submit(NameChange(client_token='a', new_name='name'))
+        await self.written(manager)
+
+        self.assertEqual(manager.game.host, Token('a').hash())
+        self.assertEqual(self.stored_game(1), manager.game)
+
+    async def test_save_navigation_from_stranger(self):
+        self.create_game(1)
+        manager = self.manager(1)
+        tokens = await self.start_game(manager, 'ab')
+        game = manager.game
+        while game.phase != GamePhase.Day:
+            await manager.submit(TakeSupply(client_token=tokens[game.active_player],
+                                            supply=game.supply_stash[0]))
+        await manager.submit(NavigationRequest(client_token=tokens[game.active_player]))
+
+        await self.rejected(manager.submit(SaveNavigation(
+            client_token='c', navigation=game.offered_navigations[0])), HTTPException)
+        await self.written(manager)
+
+        self.assertEqual(len(manager.game.offered_navigations), 2)
+        self.assertEqual(manager.game.navigation_stash, [])
+        self.assertEqual(self.stored_game(1), manager.game)
+
+
+class TestWebSocket(GameTestCase):
+
+    async def test_events_are_broadcast(self):
+        self.create_game(1)
+        manager = self.manager(1)
+        host, hosting = self.connect(manager, 'a')
+        player, playing = self.connect(manager, 'b')
+
+        # Отправитель получает только ответные события, остальные - и само событие
+        host.send_from_client({'type': 'PlayerConnect', 'client_token': 'a'})
+        self.assertEqual((await host.next())['type'], 'HostChange')
+        self.assertEqual([(await player.next())['type'] for _ in range(2)],
+                         ['PlayerConnect', 'HostChange'])
+        player.send_from_client({'type': 'PlayerConnect', 'client_token': 'b'})
+        event = await host.next()
+        self.assertEqual(event['type'], 'PlayerConnect')
+        self.assertEqual(event['player_id'], Token('b').hash())
+        self.assertEqual(event['seq'], 3)
+
+        player.disconnect()
+        host.disconnect()
+        await asyncio.wait_for(asyncio.gather(hosting, playing), 5)
+        await self.written(manager)
+        self.assertIsNone(manager.game)
+        self.assertEqual(len(self.stored_game(1).players), 2)
+
+
+class TestResume(GameTestCase):
+
+    async def rename(self, manager: GameManager, times: int) -> None:
+        for i in range(times):
+            await manager.submit(NameChange(client_token='b', new_name=f'name {i}'))
+
+    async def test_replays_missed_events(self):
+        self.create_game(1)
+        manager = self.manager(1)
+        await self.start_game(manager, 'ab')
+        last_seq = manager.game.seq
+        await self.rename(manager, 3)
+
+        websocket, connected = self.connect(manager, 'a', last_seq)
+        for seq in range(last_seq + 1, last_seq + 4):
+            event = await websocket.next()
+            self.assertEqual(event['type'], 'NameChange')
+            self.assertEqual(event['seq'], seq)
+        websocket.disconnect()
+        await asyncio.wait_for(connected, 5)
+        self.assertTrue(websocket.sent.empty())
+
+    async def test_resync_when_client_is_ahead(self):
+        self.create_game(1)
+        manager = self.manager(1)
+        await self.start_game(manager, 'ab')
+
+        websocket, connected = self.connect(manager, 'a', manager.game.seq + 5)
+        sync = await websocket.next()
+        self.assertEqual(sync['type'], 'GameSync')
+        self.assertEqual(sync['seq'], manager.game.seq)
+        websocket.disconnect()
+        await asyncio.wait_for(connected, 5)
+
+    async def test_history_miss_loads_event_log(self):
+        self.create_game(1)
+        manager = self.manager(1)
+        manager.durability = DurabilityMode.PhaseChange
+        await self.start_game(manager, 'ab')
+        last_seq = manager.game.seq
+        await self.rename(manager, 3)
+        await self.written(manager)
+        # После начала игры документ не записывался, переименования есть только в журнале
+        self.assertEqual(self.stored_game(1).seq, last_seq)
+
+        # У нового менеджера нет истории рассылок
+        restarted = self.manager(1)
+        websocket, connected = self.connect(restarted, 'a', last_seq)
+        sync = await websocket.next()
+        self.assertEqual(sync['type'], 'GameSync')
+        self.assertEqual(sync['seq'], last_seq + 3)
+        self.assertEqual(sync['game']['players'][Token('b').hash()]['name'], 'name 2')
+        websocket.disconnect()
+        await asyncio.wait_for(connected, 5)
+
+
+class TestSpectators(GameTestCase):
+
+    async def test_masked_view(self):
+        self.create_game(1)
+        manager = self.manager(1)
+        tokens = await self.start_game(manager, 'ab')
+        game = manager.game
+
+        websocket = FakeWebSocket()
+        # Игра уже загружена, поэтому наблюдатель подключается мимо очереди игры
+        with patch.object(manager, '_run', side_effect=AssertionError('spectator used the queue')):
+            watching = asyncio.create_task(manager.spectate(websocket))
+            sync = await websocket.next()
+        self.assertEqual(sync['type'], 'GameSync')
+        self.assertEqual(sync['seq'], game.seq)
+        self.assertTrue(sync['game']['observed'])
+        self.assertEqual(sync['game']['supply_stash'], [{}] * len(game.supply_stash))
+        for player in sync['game']['players'].values():
+            self.assertEqual(player['supplies'], [{}])
+
+        await manager.submit(TakeSupply(client_token=tokens[game.active_player],
+                                        supply=game.supply_stash[0]))
+        event = await websocket.next()
+        self.assertEqual(event['type'], 'TakeSupply')
+        self.assertEqual(event['seq'], sync['seq'] + 1)
+        self.assertEqual(event['supply'], {})
+
+        websocket.disconnect()
+        await asyncio.wait_for(watching, 5)
+        self.assertEqual(manager.spectators, set())
+
+
+class TestSlowClients(GameTestCase):
+
+    async def test_background_error_is_logged(self):
+        async def broken() -> None:
+            raise ValueError('broken')
+
+        manager = self.manager(1)
+        with self.assertLogs(websocket_connections.logger, 'ERROR'):
+            manager._in_background(broken())
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+        self.assertEqual(GameManager._background, set())
+
+    async def test_overflow_disconnects(self):
+        manager = self.manager(1)
+        manager.overflow_policy = OverflowPolicy.Disconnect
+        websocket = FakeWebSocket()
+        connection = Connection(websocket, 2, partial(manager._overflow, 'player'))
+        observed = sum(metrics.outbound_high_water._counts.get((), []))
+
+        for text in ('1', '2', '3'):
+            connection.send(text)
+        self.assertEqual(len(GameManager._background), 1)
+        await asyncio.gather(*GameManager._background)
+        await asyncio.sleep(0)
+
+        self.assertTrue(websocket.closed)
+        self.assertEqual(GameManager._background, set())
+        self.assertEqual(connection.overflows, 1)
+        self.assertEqual(sum(metrics.outbound_high_water._counts[()]), observed + 1)
+
+
+class TestGameIds(GameTestCase):
+
+    modules = (game_ids,)
+
+    def test_permute_is_bijection(self):
+        ids = sorted(game_ids.permute(index, 12345) for index in range(game_ids.SPACE))
+        self.assertEqual(ids, list(range(game_ids.SPACE)))
+
+    async def test_skips_ids_in_use(self):
+        key = 12345
+        self.db['counters'].insert_one({'_id': 'game_ids', 'next': 0, 'key': key})
+        ids = [game_ids.ID_MIN + game_ids.permute(index, key) for index in range(6)]
+        for game_id in ids[:2] + ids[3:5]:
+            self.create_game(game_id)
+
+        allocator = game_ids.GameIdAllocator()
+        allocator.lease_size = 3
+        self.assertEqual([await allocator.allocate(), await allocator.allocate()],
+                         [ids[2], ids[5]])
+
+
+class TestWireKeys(unittest.TestCase):
+
+    def setUp(self) -> None:
+        game = Game(id=1)
+        game.apply_event(PlayerConnect(client_token='a'))
+        self.event = {'type': 'GameSync', 'seq': 3, 'game': game.dict(),
+                      'unknown_key': {'1': [{'name': 'value'}]}}
+
+    def test_intern_extern(self):
+        interned = codecs._intern(self.event)
+        self.assertIn(codecs._key_numbers['type'], interned)
+        self.assertIn('unknown_key', interned)
+        self.assertEqual(codecs._extern(interned), self.event)
+
+    @unittest.skipIf(codecs.msgpack is None, 'msgpack is not installed')
+    def test_msgpack_keys_codec(self):
+        codec = codecs.codecs['overboard.msgpack.keys']
+        message = codec.encode(self.event)
+        self.assertLess(len(message), len(codecs.codecs['overboard.msgpack'].encode(self.event)))
+        self.assertEqual(codec.decode(message), self.event)
+
+
+class TestSchemas(unittest.TestCase):
+
+    def setUp(self) -> None:
+        app = FastAPI()
+        app.include_router(schemas.router)
+        self.client = TestClient(app)
+
+    def test_not_modified(self):
+        response = self.client.get('/schemas/game')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['cache-control'], schemas.CACHE_CONTROL)
+        etag = response.headers['etag']
+
+        for if_none_match in (etag, f'W/{etag}', f'"other", {etag}', '*'):
+            response = self.client.get('/schemas/game', headers={'If-None-Match': if_none_match})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.content, b'')
+            self.assertEqual(response.headers['etag'], etag)
+
+        response = self.client.get('/schemas/game', headers={'If-None-Match': '"other"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), Game.schema())
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('test_size', 'Test', ('kind',), buckets=(1, 10))
+        self.addCleanup(metrics.registry.remove, histogram)
+        for value in (0, 5, 50):
+            histogram.observe(value, 'a')
+
+        rendered = metrics.render()
+        self.assertIn('# TYPE test_size histogram\n', rendered)
+        self.assertIn('test_size_bucket{kind="a",le="1"} 1\n', rendered)
+        self.assertIn('test_size_bucket{kind="a",le="10"} 2\n', rendered)
+        self.assertIn('test_size_bucket{kind="a",le="+Inf"} 3\n', rendered)
+        self.assertIn('test_size_sum{kind="a"} 55\n', rendered)
+        self.assertIn('test_size_count{kind="a"} 3\n', rendered)
+
+    def test_gauges_and_counters(self):
+        rendered = metrics.render()
+        self.assertIn('# TYPE overboard_game_managers gauge\n', rendered)
+        self.assertIn(f'overboard_game_managers {len(GameManager.managed_games)}\n', rendered)
+        # Счётчики без меток видны до первого увеличения
+        self.assertRegex(rendered, r'\noverboard_outbound_overflows_total \d+\n')
+
+    def test_queue_depth(self):
+        managers = [GameManager(game_id) for game_id in (1, 2)]
+        for depth, manager in zip((2, 3), managers):
+            for _ in range(depth):
+                manager._inbox.put_nowait((None, None))
+        with patch.dict(GameManager.managed_games, {1: managers[0], 2: managers[1]}, clear=True):
+            rendered = metrics.render()
+        self.assertIn('\noverboard_game_queue_depth 5\n', rendered)
+        self.assertIn('\noverboard_game_queue_depth_max 3\n', rendered)
+
+
+class TestProfiling(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        for name, value in (('PROFILE_KEY', 'key'), ('PROFILE_DIR', self.dir.name)):
+            patcher = patch.object(profiling, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        app = FastAPI()
+        app.include_router(profiling.router)
+        self.client = TestClient(app)
+
+    def test_admin_key(self):
+        self.assertEqual(self.client.get('/profiling/games').status_code, 403)
+        response = self.client.get('/profiling/games', headers={'X-Overboard-Admin': 'wrong'})
+        self.assertEqual(response.status_code, 403)
+        with patch.object(profiling, 'PROFILE_KEY', None):
+            response = self.client.get('/profiling/games', headers={'X-Overboard-Admin': 'key'})
+            self.assertEqual(response.status_code, 404)
+
+    def test_game_profile(self):
+        admin = {'X-Overboard-Admin': 'key'}
+        self.assertEqual(self.client.post('/profiling/games/1', headers=admin).status_code, 200)
+        self.assertEqual(self.client.post('/profiling/games/1', headers=admin).status_code, 409)
+        self.assertEqual(list(self.client.get('/profiling/games', headers=admin).json()), ['1'])
+
+        with profiling.for_game(1):
+            sum(range(1000))
+        with profiling.for_game(2) as profile:
+            self.assertIs(profile, profiling._NOT_PROFILED)
+
+        path = self.client.delete('/profiling/games/1', headers=admin).json()['path']
+        self.assertTrue(path.startswith(self.dir.name))
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(profiling.game_profiles, {})
+        self.assertEqual(self.client.delete('/profiling/games/1', headers=admin).status_code, 404)
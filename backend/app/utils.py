@@ -8,7 +8,10 @@ class PlayerId(str):
 
 class Token(str):
     '''Уникальный токен клиента, аутентифицирующий его (подтверждающий его "личность")'''
-    
+
+    _player_id: PlayerId | None = None
+    '''Результат `hash`. Токен соединения хэшируется один раз за всё соединение'''
+
     def hash(self) -> PlayerId:
         '''
         Хэширует токен-идентификатор клиента, доступный только самому клиенту,
@@ -24,4 +27,6 @@ class Token(str):
         Поэтому клиент передаёт свой токен, известный
         только ему, который сервер сверяет с идентификатором игрока (после хэширования)
         '''
-        return hash_string(self)
\ No newline at end of file
+        if self._player_id is None:
+            self._player_id = hash_string(self)
+        return self._player_id
@@ -1,33 +1,324 @@
 import asyncio
-from typing import Awaitable, Annotated
+from collections import OrderedDict, deque
+import logging
+import time
+from enum import Enum
+from functools import partial
+from typing import Awaitable, Annotated, Callable
 
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Query, HTTPException
 from pydantic import ValidationError
+from pymongo import UpdateOne
 
-from .databases import mongo_db as db
+from .broadcast import Broadcast, BroadcastBatch
+from .broker import Broker, broker
+from .codecs import Codec, JSON, negotiate
+from .databases import mongo_db as db, run_db
+from . import eventlog, profiling
+from .metrics import (Gauge, broadcast_fanout, outbound_high_water, outbound_overflows,
+                      rejected_events)
 from .models import *
 from .routers.eventhandlers import handle_player
 from .utils import Token
 
 router = APIRouter(tags=['Websocket Connection'])
 
+logger = logging.getLogger(__name__)
+
+
+class _NotOwner(Exception):
+    '''Процесс перестал владеть игрой, пока задача ждала в очереди'''
+
+
+def _to_wire(message: dict) -> dict:
+    '''Запрос к владельцу игры в виде, который можно передать в другой процесс'''
+    event = message.get('event')
+    if isinstance(event, PlayerEvent):
+        # Токен не входит в `dict()` события, но без него событие не восстановить
+        return {**message, 'event': {**event.dict(), 'client_token': event.client_token}}
+    return message
+
+
+SPECTATOR_ID = ''
+'''
+Идентификатор, под которым наблюдатели получают рассылки. Не совпадает ни с одним игроком,
+поэтому наблюдатели получают события с точки зрения наблюдателя
+'''
+
+
+class DurabilityMode(str, Enum):
+    '''Определяет, когда изменения игры из памяти записываются в базу данных'''
+    EveryEvent = 'every_event'
+    '''Изменения записываются после каждого обработанного события'''
+    Interval = 'interval'
+    '''Изменения копятся и записываются не чаще, чем раз в `GameManager.flush_interval` секунд'''
+    PhaseChange = 'phase_change'
+    '''Изменения записываются только при смене фазы игры'''
+
+
+class OverflowPolicy(str, Enum):
+    '''Что делать, если клиент не успевает получать события и его очередь переполнилась'''
+    Resync = 'resync'
+    '''Неотправленные события выбрасываются, а клиенту присылается полное состояние игры (`GameSync`)'''
+    Disconnect = 'disconnect'
+    '''Соединение разрывается'''
+
+
+class Connection:
+    '''
+    Вебсокет игрока со своей очередью исходящих сообщений.
+
+    Сообщения отправляет отдельная задача, поэтому рассылка события не ждёт, пока его получат
+    все клиенты, и клиент с медленным соединением не задерживает обработку событий игры
+    '''
+
+    def __init__(self, websocket: WebSocket, limit: int,
+                 on_overflow: Callable[['Connection'], None], codec: Codec = JSON,
+                 batches: bool = False, token: Token | None = None) -> None:
+        '''
+        @limit: Сколько сообщений может ждать отправки
+        @on_overflow: Вызывается вместо добавления сообщения в заполненную очередь
+        @codec: Формат сообщений, выбранный клиентом
+        @batches: Клиент принимает пакеты событий `EventBatch`
+        @token: Токен, с которым клиент подключился. Уже знает идентификатор игрока
+        '''
+        self.websocket = websocket
+        self.codec = codec
+        self.batches = batches
+        self.token = token
+        self.limit = limit
+        self.high_water = 0
+        '''Наибольшее количество сообщений, ждавших отправки, за всё время соединения'''
+        self.overflows = 0
+        '''Сколько раз очередь переполнялась'''
+        self.closed = False
+
+        self._queue: deque[str | bytes] = deque()
+        self._ready = asyncio.Event()
+        self._on_overflow = on_overflow
+        self._writer = asyncio.create_task(self._write())
+
+    @property
+    def queued(self) -> int:
+        '''Сколько сообщений ждёт отправки'''
+        return len(self._queue)
+
+    def send(self, payload: str | bytes, force: bool = False) -> None:
+        '''
+        Ставит сообщение в очередь на отправку, не дожидаясь её
+
+        @force: Добавить сообщение, даже если очередь заполнена
+        '''
+        if self.closed:
+            return
+        if not force and len(self._queue) >= self.limit:
+            self.overflows += 1
+            outbound_overflows.inc()
+            self._on_overflow(self)
+            return
+        self._queue.append(payload)
+        self.high_water = max(self.high_water, len(self._queue))
+        self._ready.set()
+
+    def send_broadcast(self, player_id: str, broadcast: Broadcast | BroadcastBatch,
+                       force: bool = False) -> bool:
+        '''
+        Ставит в очередь то, что игрок `player_id` получает из рассылки. Если клиент не принимает
+        пакеты, события пакета ставятся в очередь по отдельности
+
+        :returns: Получает ли игрок хотя бы одно событие рассылки
+        '''
+        if isinstance(broadcast, BroadcastBatch) and not self.batches:
+            sent = False
+            for item in broadcast.broadcasts:
+                sent = self.send_broadcast(player_id, item, force) or sent
+            return sent
+        payload = broadcast.payload_for(player_id, self.codec)
+        if payload is None:
+            return False
+        self.send(payload, force)
+        return True
+
+    def clear(self) -> None:
+        '''Выбрасывает неотправленные сообщения'''
+        self._queue.clear()
+
+    async def _write(self) -> None:
+        try:
+            while True:
+                await self._ready.wait()
+                while len(self._queue) > 0:
+                    payload = self._queue.popleft()
+                    try:
+                        if isinstance(payload, bytes):
+                            await self.websocket.send_bytes(payload)
+                        else:
+                            await self.websocket.send_text(payload)
+                    except Exception:
+                        # Соединение уже разорвано, это заметит `GameManager._handle_socket`
+                        self.closed = True
+                        return
+                self._ready.clear()
+        finally:
+            # Соединение больше ничего не отправит
+            outbound_high_water.observe(self.high_water)
+
+    def stop(self) -> None:
+        '''Перестаёт отправлять сообщения'''
+        self.closed = True
+        self._writer.cancel()
+
+    async def close(self, reason: str | None = None) -> None:
+        '''Перестаёт отправлять сообщения и закрывает вебсокет'''
+        self.stop()
+        try:
+            await self.websocket.close(reason=reason)
+        except RuntimeError:
+            pass  # Вебсокет уже закрыт
+
 
 class GameManager:
-    '''Менеджер соединений для игры'''
+    '''
+    Менеджер соединений для игры.
+
+    Пока к игре подключён хотя бы один вебсокет, менеджер хранит состояние игры в памяти и
+    обрабатывает события над ним, а изменения записывает в базу данных в фоне в зависимости от
+    `durability`. Когда отключается последний вебсокет, изменения сохраняются,
+    а состояние игры выгружается из памяти.
+
+    Обработанные события сразу же в фоне дописываются в журнал игры (см. `eventlog`), поэтому
+    изменения, не успевшие попасть в документ игры, восстанавливаются при следующей загрузке.
+
+    События от всех вебсокетов игры попадают в одну очередь и обрабатываются по одному,
+    поэтому обработчики одной игры никогда не выполняются одновременно. Разные игры
+    обрабатываются независимо друг от друга.
+
+    Если сервер запущен в несколько процессов, у каждого процесса свой менеджер игры, а
+    состояние игры хранит только один из них - владелец (см. `broker`). Остальные пересылают
+    события своих игроков владельцу, а разосланные им события - своим вебсокетам.
+    '''
+
+    broker: Broker = broker
+    '''Через что менеджеры игры в разных процессах обмениваются событиями'''
+
+    queue_size: int = 64
+    '''
+    Сколько событий может ждать обработки в очереди игры.
+    Если очередь заполнена, вебсокеты игры ждут, пока в ней не освободится место
+    '''
+
+    durability: DurabilityMode = DurabilityMode.EveryEvent
+    '''Когда записывать изменения игры в базу данных'''
+
+    flush_interval: float = 1.0
+    '''Через сколько секунд после изменения игры оно записывается в режиме `DurabilityMode.Interval`'''
+
+    snapshot_every: int = 100
+    '''Через сколько событий в журнал записывается полное состояние игры'''
+
+    outbound_size: int = 256
+    '''Сколько сообщений может ждать отправки одному клиенту'''
+
+    overflow_policy: OverflowPolicy = OverflowPolicy.Resync
+    '''Что делать с клиентом, очередь сообщений которого переполнилась'''
+
+    history_size: int = 256
+    '''
+    Сколько последних событий хранится в памяти, чтобы дослать их переподключившемуся клиенту.
+    Если клиент пропустил больше, ему присылается полное состояние игры
+    '''
+
+    idle_ttl: float = 300.0
+    '''
+    Через сколько секунд простоя менеджер удаляется из `managed_games`. Простаивает менеджер,
+    к игре которого никто не подключён и которая выгружена из памяти
+    '''
+
+    max_managed_games: int = 10000
+    '''
+    Сколько менеджеров может храниться в `managed_games`. При превышении удаляются
+    простаивающие менеджеры, начиная с тех, которые дольше всего не использовались
+    '''
+
+    sweep_interval: float = 60.0
+    '''Как часто в секундах `sweep_forever` ищет простаивающих менеджеров'''
+
+    write_retry_delay: float = 1.0
+    '''Через сколько секунд повторить запись в базу данных, которая не удалась в фоне'''
 
     # Ну как бы вне класса managed_games не должен меняться, но мне кажется, что
     # делать обёртку и проперти, копирующий внутренний словарь это слишком дорогостояще.
     # Думаю и так понятно, что менять его не стоит
-    managed_games: dict[int, 'GameManager'] = {}
+    managed_games: OrderedDict[int, 'GameManager'] = OrderedDict()
     '''
     Словарь всех созданных менеджеров соединений через метод `GameManager.create`,
-    где идентификатор игры - это ключ
+    где идентификатор игры - это ключ. Менеджеры упорядочены от давно использованных
+    к недавно использованным
+    '''
+
+    _background: set[asyncio.Task] = set()
+    '''
+    Задачи, запущенные менеджерами без ожидания: закрытие медленных соединений, досылка им
+    состояния игры, отписка от брокера. Цикл событий хранит только слабые ссылки на задачи,
+    поэтому они хранятся здесь, пока не завершатся, даже если менеджер уже удалён
+    из `managed_games`
     '''
 
     def __init__(self, game_id: int) -> None:
         '''Менеджер соединений, связанных с игрой с идентификатором `game_id`'''
         self.game_id = game_id
-        self.websockets: dict[str, WebSocket] = {}
+        self.connections: dict[str, Connection] = {}
+        '''Соединения с игроками этого процесса, где ключ - идентификатор игрока'''
+        self.spectators: set[Connection] = set()
+        '''Соединения с наблюдателями этого процесса, которым уже прислано состояние игры'''
+
+        self.game: Game | None = None
+        '''Состояние игры в памяти. `None`, если к игре никто не подключён'''
+        self._updates: list[tuple[int, dict]] = []
+        '''
+        Ещё не записанные запросы `update_one` к документу игры, по одному на событие,
+        с порядковым номером игры после события
+        '''
+        self._log_entries: list[dict] = []
+        '''Ещё не записанные записи журнала'''
+        self._snapshot: dict | None = None
+        '''Ещё не записанный снимок игры'''
+        self._flush_lock = asyncio.Lock()
+        self._log_lock = asyncio.Lock()
+        self._flush_task: asyncio.Task | None = None
+        self._writes: set[asyncio.Task] = set()
+        '''Фоновые записи в базу данных. Ссылки на задачи хранятся, пока они не завершатся'''
+        self._retry_task: asyncio.Task | None = None
+
+        self._inbox: asyncio.Queue[tuple[Callable[[], Awaitable], asyncio.Future]] = \
+            asyncio.Queue(self.queue_size)
+        '''
+        Очередь задач, ждущих выполнения: обработка событий, выгрузка игры, подключение
+        вебсокетов с досылкой пропущенных событий
+        '''
+        self._consumer: asyncio.Task | None = None
+
+        self._history: deque[Broadcast] = deque(maxlen=self.history_size)
+        '''Последние разосланные события'''
+
+        self._owner = False
+        '''Владеет ли этот процесс состоянием игры'''
+        self._subscribed = False
+        self._resuming: dict[str, list[Broadcast]] = {}
+        '''События, отложенные для игроков, которым сейчас досылаются пропущенные события'''
+        self._joining: dict[Connection, list[Broadcast]] = {}
+        '''События, отложенные для наблюдателей, которым сейчас присылается состояние игры'''
+        self._spectator_sync: tuple[Game, Broadcast] | None = None
+        '''Последнее вычисленное состояние игры для наблюдателей и `GameSync` с ним'''
+
+        self._last_used = time.monotonic()
+        self._users = 0
+        '''Сколько вебсокетов и запросов сейчас пользуются менеджером'''
+
+    @property
+    def queue_depth(self) -> int:
+        '''Сколько событий сейчас ждёт обработки'''
+        return self._inbox.qsize()
 
     @staticmethod
     def create(game_id: int) -> 'GameManager':
@@ -40,36 +331,659 @@ class GameManager:
 
         manager = GameManager(game_id)
         GameManager.managed_games[game_id] = manager
+        GameManager._evict_overflow()
         return manager
 
+    @staticmethod
+    def get(game_id: int) -> 'GameManager':
+        '''Возвращает менеджера соединений игры, создавая его при необходимости'''
+        manager = GameManager.managed_games.get(game_id)
+        if manager is None:
+            manager = GameManager.create(game_id)
+        return manager
+
+    @property
+    def idle(self) -> bool:
+        '''Можно ли удалить менеджера: им никто не пользуется, и игра выгружена из памяти'''
+        return (self._users == 0 and len(self.connections) == 0 and self.game is None
+                and not self._owner)
+
+    def _use(self) -> None:
+        '''Отмечает менеджера как используемого: он не удаляется, пока не вызван `_leave`'''
+        self._users += 1
+        self._touch()
+
+    def _leave(self) -> None:
+        self._users -= 1
+        self._touch()
+
+    def _touch(self) -> None:
+        self._last_used = time.monotonic()
+        if GameManager.managed_games.get(self.game_id) is self:
+            GameManager.managed_games.move_to_end(self.game_id)
 
-    async def add(self, websocket: WebSocket, player_id: str) -> Awaitable[None]:
+    def _evict(self) -> None:
+        '''Удаляет простаивающего менеджера из `managed_games` и отписывает его от брокера'''
+        if GameManager.managed_games.get(self.game_id) is self:
+            del GameManager.managed_games[self.game_id]
+        if self._consumer is not None:
+            self._consumer.cancel()
+            self._consumer = None
+        if self._subscribed:
+            self._subscribed = False
+            self._in_background(self.broker.unsubscribe(self.game_id, self._deliver))
+
+    @staticmethod
+    def _evict_overflow() -> None:
+        '''Удаляет давно не использованных простаивающих менеджеров сверх `max_managed_games`'''
+        managers = GameManager.managed_games
+        if len(managers) <= GameManager.max_managed_games:
+            return
+        for manager in list(managers.values()):
+            if len(managers) <= GameManager.max_managed_games:
+                break
+            if manager.idle:
+                manager._evict()
+
+    @staticmethod
+    def sweep() -> int:
+        '''
+        Удаляет менеджеров, простаивающих дольше `idle_ttl`
+
+        :returns: Сколько менеджеров удалено
+        '''
+        deadline = time.monotonic() - GameManager.idle_ttl
+        evicted = 0
+        for manager in list(GameManager.managed_games.values()):
+            if manager._last_used > deadline:
+                break  # Дальше только менеджеры, использованные ещё позже
+            if manager.idle:
+                manager._evict()
+                evicted += 1
+        return evicted
+
+    @staticmethod
+    async def sweep_forever() -> None:
+        '''Раз в `sweep_interval` секунд удаляет простаивающих менеджеров'''
+        while True:
+            await asyncio.sleep(GameManager.sweep_interval)
+            GameManager.sweep()
+
+
+    async def add(self, websocket: WebSocket, player_id: str,
+                  last_seq: int | None = None, batches: bool = False,
+                  token: Token | None = None) -> Awaitable[None]:
         '''
         Устанавливает по переданному вебсокету соединение с клиентом с идентификатором `player_id.
         Разрывает предыдущее соединение, если оно было.
 
+        @last_seq: Порядковый номер последнего события, полученного клиентом. Если передан,
+        клиенту досылаются все события после него (или полное состояние игры, если пропущено
+        слишком много)
+        @batches: Присылать события, вызванные одним событием игрока, одним пакетом `EventBatch`
+        @token: Токен клиента, из которого получен `player_id`. События с этим токеном не хэшируют
+        его заново
+
         :returns: Awaitable, который завершается при отключении соединения.
         #### Если не ждать этот метод, соединение сразу прервётся
         '''
-        await websocket.accept()
-        if player_id in self.websockets:
-            reason = "Client made a new websocket connection"
-            await self.websockets[player_id].close(reason=reason)
+        # Пока соединение открыто, менеджера нельзя удалить
+        self._use()
+        try:
+            codec, subprotocol = negotiate(websocket.scope.get('subprotocols', []))
+            await websocket.accept(subprotocol=subprotocol)
+            if player_id in self.connections:
+                reason = "Client made a new websocket connection"
+                await self.connections[player_id].close(reason=reason)
+
+            await self._subscribe()
+            connection = Connection(websocket, self.outbound_size,
+                                    partial(self._overflow, player_id), codec, batches, token)
+            self.connections[player_id] = connection
+            if last_seq is not None:
+                try:
+                    await self._catch_up(player_id, connection, {
+                        'kind': 'resume', 'player_id': player_id, 'last_seq': last_seq})
+                except HTTPException as e:
+                    self._discard(player_id, connection)
+                    await connection.close(reason=str(e))
+                    raise e
+            await self._handle_socket(player_id)
+        finally:
+            self._leave()
+
+    async def _catch_up(self, player_id: str, connection: Connection, message: dict) -> None:
+        '''
+        Досылает клиенту события, полученные запросом `resume` или `sync` к владельцу игры
+        '''
+        # Пока ответ не получен, новые события для игрока откладываются, чтобы между
+        # досланными событиями и новыми не потерялось и не задвоилось ни одно событие
+        pending = self._resuming[player_id] = []
+        try:
+            reply = await self._call(message)
+            broadcasts = reply['broadcasts'] + [
+                broadcast for broadcast in pending
+                if broadcast.seq is None or broadcast.seq > reply['seq']
+            ]
+            if len(broadcasts) > 1:
+                # Клиент, принимающий пакеты, получит всё пропущенное одним сообщением
+                connection.send_broadcast(player_id, BroadcastBatch(broadcasts), force=True)
+            elif len(broadcasts) == 1:
+                connection.send_broadcast(player_id, broadcasts[0], force=True)
+        finally:
+            if self._resuming.get(player_id) is pending:
+                del self._resuming[player_id]
+
+    async def spectate(self, websocket: WebSocket, batches: bool = False) -> None:
+        '''
+        Подключает наблюдателя: присылает ему состояние игры и затем все события игры с точки
+        зрения наблюдателя. Сообщения от наблюдателя не обрабатываются.
+
+        Каждое событие кодируется для наблюдателей один раз на формат, а не для каждого из них
+
+        @batches: Присылать события, вызванные одним событием игрока, одним пакетом `EventBatch`
+
+        :returns: Завершается при отключении наблюдателя
+        '''
+        self._use()
+        try:
+            codec, subprotocol = negotiate(websocket.scope.get('subprotocols', []))
+            await websocket.accept(subprotocol=subprotocol)
+            await self._subscribe()
+            connection = Connection(websocket, self.outbound_size, self._spectator_overflow,
+                                    codec, batches)
+            try:
+                await self._join(connection)
+            except HTTPException as e:
+                await connection.close(reason=str(e))
+                raise e
+
+            while (await websocket.receive())['type'] != 'websocket.disconnect':
+                pass
+            connection.stop()
+            self.spectators.discard(connection)
+            if len(self.spectators) == 0 and len(self.connections) == 0:
+                # Игру загрузили только для наблюдателей. Пока к игре кто-то подключён,
+                # наблюдатели не ставят задач в очередь игры
+                await self.submit(None)
+        finally:
+            self._leave()
+
+    async def _join(self, connection: Connection) -> None:
+        '''Присылает наблюдателю состояние игры и добавляет его к остальным наблюдателям'''
+        pending = self._joining[connection] = []
+        try:
+            reply = await self._call({'kind': 'spectate'})
+            # Если игра загружена в этом процессе, ответ получен сразу, а рассылки событий до
+            # `reply['seq']` могут ещё ждать в цикле событий (см. `_deliver`). Они попадут в
+            # `pending` и будут отброшены, а не присланы наблюдателю после `GameSync`
+            await asyncio.sleep(0)
+            broadcasts = reply['broadcasts'] + [
+                broadcast for broadcast in pending
+                if broadcast.seq is None or broadcast.seq > reply['seq']
+            ]
+            if len(broadcasts) > 1:
+                connection.send_broadcast(SPECTATOR_ID, BroadcastBatch(broadcasts), force=True)
+            else:
+                connection.send_broadcast(SPECTATOR_ID, broadcasts[0], force=True)
+            if not connection.closed:
+                self.spectators.add(connection)
+        finally:
+            del self._joining[connection]
+
+    def _spectator_overflow(self, connection: Connection) -> None:
+        '''Наблюдатель не успевает получать события: поступает с ним согласно `overflow_policy`'''
+        # Вызывается во время рассылки, поэтому множество наблюдателей меняется позже
+        if self.overflow_policy == OverflowPolicy.Disconnect:
+            self._in_background(connection.close(reason='Client is too slow to receive events'))
+            return
+
+        connection.clear()
+        self._in_background(self._rejoin(connection))
+
+    async def _rejoin(self, connection: Connection) -> None:
+        '''Присылает наблюдателю полное состояние игры вместо выброшенных событий'''
+        if connection not in self.spectators:
+            return
+        self.spectators.discard(connection)
+        self._use()
+        try:
+            await self._join(connection)
+        except HTTPException:
+            await connection.close(reason='Could not resync the client')
+        finally:
+            self._leave()
+
+    def _overflow(self, player_id: str, connection: Connection) -> None:
+        '''Клиент не успевает получать события: поступает с ним согласно `overflow_policy`'''
+        if self.overflow_policy == OverflowPolicy.Disconnect:
+            self._in_background(connection.close(reason='Client is too slow to receive events'))
+            return
+
+        connection.clear()
+        if player_id not in self._resuming:
+            self._in_background(self._resync(player_id, connection))
+
+    async def _resync(self, player_id: str, connection: Connection) -> None:
+        '''Присылает клиенту полное состояние игры вместо выброшенных событий'''
+        if self.connections.get(player_id) is not connection:
+            return
+        self._use()
+        try:
+            await self._catch_up(player_id, connection, {'kind': 'sync', 'player_id': player_id})
+        except HTTPException:
+            await connection.close(reason='Could not resync the client')
+        finally:
+            self._leave()
+
+    def outbound_stats(self) -> dict[str, dict[str, int]]:
+        '''Длина очереди, её наибольшая длина и количество переполнений для каждого соединения'''
+        return {
+            player_id: {
+                'queued': connection.queued,
+                'high_water': connection.high_water,
+                'overflows': connection.overflows,
+            }
+            for player_id, connection in self.connections.items()
+        }
+
+    async def _replay(self, player_id: str, last_seq: int) -> tuple[int, list[Broadcast]]:
+        '''
+        События, которые игрок пропустил после `last_seq`, или событие `GameSync`,
+        если их уже нет в памяти.
+
+        #### Вызывается только из очереди игры
+
+        :returns: Порядковый номер последнего события игры и рассылки для игрока
+        '''
+        if not self._owner:
+            raise _NotOwner()
+        game = await self._load_game()
+        if last_seq == game.seq:
+            return game.seq, []
+        if last_seq > game.seq:
+            # Клиент видел события, которых у игры нет: это была другая игра с тем же
+            # идентификатором или потерянное состояние. Его состояние нужно заменить целиком
+            return await self._sync(player_id)
+
+        history = self._history
+        # История должна быть без пропусков и доходить до текущего состояния игры
+        if (len(history) > 0 and history[0].seq <= last_seq + 1 and history[-1].seq == game.seq
+                and history[-1].seq - history[0].seq == len(history) - 1):
+            return game.seq, [broadcast for broadcast in history if broadcast.seq > last_seq]
+        return await self._sync(player_id)
+
+    async def _sync(self, player_id: str) -> tuple[int, list[Broadcast]]:
+        '''
+        Событие `GameSync` с текущим состоянием игры с точки зрения игрока.
+
+        #### Вызывается только из очереди игры
+        '''
+        if not self._owner:
+            raise _NotOwner()
+        game = await self._load_game()
+        if player_id in game.players:
+            view = Game.with_player_view(game, player_id)
+        else:
+            view = Game.with_spectator_view(game)  # Клиент подключился, но ещё не вошёл в игру
+        sync = GameSync(targets=[player_id], game=view)
+        sync.seq = game.seq
+        return game.seq, [Broadcast(sync)]
+
+    async def _spectate(self) -> tuple[int, list[Broadcast]]:
+        '''
+        Событие `GameSync` с текущим состоянием игры с точки зрения наблюдателя.
+
+        #### Вызывается только из очереди игры
+        '''
+        if not self._owner:
+            raise _NotOwner()
+        game = await self._load_game()
+        return game.seq, [self._spectator_broadcast(game)]
+
+    def _spectator_broadcast(self, game: Game) -> Broadcast:
+        '''
+        `GameSync` для наблюдателей. Вычисляется один раз для каждого состояния игры, поэтому
+        все наблюдатели, подключившиеся между событиями, получают одно и то же сообщение
+        '''
+        if self._spectator_sync is None or self._spectator_sync[1].seq != game.seq:
+            view = Game.with_spectator_view(game)
+            sync = GameSync(targets=[SPECTATOR_ID], game=view)
+            sync.seq = game.seq
+            self._spectator_sync = view, Broadcast(sync)
+        return self._spectator_sync[1]
+
+    def spectator_view(self) -> Game | None:
+        '''
+        Игра с точки зрения наблюдателя, если она загружена в память этого процесса, иначе `None`
+        '''
+        if self.game is None:
+            return None
+        self._spectator_broadcast(self.game)
+        return self._spectator_sync[0]
+
+    async def _subscribe(self) -> None:
+        '''Начинает получать рассылки игры из всех процессов'''
+        if not self._subscribed:
+            self._subscribed = True
+            await self.broker.subscribe(self.game_id, self._deliver)
+
+    async def _claim(self) -> bool:
+        '''Пытается стать владельцем игры, если ещё им не является'''
+        if not self._owner:
+            self._owner = await self.broker.claim(self.game_id, self._serve, self._lost)
+        return self._owner
+
+    def _lost(self) -> None:
+        '''Игрой завладел другой процесс, пока этот был отключён от брокера'''
+        self._owner = False
+        self.game = None
+        self._updates.clear()
+        self._log_entries.clear()
+        self._snapshot = None
+        self._history.clear()
+        self._spectator_sync = None
+
+    async def _call(self, message: dict) -> dict:
+        '''
+        Выполняет запрос к владельцу игры: в этом процессе, если он владеет игрой или смог ею
+        завладеть, иначе - через брокер
+
+        :raises HTTPException: Владелец не смог выполнить запрос
+        '''
+        while True:
+            if await self._claim():
+                try:
+                    return await self._execute(message)
+                except _NotOwner:
+                    continue
+
+            reply = await self.broker.request(self.game_id, _to_wire(message))
+            if reply is None:
+                continue  # У игры больше нет владельца, пробуем завладеть ею сами
+            if 'error' in reply:
+                raise HTTPException(reply['status'], reply['error'])
+            if 'broadcasts' in reply:
+                reply['broadcasts'] = [Broadcast.from_message(message)
+                                       for message in reply['broadcasts']]
+            return reply
+
+    async def _execute(self, message: dict) -> dict:
+        '''Выполняет запрос к владельцу игры в этом процессе'''
+        if not self._owner:
+            raise _NotOwner()
+
+        kind = message['kind']
+        if kind == 'submit':
+            event = message['event']
+            if isinstance(event, dict):
+                event = PlayerEvent.from_dict(event)
+            await self._run(partial(self.process, event, message['from_player']))
+            return {}
+        if kind == 'resume':
+            seq, broadcasts = await self._run(
+                partial(self._replay, message['player_id'], message['last_seq']))
+            return {'seq': seq, 'broadcasts': broadcasts}
+        if kind == 'sync':
+            seq, broadcasts = await self._run(partial(self._sync, message['player_id']))
+            return {'seq': seq, 'broadcasts': broadcasts}
+        if kind == 'spectate':
+            if self.game is not None:
+                # Обработчики меняют игру, ничего не ожидая, поэтому вне очереди она всегда в
+                # состоянии после последнего события. Наблюдатели не ждут в очереди за игроками
+                return {'seq': self.game.seq, 'broadcasts': [self._spectator_broadcast(self.game)]}
+            seq, broadcasts = await self._run(self._spectate)
+            return {'seq': seq, 'broadcasts': broadcasts}
+        if kind == 'document':
+            return {'game': self.game.dict() if self.game is not None else None}
+        raise ValueError(f'Unknown request {kind}')
+
+    async def _serve(self, message: dict) -> dict | None:
+        '''Отвечает на запрос, пришедший через брокер (см. `broker.Server`)'''
+        try:
+            reply = await self._execute(message)
+        except _NotOwner:
+            return None
+        except HTTPException as e:
+            return {'error': e.detail, 'status': e.status_code}
+        except (AttributeError, TypeError, ValidationError) as e:
+            return {'error': str(e), 'status': 400}
+        except Exception as e:
+            # Спросивший процесс ждёт ответа, поэтому любая ошибка обработчика или базы данных
+            # передаётся ему, как если бы она произошла в нём самом
+            return {'error': f'{type(e).__name__}: {e}', 'status': 500}
+
+        if 'broadcasts' in reply:
+            reply['broadcasts'] = [broadcast.to_message() for broadcast in reply['broadcasts']]
+        return reply
+
+    async def _load_game(self) -> Game:
+        '''Загружает игру из базы данных в память, если она ещё не загружена'''
+        if self.game is None:
+            if len(self._updates) > 0 or len(self._log_entries) > 0 or self._snapshot is not None:
+                # Игру выгрузили, не записав изменения (см. `process`): без них она загрузилась бы
+                # из базы данных в старом состоянии
+                await self.flush()
+            game = await run_db(eventlog.load_game, self.game_id, site='load_game')
+            if game is None:
+                raise HTTPException(422, f'Cannot find a game with id {self.game_id}')
+            # Пока шёл запрос, игру мог загрузить обработчик другого вебсокета
+            if self.game is None:
+                self.game = game
+        return self.game
+
+    async def _write_log(self) -> None:
+        '''Дописывает в журнал накопленные события и снимок игры'''
+        async with self._log_lock:
+            entries, self._log_entries = self._log_entries, []
+            snapshot, self._snapshot = self._snapshot, None
+            try:
+                await run_db(eventlog.append, entries, site='flush.log')
+                if snapshot is not None:
+                    await run_db(eventlog.save_snapshot, snapshot, site='flush.snapshot')
+            except Exception:
+                self._log_entries[:0] = entries
+                self._snapshot = self._snapshot or snapshot
+                raise
+
+    async def flush(self) -> None:
+        '''Записывает в базу данных изменения игры и события, накопленные в памяти'''
+        await self._write_log()
+        async with self._flush_lock:
+            # Запросы собираются в цикле событий при обработке каждого события,
+            # а в отдельном потоке выполняется только их запись одним пакетом
+            updates, self._updates = self._updates, []
+            if len(updates) == 0:
+                return
+            # `$push`/`$pop`/`$pull` нельзя применять дважды, а после сбоя неизвестно, какие из
+            # запросов уже применены. Каждый запрос сдвигает `seq` документа, поэтому применяется
+            # только к документу, который ещё не дошёл до его `seq` (или старому, без `seq`)
+            requests = [UpdateOne({'id': self.game_id, 'seq': {'$not': {'$gte': seq}}}, update)
+                        for seq, update in updates]
+            try:
+                await run_db(db['games'].bulk_write, requests, site='flush.game')
+            except Exception:
+                self._updates[:0] = updates
+                raise
+
+    async def _delayed_flush(self) -> None:
+        await asyncio.sleep(self.flush_interval)
+        self._flush_task = None
+        await self.flush()
+
+    def _in_background(self, coroutine: Awaitable[None]) -> None:
+        '''Запускает задачу, которую никто не ждёт. Ошибка задачи записывается в лог'''
+        task = asyncio.create_task(coroutine)
+        GameManager._background.add(task)
+        task.add_done_callback(self._background_done)
+
+    def _background_done(self, task: asyncio.Task) -> None:
+        GameManager._background.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Background task of game %s failed', self.game_id,
+                         exc_info=task.exception())
+
+    def _write_in_background(self, write: Awaitable[None]) -> asyncio.Task:
+        '''
+        Запускает запись в базу данных в фоне. Если запись не удалась, ошибка записывается в лог,
+        а запись повторяется через `write_retry_delay` секунд: не записанные изменения и события
+        остаются в памяти менеджера
+        '''
+        task = asyncio.create_task(write)
+        self._writes.add(task)
+        task.add_done_callback(self._write_done)
+        return task
+
+    def _write_done(self, task: asyncio.Task) -> None:
+        self._writes.discard(task)
+        if task.cancelled() or task.exception() is None:
+            return
+        logger.error('Could not write game %s to the database', self.game_id,
+                     exc_info=task.exception())
+        if self._retry_task is None:
+            self._retry_task = self._write_in_background(self._retry_write())
+
+    async def _retry_write(self) -> None:
+        await asyncio.sleep(self.write_retry_delay)
+        self._retry_task = None
+        await self.flush()
+
+    def _schedule_flush(self, phase_before: GamePhase) -> None:
+        '''Планирует запись изменений игры в соответствии с `durability`'''
+        if self.durability == DurabilityMode.EveryEvent:
+            self._write_in_background(self.flush())
+            return
+
+        self._write_in_background(self._write_log())
+        if self.durability == DurabilityMode.Interval:
+            if self._flush_task is None:
+                self._flush_task = self._write_in_background(self._delayed_flush())
+        elif self.durability == DurabilityMode.PhaseChange:
+            if self.game.phase != phase_before:
+                self._write_in_background(self.flush())
+
+    async def _release_game(self) -> None:
+        '''
+        Сохраняет и выгружает игру из памяти, если к ней больше никто не подключён,
+        и отказывается от владения игрой
+        '''
+        if len(self.connections) != 0 or not self._owner:
+            return
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+        self.game = None
+        # Пока игрой владеет другой процесс, история здесь не пополняется. Если процесс снова
+        # завладеет игрой, в старой истории был бы пропуск
+        self._history.clear()
+        self._spectator_sync = None
+        # Игра сохранена целиком, следующий владелец загрузит её из базы данных
+        self._owner = False
+        await self.broker.release(self.game_id, self._serve)
+
+    async def submit(self, event: PlayerEvent | None, from_player: str | None = None) -> None:
+        '''
+        Ставит событие игрока в очередь игры и ждёт, пока оно не будет обработано.
+        Если игрой владеет другой процесс, событие обрабатывается там.
+
+        @event: Событие игрока. `None`, чтобы сохранить и выгрузить игру из памяти, если к ней
+        никто не подключён
+        @from_player: Идентификатор игрока, от которого было получено событие
+
+        :raises: Исключение, которое вызвал обработчик события
+        '''
+        self._use()
+        try:
+            await self._subscribe()
+            if event is None:
+                if self._owner:
+                    await self._run(self._release_game)
+            else:
+                await self._call({'kind': 'submit', 'event': event, 'from_player': from_player})
+        finally:
+            self._leave()
+
+    async def _run(self, job: Callable[[], Awaitable]):
+        '''Ставит задачу в очередь игры, ждёт её выполнения и возвращает её результат'''
+        if self._consumer is None or self._consumer.done():
+            self._consumer = asyncio.create_task(self._consume())
+
+        processed = asyncio.get_running_loop().create_future()
+        await self._inbox.put((job, processed))
+        return await processed
+
+    async def _consume(self) -> None:
+        '''Выполняет задачи из очереди игры по одной'''
+        while True:
+            job, processed = await self._inbox.get()
+            try:
+                result = await job()
+            except Exception as e:
+                if not processed.done():
+                    processed.set_exception(e)
+            else:
+                if not processed.done():
+                    processed.set_result(result)
+            finally:
+                self._inbox.task_done()
+
+    async def process(self, event: PlayerEvent, from_player: str | None = None) -> None:
+        '''
+        Обрабатывает событие игрока над игрой в памяти и рассылает его и ответные события.
+
+        #### Вызывается только из очереди игры, в остальных случаях нужно использовать `submit`
+
+        @from_player: Идентификатор игрока, от которого было получено событие
+        '''
+        if not self._owner:
+            raise _NotOwner()
+        game = await self._load_game()
+        phase_before = game.phase
+
+        # Сначала обрабатываем событие, чтобы не пересылать событие,
+        # которое оказалось неверным
+        with profiling.for_game(self.game_id) as profile:
+            try:
+                response_events = handle_player(game, event) or []
+            except Exception:
+                if game.has_changes:
+                    # Обработчик изменил игру и упал. Отменить изменения нельзя, поэтому игра
+                    # выгружается и при следующем событии загружается из базы данных и журнала
+                    self.game = None
+                raise
 
-        self.websockets[player_id] = websocket
-        await self._handle_socket(player_id)
+            entries, update = eventlog.record(game, [event, *response_events])
+            self._log_entries.extend(entries)
+            if len(update) > 0:
+                self._updates.append((game.seq, update))
+            if game.seq // self.snapshot_every != (game.seq - len(entries)) // self.snapshot_every:
+                self._snapshot = game.dict()
+            self._schedule_flush(phase_before)
+
+            broadcasts = [Broadcast(event, from_player)]
+            broadcasts.extend(Broadcast(response_event) for response_event in response_events)
+            self._history.extend(broadcasts)
+        profile.event()
+
+        # Рассылаем событие и ответные события сервера всем, кому нужно, во всех процессах.
+        # Все они рассылаются вместе, чтобы каждый клиент мог получить их одним сообщением
+        if len(broadcasts) == 1:
+            await self.broker.publish(self.game_id, broadcasts[0])
+        else:
+            await self.broker.publish(self.game_id, BroadcastBatch(broadcasts))
 
     async def close_all(self, reason: str | None = None):
         '''Закрывает все соединения Менеджера'''
         coroutines = []
-        for player_id in self.websockets:
-            coroutines.append(self.websockets[player_id].close(reason=reason))
+        for player_id in self.connections:
+            coroutines.append(self.connections[player_id].close(reason=reason))
         await asyncio.gather(*coroutines)
-        self.websockets.clear()
+        self.connections.clear()
 
     async def send(self, event: GameEvent | ObservableEvent, from_player: str | None = None) -> None:
         '''
-        Отправляет игровое событие, всем, кому оно предназначено
+        Отправляет игровое событие всем, кому оно предназначено, во всех процессах
 
         Определяет, кому оно предназначено с помощью `event.targets`.
         Если это `Observable`, пересылает тем, кто указан в `event.targets` полное событие,
@@ -77,69 +991,131 @@ class GameManager:
 
         @from_player: Идентификатор игрока, от которого было изначально получено событие. `None`, если событие создано сервером
         '''
+        await self.broker.publish(self.game_id, Broadcast(event, from_player))
 
-        all_players = set(self.websockets.keys())
-
-        ids: set[str] = set()
-
-        if event.targets == EventTargets.All:
-            ids = all_players.copy()
-            ids.discard(from_player)
-        elif event.targets == EventTargets.Server:
-            pass  # Событие предназначалось только для сервера, никому пересылать не надо
-        else:
-            ids = set(event.targets)
-
-        coroutines = []
+    async def _deliver(self, broadcast: Broadcast | BroadcastBatch) -> None:
+        '''
+        Ставит рассылку в очереди соединений этого процесса. Не ждёт, пока клиенты её получат
+        '''
+        # Каждый вариант события кодируется в каждом формате один раз и одним и тем же
+        # сообщением отправляется всей своей аудитории
+        recipients = 0
+        with profiling.for_game(self.game_id):
+            for player_id, connection in self.connections.items():
+                if player_id in self._resuming:
+                    if isinstance(broadcast, BroadcastBatch):
+                        self._resuming[player_id].extend(broadcast.broadcasts)
+                    else:
+                        self._resuming[player_id].append(broadcast)
+                elif connection.send_broadcast(player_id, broadcast):
+                    recipients += 1
+        broadcast_fanout.observe(recipients, 'players')
 
-        for player_id in ids:
-            if player_id not in self.websockets:
-                continue  # Мало ли фейковых id переслали с событием
-            coroutines.append(self.websockets[player_id].send_json(event.dict()))
+        if len(self.spectators) > 0 or len(self._joining) > 0:
+            # Наблюдатели получают событие после игроков, когда обработчик события уже завершился
+            asyncio.get_running_loop().call_soon(self._deliver_spectators, broadcast)
 
-        if isinstance(event, ObservableEvent):
-            # Пересылаем событие наблюдателям
-            observers = all_players.difference(ids)
-            observers.discard(from_player)
-            for player_id in observers:
-                observed_event = event.observer_viewpoint()
-                coroutines.append(self.websockets[player_id].send_json(observed_event.dict()))
+    def _deliver_spectators(self, broadcast: Broadcast | BroadcastBatch) -> None:
+        '''Ставит рассылку в очереди наблюдателей этого процесса'''
+        for pending in self._joining.values():
+            if isinstance(broadcast, BroadcastBatch):
+                pending.extend(broadcast.broadcasts)
+            else:
+                pending.append(broadcast)
 
-        await asyncio.gather(*coroutines)
+        # Все наблюдатели получают один и тот же вариант события, поэтому сообщения
+        # собираются один раз для каждого формата
+        messages: dict[tuple[Codec, bool], list[str | bytes]] = {}
+        recipients = 0
+        for connection in self.spectators:
+            key = (connection.codec, connection.batches)
+            payloads = messages.get(key)
+            if payloads is None:
+                if isinstance(broadcast, BroadcastBatch) and not connection.batches:
+                    items = broadcast.broadcasts
+                else:
+                    items = [broadcast]
+                payloads = messages[key] = [
+                    payload for item in items
+                    if (payload := item.payload_for(SPECTATOR_ID, connection.codec)) is not None
+                ]
+            for payload in payloads:
+                connection.send(payload)
+            if len(payloads) > 0:
+                recipients += 1
+        broadcast_fanout.observe(recipients, 'spectators')
 
     async def _handle_socket(self, player_id: str):
         '''
         Обрабатывает соединение с вебсокетом, привязанного к `player_id`
         на момент вызова метода.
         '''
+        connection = self.connections[player_id]
+        websocket = connection.websocket
         while True:
             try:
-                json: dict = await self.websockets[player_id].receive_json()
-                event: PlayerEvent = PlayerEvent.from_dict(json)
+                json: dict = await connection.codec.receive(websocket)
+                with profiling.for_game(self.game_id):
+                    if connection.token is not None and json.get('client_token') == connection.token:
+                        # Подставляем токен соединения, чтобы не хэшировать его на каждое событие
+                        json['client_token'] = connection.token
+                    event: PlayerEvent = PlayerEvent.from_dict(json)
+                await self.submit(event, from_player=player_id)
+
+            except WebSocketDisconnect:
+                connection.stop()
+                self._discard(player_id, connection)
+                await self.submit(None)
+                break
+            except Exception as e:
+                # Любая ошибка события (неверный кадр, ошибка обработчика) закрывает соединение,
+                # иначе соединение и загруженная игра остались бы в менеджере навсегда
+                rejected_events.inc('websocket', type(e).__name__)
+                await connection.close(reason=str(e))
+                self._discard(player_id, connection)
+                await self.submit(None)
+                raise e
 
-                # Сначала обрабатываем событие, чтобы не пересылать событие,
-                # которое оказалось неверным
-                response_events = handle_player(self.game_id, event)
+    def _discard(self, player_id: str, connection: Connection) -> None:
+        '''Убирает соединение игрока, если его ещё не заменило новое соединение'''
+        if self.connections.get(player_id) is connection:
+            del self.connections[player_id]
 
-                # пересылаем событие всем, кому нужно
-                await self.send(event, from_player=player_id)
 
-                # Отсылаем ответные событие от сервера, если они есть
-                if response_events is not None:
-                    for event in response_events:
-                        await self.send(event)
+def _outbound_totals() -> int:
+    '''Сообщения, ждущие отправки, во всех соединениях процесса (см. `outbound_stats`)'''
+    queued = 0
+    for manager in GameManager.managed_games.values():
+        for stats in manager.outbound_stats().values():
+            queued += stats['queued']
+    return queued
 
-            except (AttributeError, TypeError, ValidationError, HTTPException) as e:
-                await self.websockets[player_id].close(reason=str(e))
-                del self.websockets[player_id]
-                raise e
-            except WebSocketDisconnect:
-                del self.websockets[player_id]
-                break
+
+Gauge('overboard_game_managers', 'Менеджеры игр в памяти процесса',
+      lambda: len(GameManager.managed_games))
+Gauge('overboard_loaded_games', 'Игры, загруженные в память процесса',
+      lambda: sum(manager.game is not None for manager in GameManager.managed_games.values()))
+Gauge('overboard_websockets', 'Открытые вебсокеты процесса',
+      lambda: sum(len(manager.connections) for manager in GameManager.managed_games.values()))
+Gauge('overboard_spectators', 'Наблюдатели, подключённые к процессу',
+      lambda: sum(len(manager.spectators) for manager in GameManager.managed_games.values()))
+Gauge('overboard_outbound_queued', 'Сообщения, ждущие отправки во всех соединениях процесса',
+      _outbound_totals)
+Gauge('overboard_game_queue_depth', 'Задачи, ждущие в очередях всех игр процесса',
+      lambda: sum(manager.queue_depth for manager in GameManager.managed_games.values()))
+Gauge('overboard_game_queue_depth_max', 'Самая длинная очередь задач игры в процессе',
+      lambda: max((manager.queue_depth for manager in GameManager.managed_games.values()),
+                  default=0))
 
 
 @router.websocket('/{game_id}')
-async def connect(game_id: int, websocket: WebSocket, token: Annotated[str, Query()]):
+async def connect(
+    game_id: int,
+    websocket: WebSocket,
+    token: Annotated[str, Query()],
+    last_seq: Annotated[int | None, Query()] = None,
+    batch: Annotated[bool, Query()] = False
+):
     '''
     Подключает вебсокет от игрока к серверу.
 
@@ -147,9 +1123,33 @@ async def connect(game_id: int, websocket: WebSocket, token: Annotated[str, Quer
     @token: Токен, определяющий клиента. При разрыве предыдущего
     вебсокета и создании нового с тем же токеном, сервер понимает, что новый вебсокет
     принадлежит тому же клиенту
+    @last_seq: Порядковый номер (`seq`) последнего события, полученного клиентом до разрыва
+    соединения. Сервер дошлёт все события после него или, если их уже нет в памяти,
+    событие `GameSync` с полным состоянием игры
+
+    Формат сообщений выбирается подпротоколом вебсокета: `overboard.json` (по умолчанию),
+    `overboard.msgpack` или `overboard.msgpack.keys` (см. `codecs`)
+
+    @batch: Присылать событие игрока и ответные события сервера одним сообщением `EventBatch`.
+    Клиент должен применить все события пакета сразу, по порядку
+    '''
+    manager = GameManager.get(game_id)
+    token = Token(token)
+    await manager.add(websocket, token.hash(), last_seq, batch, token)
+
+
+@router.websocket('/{game_id}/spectate')
+async def spectate(
+    game_id: int,
+    websocket: WebSocket,
+    batch: Annotated[bool, Query()] = False
+):
+    '''
+    Подключает вебсокет наблюдателя к игре. Токен не нужен: наблюдатель не участвует в игре и
+    не может отправлять события.
+
+    Сначала присылается событие `GameSync` с состоянием игры с точки зрения наблюдателя, затем -
+    все события игры с точки зрения наблюдателя. Формат сообщений и `batch` - как у `/{game_id}`
     '''
-    if game_id in GameManager.managed_games:
-        manager = GameManager.managed_games[game_id]
-    else:
-        manager = GameManager.create(game_id)
-    await manager.add(websocket, Token(token).hash())
\ No newline at end of file
+    manager = GameManager.get(game_id)
+    await manager.spectate(websocket, batch)
@@ -0,0 +1,4 @@
+'''
+Бенчмарки сервера. Запускаются из директории `backend` как модули, например
+`python -m benchmarks.event_loop`
+'''
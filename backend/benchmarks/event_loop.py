@@ -0,0 +1,112 @@
+'''
+Бенчмарк задержки обработки событий в зависимости от количества одновременных игр.
+
+Каждая игра с заданной частотой получает события от игроков, а база данных отвечает с
+задержкой `--db-latency`. Если запросы к базе данных блокируют цикл событий, p99 задержки
+растёт вместе с количеством игр; если выполняются в пуле потоков - остаётся на месте.
+
+Запуск: `python -m benchmarks.event_loop [--blocking]`
+'''
+
+import argparse
+import asyncio
+import statistics
+import time
+
+from app import websocket_connections, eventlog
+from app.broker import LocalBroker
+from app.models import Game, PlayerConnect, NameChange
+from app.websocket_connections import GameManager
+
+from .fakemongo import FakeDatabase
+
+
+async def _blocking_run_db(func, *args, site: str, **kwargs):
+    '''Выполняет запрос прямо в цикле событий, как это делалось до пула потоков'''
+    return func(*args, **kwargs)
+
+
+def percentile(values: list[float], percent: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+async def _play(manager: GameManager, players: int, interval: float, offset: float,
+                deadline: float, latencies: list[float]) -> None:
+    tokens = [f'{manager.game_id}-{i}' for i in range(players)]
+    events = [PlayerConnect(client_token=token) for token in tokens]
+    i = 0
+    # Игры начинают со сдвигом, чтобы события всех игр не приходили одной пачкой
+    scheduled = time.perf_counter() + offset
+    while scheduled < deadline:
+        if i >= len(events):
+            token = tokens[i % players]
+            events.append(NameChange(client_token=token, new_name=f'name {i}'))
+        await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+        await manager.submit(events[i])
+        # Задержка считается от запланированного времени события, чтобы в неё попадало и
+        # время, которое событие ждало занятый цикл событий
+        latencies.append(time.perf_counter() - scheduled)
+        i += 1
+        scheduled += interval
+
+
+async def _measure_lag(deadline: float, lags: list[float]) -> None:
+    '''Насколько позже запланированного просыпается цикл событий'''
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        await asyncio.sleep(0.001)
+        lags.append(time.perf_counter() - start - 0.001)
+
+
+async def run(games: int, args: argparse.Namespace) -> tuple[list[float], list[float]]:
+    db = FakeDatabase(latency=args.db_latency)
+    websocket_connections.db = db
+    eventlog.db = db
+    GameManager.managed_games.clear()
+    GameManager.broker = LocalBroker()
+
+    managers = []
+    for game_id in range(games):
+        db['games'].insert_one(Game(id=game_id).dict())
+        managers.append(GameManager.create(game_id))
+
+    latencies: list[float] = []
+    lags: list[float] = []
+    deadline = time.perf_counter() + args.duration
+    await asyncio.gather(
+        _measure_lag(deadline, lags),
+        *(_play(manager, args.players, args.interval, args.interval * i / games, deadline, latencies)
+          for i, manager in enumerate(managers))
+    )
+    # Дожидаемся фоновых записей, чтобы они не попали в следующий замер
+    await asyncio.gather(*(manager.flush() for manager in managers))
+    return latencies, lags
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--games', type=int, nargs='+', default=[1, 10, 25, 50, 100])
+    parser.add_argument('--players', type=int, default=6)
+    parser.add_argument('--interval', type=float, default=0.1,
+                        help='Пауза между событиями одной игры в секундах')
+    parser.add_argument('--duration', type=float, default=3.0)
+    parser.add_argument('--db-latency', type=float, default=0.002)
+    parser.add_argument('--blocking', action='store_true',
+                        help='Выполнять запросы к базе данных прямо в цикле событий')
+    args = parser.parse_args()
+
+    if args.blocking:
+        websocket_connections.run_db = _blocking_run_db
+
+    print(f'{"games":>6} {"events":>8} {"p50 ms":>8} {"p99 ms":>8} {"lag p99 ms":>11}')
+    for games in args.games:
+        latencies, lags = asyncio.run(run(games, args))
+        print(f'{games:>6} {len(latencies):>8} '
+              f'{statistics.median(latencies) * 1000:>8.2f} '
+              f'{percentile(latencies, 99) * 1000:>8.2f} '
+              f'{percentile(lags, 99) * 1000:>11.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+'''
+Заменитель MongoDB в памяти для бенчмарков.
+
+Поддерживает только те запросы, которые делает сервер, и может имитировать задержку сети,
+блокируя вызывающий поток так же, как это делает pymongo
+'''
+
+import copy
+import threading
+import time
+
+from pymongo import ReturnDocument
+
+from app.models.tracking import apply_update
+
+
+def _condition(document: dict, key: str, condition: dict) -> bool:
+    '''Проверяет поле документа операторами `$gt`, `$gte`, `$lt`, `$in` и `$not`'''
+    for op, arg in condition.items():
+        if op == '$not':
+            if _condition(document, key, arg):
+                return False
+        elif key not in document:
+            return False
+        elif op == '$gt' and not document[key] > arg:
+            return False
+        elif op == '$gte' and not document[key] >= arg:
+            return False
+        elif op == '$lt' and not document[key] < arg:
+            return False
+        elif op == '$in' and document[key] not in arg:
+            return False
+    return True
+
+
+def _matches(document: dict, filter: dict) -> bool:
+    for key, value in filter.items():
+        if isinstance(value, dict) and len(value) > 0 and all(op.startswith('$') for op in value):
+            if not _condition(document, key, value):
+                return False
+        elif document.get(key) != value:
+            return False
+    return True
+
+
+def _project(document: dict, projection: dict | None) -> dict:
+    document = copy.deepcopy(document)
+    if projection is not None:
+        for key, include in projection.items():
+            if not include:
+                document.pop(key, None)
+    return document
+
+
+class FakeCursor(list):
+    def sort(self, key: str, direction: int = 1) -> 'FakeCursor':
+        return FakeCursor(sorted(self, key=lambda document: document[key], reverse=direction < 0))
+
+
+class FakeCollection:
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        '''Сколько секунд длится каждый запрос'''
+        self.documents: list[dict] = []
+        self._lock = threading.Lock()
+
+    def _wait(self) -> None:
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def create_index(self, keys: list, **kwargs) -> None:
+        '''Индексы не нужны: коллекции бенчмарков маленькие'''
+
+    def find(self, filter: dict, projection: dict | None = None) -> FakeCursor:
+        self._wait()
+        with self._lock:
+            return FakeCursor(_project(document, projection)
+                              for document in self.documents if _matches(document, filter))
+
+    def find_one(self, filter: dict, projection: dict | None = None,
+                 sort: list[tuple[str, int]] | None = None) -> dict | None:
+        self._wait()
+        with self._lock:
+            documents = [document for document in self.documents if _matches(document, filter)]
+        for key, direction in reversed(sort or []):
+            documents.sort(key=lambda document: document[key], reverse=direction < 0)
+        return _project(documents[0], projection) if len(documents) > 0 else None
+
+    def insert_one(self, document: dict) -> None:
+        self._wait()
+        with self._lock:
+            self.documents.append(copy.deepcopy(document))
+
+    def insert_many(self, documents: list[dict], ordered: bool = True) -> None:
+        self._wait()
+        with self._lock:
+            self.documents.extend(copy.deepcopy(documents))
+
+    def _update(self, filter: dict, update: dict) -> None:
+        for document in self.documents:
+            if _matches(document, filter):
+                apply_update(document, copy.deepcopy(update))
+                return
+
+    def update_one(self, filter: dict, update: dict) -> None:
+        self._wait()
+        with self._lock:
+            self._update(filter, update)
+
+    def find_one_and_update(self, filter: dict, update: dict, upsert: bool = False,
+                            return_document: bool = ReturnDocument.BEFORE) -> dict | None:
+        '''Кроме операторов `apply_update` поддерживает `$inc` и `$setOnInsert`'''
+        self._wait()
+        with self._lock:
+            document = next((document for document in self.documents
+                             if _matches(document, filter)), None)
+            before = copy.deepcopy(document)
+            if document is None:
+                if not upsert:
+                    return None
+                document = {key: value for key, value in filter.items()
+                            if not isinstance(value, dict)}
+                document.update(copy.deepcopy(update.get('$setOnInsert', {})))
+                self.documents.append(document)
+            for key, amount in update.get('$inc', {}).items():
+                document[key] = document.get(key, 0) + amount
+            rest = {op: arg for op, arg in update.items() if op not in ('$inc', '$setOnInsert')}
+            if len(rest) > 0:
+                apply_update(document, copy.deepcopy(rest))
+            return copy.deepcopy(document if return_document == ReturnDocument.AFTER else before)
+
+    def delete_many(self, filter: dict) -> None:
+        self._wait()
+        with self._lock:
+            self.documents = [document for document in self.documents
+                              if not _matches(document, filter)]
+
+    def bulk_write(self, requests: list, ordered: bool = True) -> None:
+        '''Поддерживает только `pymongo.UpdateOne`'''
+        self._wait()
+        with self._lock:
+            for request in requests:
+                self._update(request._filter, request._doc)
+
+
+class FakeDatabase(dict):
+    '''База данных, создающая коллекции при первом обращении'''
+
+    def __init__(self, latency: float = 0.0) -> None:
+        super().__init__()
+        self.latency = latency
+
+    def __missing__(self, name: str) -> FakeCollection:
+        collection = FakeCollection(self.latency)
+        self[name] = collection
+        return collection
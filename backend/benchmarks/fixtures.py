@@ -0,0 +1,41 @@
+'''Типичные игровые состояния для бенчмарков'''
+
+import random
+
+from app.models import (
+    Game, GamePhase, Player, CharactersEnum, SuppliesEnum, Navigation
+)
+
+
+def make_game(players: int = 6, seed: int = 0) -> Game:
+    '''Игра в середине дня: у каждого игрока есть персонаж и несколько припасов'''
+    rng = random.Random(seed)
+    ids = [f'{i:064x}' for i in range(players)]
+    characters = rng.sample(list(CharactersEnum), k=players)
+    supplies = list(SuppliesEnum)
+
+    game = Game(id=10000 + players, host=ids[0], phase=GamePhase.Day)
+    for player_id, character, friend, enemy in zip(
+            ids, characters, rng.sample(ids, k=players), rng.sample(ids, k=players)):
+        game.players[player_id] = Player(
+            name=f'Player {player_id[-1]}',
+            character=character.value,
+            supplies=[rng.choice(supplies).value for _ in range(3)],
+            friend=friend,
+            enemy=enemy
+        )
+    game.supply_stash = [rng.choice(supplies).value for _ in range(players)]
+    game.navigation_stash = [_make_navigation(rng, ids) for _ in range(players)]
+    game.offered_navigations = [_make_navigation(rng, ids) for _ in range(2)]
+    game.reset_turn_order()
+    game.change_turn()
+    return game
+
+
+def _make_navigation(rng: random.Random, ids: list[str]) -> Navigation:
+    return Navigation(
+        bird_info=rng.choice(['exed', 'missing', 'present']),
+        overboard=[rng.choice(ids)],
+        thirsty_players=rng.sample(ids, k=min(2, len(ids))),
+        thirst_actions=['row']
+    )
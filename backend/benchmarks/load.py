@@ -0,0 +1,394 @@
+'''
+Нагрузочный тест сервера: `--games` одновременных игр по `--players` ботов, которые играют
+через настоящий маршрут вебсокета `connect` сервера uvicorn. Сервер запускается в отдельном
+процессе с базой данных в памяти (`fakemongo`), либо можно указать уже запущенный сервер в `--url`.
+
+Боты проходят игру целиком: `PlayerConnect`, `NameChange`, `StartRequest`, `TakeSupply` каждого
+игрока, `NavigationRequest` и `SaveNavigation`. После этого игра создаётся заново, пока не пройдёт
+`--duration` секунд.
+
+Задержка события - время от его отправки до того, как бот, которому предназначен ответ, его
+получил. Выводится количество событий в секунду, p50/p95/p99 задержки по типам событий и
+количество ошибок и разорванных соединений.
+
+С `--spectators` к каждой игре до её начала подключаются наблюдатели (`/{game_id}/spectate`),
+которые только считают полученные сообщения. Так видно, как наблюдатели влияют на задержку игроков.
+
+Запуск: `python -m benchmarks.load [--games 10] [--players 4] [--spectators 0] [--duration 10] [--json]`
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+from collections import Counter, defaultdict
+from itertools import count
+from typing import Callable
+
+import websockets
+
+from app.codecs import codecs, msgpack
+from app.game_ids import ID_MIN
+from app.hashing import hash_string
+
+from .event_loop import percentile
+
+
+class GameFailed(Exception):
+    '''Игру нельзя продолжить: бот не получил ответ или соединение разорвано'''
+
+
+class Stats:
+    def __init__(self) -> None:
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        '''Задержки событий по типам в секундах'''
+        self.errors: Counter[str] = Counter()
+        self.disconnects = 0
+        '''Соединения, которые сервер разорвал посреди игры'''
+        self.frames = 0
+        '''Сколько сообщений получили все боты'''
+        self.spectator_frames = 0
+        '''Сколько сообщений получили все наблюдатели'''
+        self.games = 0
+        '''Сколько игр боты прошли до конца'''
+
+    def report(self, elapsed: float) -> dict:
+        events = sum(len(latencies) for latencies in self.latencies.values())
+        return {
+            'elapsed': elapsed,
+            'events': events,
+            'events_per_second': events / elapsed,
+            'frames_per_second': self.frames / elapsed,
+            'spectator_frames_per_second': self.spectator_frames / elapsed,
+            'games': self.games,
+            'latency_ms': {
+                event_type: {
+                    'count': len(latencies),
+                    'p50': percentile(latencies, 50) * 1000,
+                    'p95': percentile(latencies, 95) * 1000,
+                    'p99': percentile(latencies, 99) * 1000,
+                }
+                for event_type, latencies in sorted(self.latencies.items())
+            },
+            'errors': dict(self.errors),
+            'disconnects': self.disconnects,
+        }
+
+
+Done = Callable[['Bot', dict], bool]
+'''Проверяет, завершает ли событие, полученное ботом, ожидание ответа'''
+
+
+class Bot:
+    '''Клиент одного игрока'''
+
+    def __init__(self, game: 'GameRun', index: int) -> None:
+        self.game = game
+        self.index = index
+        self.token = f'load-{game.game_id}-{index}'
+        self.player_id = hash_string(self.token)
+        self.websocket: websockets.WebSocketClientProtocol | None = None
+        self._reader: asyncio.Task | None = None
+
+    async def connect(self, url: str, subprotocol: str) -> None:
+        self.websocket = await websockets.connect(
+            f'{url}/{self.game.game_id}?token={self.token}&batch=true',
+            subprotocols=[subprotocol])
+        self._reader = asyncio.create_task(self._read())
+
+    async def send(self, event: dict) -> None:
+        event = {**event, 'client_token': self.token}
+        await self.websocket.send(codecs[self.websocket.subprotocol].encode(event))
+
+    async def close(self) -> None:
+        if self._reader is not None:
+            self._reader.cancel()
+        if self.websocket is not None:
+            await self.websocket.close()
+
+    async def _read(self) -> None:
+        try:
+            async for frame in self.websocket:
+                self.game.stats.frames += 1
+                message = codecs[self.websocket.subprotocol].decode(frame)
+                events = message['events'] if message['type'] == 'EventBatch' else [message]
+                for event in events:
+                    self.game.received(self, event)
+        except websockets.ConnectionClosed as e:
+            self.game.closed(self, e)
+
+
+class Spectator:
+    '''Наблюдатель, который только считает полученные сообщения'''
+
+    def __init__(self, game: 'GameRun') -> None:
+        self.game = game
+        self.websocket: websockets.WebSocketClientProtocol | None = None
+        self._reader: asyncio.Task | None = None
+
+    async def connect(self, url: str, subprotocol: str) -> None:
+        self.websocket = await websockets.connect(
+            f'{url}/{self.game.game_id}/spectate?batch=true', subprotocols=[subprotocol])
+        self._reader = asyncio.create_task(self._read())
+
+    async def close(self) -> None:
+        if self._reader is not None:
+            self._reader.cancel()
+        if self.websocket is not None:
+            await self.websocket.close()
+
+    async def _read(self) -> None:
+        try:
+            async for _ in self.websocket:
+                self.game.stats.spectator_frames += 1
+        except websockets.ConnectionClosed as e:
+            self.game.closed(None, e)
+
+
+class GameRun:
+    '''Одна игра, которую боты проходят от подключения до сохранения навигации'''
+
+    def __init__(self, game_id: int, args: argparse.Namespace, stats: Stats) -> None:
+        self.game_id = game_id
+        self.args = args
+        self.stats = stats
+        self.bots = [Bot(self, index) for index in range(args.players)]
+        self.spectators = [Spectator(self) for _ in range(args.spectators)]
+        self.phase = 'lobby'
+        self.active_player: str | None = None
+        self.supply_stash: list[dict] = []
+        self.offered_navigations: list[dict] = []
+        self.finished = False
+        self._waiter: tuple[Done, asyncio.Future] | None = None
+
+    def received(self, bot: Bot, event: dict) -> None:
+        '''Запоминает то, что нужно для следующих ходов, и проверяет, не пришёл ли ожидаемый ответ'''
+        event_type = event['type']
+        if event_type == 'GameStart':
+            self.phase = 'morning'
+        elif event_type == 'PhaseChange':
+            self.phase = event['new_phase']
+        elif event_type == 'TurnChange':
+            self.active_player = event['new_active_player']
+        elif event_type == 'SupplyShowcase' and not event.get('observed'):
+            self.supply_stash = event['supply_stash']
+        elif event_type == 'NavigationsOffer' and not event.get('observed'):
+            self.offered_navigations = event['offered_navigations']
+
+        if self._waiter is not None:
+            done, future = self._waiter
+            if not future.done() and done(bot, event):
+                future.set_result(None)
+
+    def closed(self, bot: Bot | None, error: websockets.ConnectionClosed) -> None:
+        if self.finished:
+            return
+        self.stats.disconnects += 1
+        self.stats.errors[f'closed: {error.rcvd.reason if error.rcvd else error}'] += 1
+        if self._waiter is not None and not self._waiter[1].done():
+            self._waiter[1].set_exception(GameFailed())
+
+    async def step(self, bot: Bot, event: dict, done: Done) -> None:
+        '''Отправляет событие от бота и ждёт, пока `done` не подтвердит, что ответ получен'''
+        future = asyncio.get_running_loop().create_future()
+        self._waiter = (done, future)
+        start = time.perf_counter()
+        try:
+            await bot.send(event)
+            await asyncio.wait_for(future, self.args.timeout)
+        except asyncio.TimeoutError:
+            self.stats.errors[f'timeout: {event["type"]}'] += 1
+            raise GameFailed()
+        except websockets.ConnectionClosed:
+            raise GameFailed()
+        finally:
+            self._waiter = None
+        self.stats.latencies[event['type']].append(time.perf_counter() - start)
+
+    def _turn_of(self, bot: Bot, event: dict) -> bool:
+        # Ответ пакетом `EventBatch` приходит целиком, поэтому вместе с `TurnChange` активный
+        # игрок уже получил и новые утренние припасы
+        return event['type'] == 'TurnChange' and bot.player_id == event['new_active_player']
+
+    async def play(self) -> None:
+        bots = {bot.player_id: bot for bot in self.bots}
+        host = self.bots[0]
+        await asyncio.gather(*(spectator.connect(self.args.url, self.args.subprotocol)
+                               for spectator in self.spectators))
+        for bot in self.bots:
+            await bot.connect(self.args.url, self.args.subprotocol)
+            if bot is host:
+                await self.step(bot, {'type': 'PlayerConnect'},
+                                lambda _, event: event['type'] == 'HostChange')
+            else:
+                await self.step(bot, {'type': 'PlayerConnect'},
+                                lambda _, event, bot=bot: event['type'] == 'PlayerConnect'
+                                and event['player_id'] == bot.player_id)
+        for bot in self.bots:
+            await self.step(bot, {'type': 'NameChange', 'new_name': f'Bot {bot.index}'},
+                            lambda _, event, bot=bot: event['type'] == 'NameChange'
+                            and event['player_id'] == bot.player_id)
+
+        await self.step(host, {'type': 'StartRequest'}, self._turn_of)
+        while self.phase == 'morning':
+            await self.step(bots[self.active_player],
+                            {'type': 'TakeSupply', 'supply': self.supply_stash[0]}, self._turn_of)
+
+        active = bots[self.active_player]
+        await self.step(active, {'type': 'NavigationRequest'},
+                        lambda bot, event: event['type'] == 'NavigationsOffer' and bot is active)
+        await self.step(active, {'type': 'SaveNavigation', 'navigation': self.offered_navigations[0]},
+                        lambda bot, event: event['type'] == 'SaveNavigation' and bot is not active)
+        self.finished = True
+
+    async def close(self) -> None:
+        self.finished = True
+        await asyncio.gather(*(client.close() for client in [*self.bots, *self.spectators]),
+                             return_exceptions=True)
+
+
+def _post(url: str) -> int:
+    request = urllib.request.Request(url, method='POST')
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+async def _games(ids: count, args: argparse.Namespace, stats: Stats, deadline: float) -> None:
+    '''Играет игры одну за другой до `deadline`'''
+    while time.perf_counter() < deadline:
+        game_id = next(ids)
+        status = await asyncio.to_thread(_post, f'{args.http_url}/create?game_id={game_id}')
+        if status != 200:
+            stats.errors[f'create: {status}'] += 1
+            continue
+        game = GameRun(game_id, args, stats)
+        try:
+            await game.play()
+            stats.games += 1
+        except (GameFailed, OSError, websockets.InvalidHandshake) as e:
+            if not isinstance(e, GameFailed):
+                stats.errors[f'connect: {type(e).__name__}'] += 1
+        finally:
+            await game.close()
+
+
+async def run(args: argparse.Namespace) -> dict:
+    stats = Stats()
+    ids = count(ID_MIN + args.first_id)
+    start = time.perf_counter()
+    deadline = start + args.duration
+    await asyncio.gather(*(_games(ids, args, stats, deadline) for _ in range(args.games)))
+    return stats.report(time.perf_counter() - start)
+
+
+def serve(port: int, db_latency: float) -> None:
+    '''Запускает сервер с базой данных в памяти в этом процессе'''
+    import uvicorn
+
+    from app import databases, eventlog, game_ids, main, websocket_connections
+    from app.routers import eventhandlers
+    from .fakemongo import FakeDatabase
+
+    db = FakeDatabase(latency=db_latency)
+    databases.mongo_db = main.db = eventlog.db = websocket_connections.db = db
+    game_ids.db = eventhandlers.db = db
+
+    async def no_docs(app) -> None:
+        '''Сборка документации не должна попадать в замер'''
+    main.build_docs = no_docs
+
+    uvicorn.run(main.app, host='127.0.0.1', port=port, log_level='warning')
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _wait_ready(http_url: str, timeout: float = 30.0) -> None:
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(f'{http_url}/schemas/bundle/version'):
+                return
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def print_report(report: dict, args: argparse.Namespace) -> None:
+    print(f'{args.games} games x {args.players} players, {report["elapsed"]:.1f} s: '
+          f'{report["events"]} events ({report["events_per_second"]:.1f} ev/s), '
+          f'{report["frames_per_second"]:.1f} frames/s, {report["games"]} games finished')
+    if args.spectators > 0:
+        print(f'{args.spectators} spectators per game: '
+              f'{report["spectator_frames_per_second"]:.1f} frames/s')
+    print(f'{"event":<20} {"count":>7} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+    for event_type, latency in report['latency_ms'].items():
+        print(f'{event_type:<20} {latency["count"]:>7} {latency["p50"]:>8.2f} '
+              f'{latency["p95"]:>8.2f} {latency["p99"]:>8.2f}')
+    print(f'disconnects: {report["disconnects"]}, errors: {report["errors"] or "none"}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--games', type=int, default=10, help='Сколько игр идёт одновременно')
+    parser.add_argument('--players', type=int, default=4)
+    parser.add_argument('--spectators', type=int, default=0, help='Сколько наблюдателей у каждой игры')
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--timeout', type=float, default=5.0,
+                        help='Сколько секунд бот ждёт ответ на событие')
+    parser.add_argument('--db-latency', type=float, default=0.0)
+    parser.add_argument('--subprotocol', default='overboard.json',
+                        choices=['overboard.json', 'overboard.msgpack', 'overboard.msgpack.keys'])
+    parser.add_argument('--url', help='Адрес уже запущенного сервера, например http://127.0.0.1:8000')
+    parser.add_argument('--first-id', type=int, default=0,
+                        help='С какого по счёту идентификатора создавать игры')
+    parser.add_argument('--json', action='store_true', help='Вывести результат в JSON')
+    parser.add_argument('--serve', type=int, metavar='PORT', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve is not None:
+        serve(args.serve, args.db_latency)
+        return
+    if args.players < 2:
+        parser.error('At least 2 players are needed to observe every event')
+    if args.subprotocol != 'overboard.json' and msgpack is None:
+        parser.error('msgpack is not installed')
+
+    server = None
+    if args.url is None:
+        port = _free_port()
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'benchmarks.load', '--serve', str(port),
+             '--db-latency', str(args.db_latency)],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        args.url = f'http://127.0.0.1:{port}'
+    args.http_url = args.url.rstrip('/')
+    args.url = 'ws' + args.http_url.removeprefix('http')
+    try:
+        _wait_ready(args.http_url)
+        report = asyncio.run(run(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+'''
+Микробенчмарки моделей: разбор и сериализация игры, сбор изменений, точки зрения
+наблюдателя и игроков, генерация навигации и разбор событий игроков.
+
+Результат - среднее время одного вызова в микросекундах для каждого случая. Его можно сохранить
+в JSON (`--output`) и сравнить с сохранённым ранее результатом (`--compare`): если какой-то
+случай стал медленнее больше, чем на `--threshold` процентов, программа завершается с кодом 1.
+
+Запуск:
+`python -m benchmarks.models --output baseline.json`
+`python -m benchmarks.models --compare baseline.json [--threshold 10]`
+'''
+
+import argparse
+import json
+import platform
+import random
+import sys
+import timeit
+from typing import Callable
+
+import pydantic
+
+from app.models import Game, NewSupplies, PlayerEvent, SuppliesEnum
+
+from .fixtures import make_game
+
+
+def _collect_changes_case(players: int) -> Callable[[], dict]:
+    '''Изменения, как от одного хода: имя, активный игрок, припас из утренних припасов'''
+    game = make_game(players)
+    game.track_changes()
+    ids = list(game.players)
+    supply = SuppliesEnum.MEDKIT.value
+    turn = iter(range(sys.maxsize))
+
+    def collect_changes():
+        i = next(turn)
+        player = game.players[ids[i % players]]
+        player.name = f'Player {i}'
+        game.active_player = ids[i % players]
+        if i % 2 == 0:
+            game.supply_stash.append(supply)
+        else:
+            game.supply_stash.remove(supply)
+        return game.collect_changes()
+    return collect_changes
+
+
+def make_cases() -> dict[str, Callable[[], object]]:
+    cases = {}
+    for players in range(1, 7):
+        document = make_game(players).dict()
+        cases[f'Game(**doc) {players}p'] = lambda document=document: Game(**document)
+
+    game = make_game(6)
+    player_id = next(iter(game.players))
+    event = NewSupplies(targets=[player_id], supplies=game.supply_stash)
+    cases['Game.dict 6p'] = game.dict
+    cases['Game.collect_changes 6p'] = _collect_changes_case(6)
+    cases['Game.observer_viewpoint 6p'] = game.observer_viewpoint
+    cases['NewSupplies.observer_viewpoint'] = event.observer_viewpoint
+    cases['Game.with_player_view 6p'] = lambda: Game.with_player_view(game, player_id)
+    cases['Game.with_spectator_view 6p'] = lambda: Game.with_spectator_view(game)
+    cases['Game.generate_offered_navigations 6p'] = make_game(6).generate_offered_navigations
+
+    token = {'client_token': 'benchmark'}
+    supply = game.supply_stash[0].dict()
+    navigation = game.offered_navigations[0].dict()
+    for model in [
+        {'type': 'NameChange', 'new_name': 'Player', **token},
+        {'type': 'TakeSupply', 'supply': supply, **token},
+        {'type': 'SaveNavigation', 'navigation': navigation, **token},
+    ]:
+        cases[f'PlayerEvent.from_dict {model["type"]}'] = \
+            lambda model=model: PlayerEvent.from_dict(model)
+    return cases
+
+
+def measure(func: Callable[[], object], repeat: int) -> float:
+    '''Лучшее среднее время одного вызова в микросекундах'''
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e6
+
+
+def run(names: list[str] | None, repeat: int) -> dict:
+    random.seed(0)
+    cases = make_cases()
+    results = {}
+    for name, func in cases.items():
+        if names and not any(part in name for part in names):
+            continue
+        results[name] = measure(func, repeat)
+    return {
+        'python': platform.python_version(),
+        'pydantic': pydantic.VERSION,
+        'cases': results,
+    }
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> bool:
+    '''
+    Выводит изменение времени каждого случая относительно `baseline`
+
+    :returns: `False`, если хотя бы один случай замедлился больше, чем на `threshold` процентов
+    '''
+    ok = True
+    print(f'{"case":<40} {"base us":>10} {"now us":>10} {"change":>8}')
+    for name, now in current['cases'].items():
+        if name not in baseline['cases']:
+            print(f'{name:<40} {"-":>10} {now:>10.2f} {"new":>8}')
+            continue
+        base = baseline['cases'][name]
+        change = (now - base) / base * 100
+        regressed = change > threshold
+        ok = ok and not regressed
+        print(f'{name:<40} {base:>10.2f} {now:>10.2f} {change:>+7.1f}%'
+              + (' REGRESSION' if regressed else ''))
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('cases', nargs='*',
+                        help='Замерять только случаи, в названии которых есть одна из этих строк')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='Куда записать результат в JSON')
+    parser.add_argument('--compare', metavar='BASELINE', help='Результат, с которым сравнивать')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='На сколько процентов случай может замедлиться при сравнении')
+    args = parser.parse_args()
+
+    results = run(args.cases, args.repeat)
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if args.compare is None:
+        print(f'{"case":<40} {"us":>10}')
+        for name, time in results['cases'].items():
+            print(f'{name:<40} {time:>10.2f}')
+        return
+
+    with open(args.compare) as file:
+        baseline = json.load(file)
+    if not compare(baseline, results, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
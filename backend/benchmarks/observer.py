@@ -0,0 +1,80 @@
+'''
+Сравнение скомпилированных планов `Observable` с прежним обходом полей через рефлексию
+на игре с 6 игроками.
+
+Запуск: `python -m benchmarks.observer`
+'''
+
+import argparse
+import timeit
+
+from app.models import Game, Observable, UNKNOWN, NewSupplies
+
+from .fixtures import make_game
+
+
+def legacy_observer_viewpoint(model: Observable) -> Observable:
+    '''`Observable.observer_viewpoint` в том виде, в котором он был до планов'''
+    diff = {}
+    for name in model.__fields__:
+        field = model.__fields__[name]
+        value = model.__getattribute__(name)
+
+        if hasattr(field.type_, '__args__') and UNKNOWN in field.type_.__args__:
+            if isinstance(value, list):
+                diff[name] = [UNKNOWN() for el in value]
+            elif isinstance(value, dict):
+                diff[name] = {}
+                for key in value:
+                    diff[name][key] = UNKNOWN()
+            else:
+                diff[name] = UNKNOWN()
+        elif isinstance(value, Observable):
+            diff[name] = legacy_observer_viewpoint(value)
+        elif isinstance(value, list):
+            diff[name] = [
+                legacy_observer_viewpoint(el) if isinstance(el, Observable) else el for el in value
+            ]
+        elif isinstance(value, dict):
+            diff[name] = {}
+            for key in value:
+                if isinstance(value[key], Observable):
+                    diff[name][key] = legacy_observer_viewpoint(value[key])
+                else:
+                    diff[name][key] = value[key]
+    diff['observed'] = True
+    return model.copy(update=diff)
+
+
+def measure(func, number: int) -> float:
+    '''Лучшее среднее время одного вызова в микросекундах'''
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--number', type=int, default=2000)
+    args = parser.parse_args()
+
+    game = make_game(6)
+    event = NewSupplies(targets=[next(iter(game.players))], supplies=game.supply_stash)
+    assert legacy_observer_viewpoint(game) == game.observer_viewpoint()
+    assert legacy_observer_viewpoint(game).dict() == game.observer_dict()
+
+    cases = [
+        ('Game model', lambda: legacy_observer_viewpoint(game), game.observer_viewpoint),
+        ('Game dict', lambda: legacy_observer_viewpoint(game).dict(), game.observer_dict),
+        ('NewSupplies model', lambda: legacy_observer_viewpoint(event), event.observer_viewpoint),
+        ('NewSupplies dict', lambda: legacy_observer_viewpoint(event).dict(), event.observer_dict),
+    ]
+
+    print(f'{"case":<20} {"legacy us":>10} {"plan us":>10} {"speedup":>8}')
+    for name, legacy, compiled in cases:
+        legacy_time = measure(legacy, args.number)
+        compiled_time = measure(compiled, args.number)
+        print(f'{name:<20} {legacy_time:>10.1f} {compiled_time:>10.1f} '
+              f'{legacy_time / compiled_time:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+'''
+Сравнение разбора событий игроков в `PlayerEvent.from_dict` с прямым созданием модели события:
+сколько событий каждого типа разбирается в секунду.
+
+Запуск: `python -m benchmarks.parsing`
+'''
+
+import argparse
+import timeit
+
+from pydantic import ValidationError
+
+from app.models import PlayerEvent
+from app.models.base_events import player_events
+
+from .fixtures import make_game
+
+
+def legacy_from_dict(model: dict) -> PlayerEvent:
+    '''`PlayerEvent.from_dict` в том виде, в котором он был до составленных функций разбора'''
+    return player_events[model['type']](**model)
+
+
+def make_cases() -> list[tuple[str, dict]]:
+    game = make_game(6)
+    supply = game.supply_stash[0].dict()
+    navigation = game.offered_navigations[0].dict()
+    token = {'client_token': 'benchmark'}
+    return [
+        ('PlayerConnect', {'type': 'PlayerConnect', **token}),
+        ('NameChange', {'type': 'NameChange', 'new_name': 'Player', **token}),
+        ('StartRequest', {'type': 'StartRequest', **token}),
+        ('TakeSupply', {'type': 'TakeSupply', 'supply': supply, **token}),
+        ('TakeSupply UNKNOWN', {'type': 'TakeSupply', 'supply': {}, **token}),
+        ('NavigationRequest', {'type': 'NavigationRequest', **token}),
+        ('SaveNavigation', {'type': 'SaveNavigation', 'navigation': navigation, **token}),
+        ('SaveNavigation UNKNOWN', {'type': 'SaveNavigation', 'navigation': {}, **token}),
+    ]
+
+
+def outcome(parse, model: dict) -> PlayerEvent | None:
+    '''Разобранное событие или `None`, если оно отклонено'''
+    try:
+        return parse(model)
+    except ValidationError:
+        return None
+
+
+def check_rejections() -> None:
+    '''Обе функции разбора принимают и отклоняют одни и те же события'''
+    token = {'client_token': 'benchmark'}
+    samples = [
+        {'type': 'TakeSupply', **token},
+        {'type': 'TakeSupply', 'supply': None, **token},
+        {'type': 'TakeSupply', 'supply': 5, **token},
+        {'type': 'TakeSupply', 'supply': {'type': 'medkit', 'strength': 'sharp'}, **token},
+        {'type': 'SaveNavigation', 'navigation': [], **token},
+        {'type': 'SaveNavigation', 'navigation': {'bird_info': 'present'}, **token},
+        {'type': 'NameChange', **token},
+        {'type': 'NameChange', 'new_name': 'Player'},
+    ]
+    for model in samples:
+        assert outcome(legacy_from_dict, model) == outcome(PlayerEvent.from_dict, model), model
+
+
+def events_per_second(parse, model: dict, number: int) -> float:
+    return number / min(timeit.repeat(lambda: parse(model), number=number, repeat=5))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--number', type=int, default=5000)
+    args = parser.parse_args()
+
+    cases = make_cases()
+    for _, model in cases:
+        assert legacy_from_dict(model) == PlayerEvent.from_dict(model)
+    check_rejections()
+
+    print(f'{"event":<24} {"legacy ev/s":>12} {"from_dict ev/s":>15} {"speedup":>8}')
+    for name, model in cases:
+        legacy = events_per_second(legacy_from_dict, model, args.number)
+        parsed = events_per_second(PlayerEvent.from_dict, model, args.number)
+        print(f'{name:<24} {legacy:>12,.0f} {parsed:>15,.0f} {parsed / legacy:>7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+'''
+Бенчмарк запуска сервера: время импорта приложения, выполнения `lifespan` и обработки первого
+запроса в свежем процессе интерпретатора, а также время до готовности документации.
+
+Сценарии:
+- `warm` - документация уже собрана и не менялась
+- `cold` - документацию нужно собрать заново
+- `selftest` - как `warm`, но с тестами моделей при запуске (`OVERBOARD_SELFTEST=1`)
+
+Запуск: `python -m benchmarks.startup [--runs 5]`
+'''
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+def child() -> None:
+    '''Замеряет запуск сервера в этом процессе и печатает результат в JSON'''
+    start = time.perf_counter()
+    from app import main, databases, eventlog, websocket_connections
+    imported = time.perf_counter()
+
+    from fastapi.testclient import TestClient
+    from .fakemongo import FakeDatabase
+
+    db = FakeDatabase()
+    databases.mongo_db = main.db = eventlog.db = websocket_connections.db = db
+    db['games'].insert_one(main.Game(id=1).dict())
+
+    lifespan_start = time.perf_counter()
+    with TestClient(main.app) as client:
+        started = time.perf_counter()
+        response = client.get('/1/info')
+        served = time.perf_counter()
+        assert response.status_code == 200, response.text
+
+        async def wait_docs():
+            await main.app.state.docs_build
+        client.portal.call(wait_docs)
+        docs_ready = time.perf_counter()
+
+    print(json.dumps({
+        'import': imported - start,
+        'lifespan': started - lifespan_start,
+        'first request': served - start,
+        'docs ready': docs_ready - start,
+    }))
+
+
+def measure(scenario: str) -> dict[str, float]:
+    env = dict(os.environ)
+    if scenario == 'selftest':
+        env['OVERBOARD_SELFTEST'] = '1'
+    if scenario == 'cold':
+        hash_path = os.path.join('app', 'mkdocs', 'site', '.build-hash')
+        if os.path.exists(hash_path):
+            os.remove(hash_path)
+
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, '-m', 'benchmarks.startup', '--child'], env=env,
+                            capture_output=True, text=True, check=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result['process'] = time.perf_counter() - started
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--scenarios', nargs='+', default=['warm', 'cold', 'selftest'])
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child()
+        return
+
+    columns = ['import', 'lifespan', 'first request', 'docs ready', 'process']
+    print(f'{"scenario":>9} ' + ' '.join(f'{column + " ms":>16}' for column in columns))
+    for scenario in args.scenarios:
+        results = [measure(scenario) for _ in range(args.runs)]
+        print(f'{scenario:>9} ' + ' '.join(
+            f'{statistics.median(result[column] for result in results) * 1000:>16.1f}'
+            for column in columns))
+
+
+if __name__ == '__main__':
+    main()